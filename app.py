@@ -1,13 +1,33 @@
 import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+import base64
+import binascii
+import heapq
+import io
+import math
+import time
+
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, abort, json, has_request_context
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
-import requests
+from flask_wtf.csrf import validate_csrf
+from wtforms import ValidationError
+import click
+import numpy as np
+from sqlalchemy import event
 from datetime import datetime
 from credentials import API_KEY
 
 from forms import UserAddForm, UserEditForm, ProjectForm, TagForm, LoginForm, GeocodeForm
-from models import db, connect_db, User, Project, Tag
+from cache import PersistentCache, RegionCache, TTLCache, VersionedCatalogue
+from geocoding import GEOCODE_URL, Gazetteer, GeocodingClient, GeocodingError, GeocodingThrottled, QuotaGovernor
+from indexes import TagCompleter, TagIndex, TextIndex
+from instrumentation import QueryInstrumentation, SlowQueryLog, prometheus_metric
+from models import db, connect_db, listen_for_project_changes, listen_for_user_changes, DuplicateUserError, User, Project, Project_Tag, Tag, Recommendation
+from passwords import PasswordHasherBusy
+from spatial import cluster_level, snap_bounds, tile_bounds
+from importer import import_projects
+import synthetic
+import matchmaker
 
 app = Flask(__name__)
 
@@ -18,10 +38,211 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['CLUSTER_THRESHOLD'] = 200
+app.config['CLUSTER_GRID_SIZE'] = 64
+app.config['TILE_CLUSTER_THRESHOLD'] = 50
+app.config['TILE_MAX_ZOOM'] = 22
+app.config['TILE_MAX_AGE'] = 60
+app.config['NEIGHBORHOOD_CACHE_BYTES'] = 32 * 1024 * 1024
+app.config['NEIGHBORHOOD_CACHE_MAX_AGE'] = 30
+app.config['NEIGHBORHOOD_PAGE_SIZE'] = 100
+app.config['NEIGHBORHOOD_MAX_PAGE_SIZE'] = 500
+app.config['NEIGHBORHOOD_COUNT_CAP'] = 10000
+app.config['NEIGHBORHOOD_MAX_POINTS'] = 100000
+app.config['NEAREST_DEFAULT_K'] = 20
+app.config['NEAREST_MAX_K'] = 100
+app.config['TAG_INDEX_MAX_AGE'] = float(os.environ.get('TAG_INDEX_MAX_AGE', 60))
+app.config['TEXT_INDEX_MAX_AGE'] = float(os.environ.get('TEXT_INDEX_MAX_AGE', 60))
+app.config['SEARCH_DEFAULT_LIMIT'] = 20
+app.config['SEARCH_MAX_LIMIT'] = 100
+app.config['SEARCH_CANDIDATE_CHUNK'] = 500
+app.config['TAG_CATALOGUE_MAX_AGE'] = 60
+app.config['USER_CACHE_ENTRIES'] = 10000
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_WAITING'] = 8
+app.config['PASSWORD_HASH_WAIT_TIMEOUT'] = 0.1
+app.config['USER_CACHE_MAX_AGE'] = 30
+app.config['TAG_COMPLETE_DEFAULT_LIMIT'] = 10
+app.config['TAG_COMPLETE_MAX_LIMIT'] = 50
+app.config['TAG_COMPLETE_MAX_AGE'] = 30
+app.config['GEOCODE_CACHE_PATH'] = os.environ.get('GEOCODE_CACHE_PATH',
+    os.path.join(app.instance_path, 'geocode-cache.sqlite3'))
+app.config['GEOCODE_CACHE_ENTRIES'] = 10000
+app.config['GEOCODE_CACHE_TTL'] = 30 * 24 * 60 * 60
+app.config['GEOCODE_CACHE_MAX_STALE'] = 90 * 24 * 60 * 60
+app.config['GEOCODE_URL'] = os.environ.get('GEOCODE_URL', GEOCODE_URL)
+app.config['GEOCODE_CONNECT_TIMEOUT'] = 3.05
+app.config['GEOCODE_READ_TIMEOUT'] = 10
+app.config['GEOCODE_RETRIES'] = 2
+app.config['GEOCODE_BACKOFF'] = 0.3
+app.config['GEOCODE_POOL_SIZE'] = 10
+app.config['GEOCODE_RATE'] = 10
+app.config['GEOCODE_BURST'] = 50
+app.config['GEOCODE_CLIENT_RATE'] = 0.5
+app.config['GEOCODE_CLIENT_BURST'] = 10
+app.config['GEOCODE_MAX_RETRY_AFTER'] = 3600
+app.config['GAZETTEER_PATH'] = os.environ.get('GAZETTEER_PATH')
+app.config['RECOMMENDATIONS_LIMIT'] = matchmaker.TOP_N
+app.config['RECOMMENDATIONS_IN_BACKGROUND'] = True
+app.config['IMPORT_CHUNK_SIZE'] = 500
+app.config['IMPORT_MAX_REPORTED_REJECTS'] = 100
+app.config['SQL_STATS_HEADERS'] = app.env == 'development'
+app.config['METRICS_ALLOWED_ADDRESSES'] = os.environ.get('METRICS_ALLOWED_ADDRESSES',
+    '127.0.0.1,::1').split(',')
+app.config['SLOW_QUERY_THRESHOLD'] = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.2))
+app.config['SLOW_QUERY_LOG_PATH'] = os.environ.get('SLOW_QUERY_LOG_PATH',
+    os.path.join(app.instance_path, 'slow-queries.log'))
+app.config['SLOW_QUERY_LOG_BYTES'] = 10 * 1024 * 1024
+app.config['SLOW_QUERY_LOG_BACKUPS'] = 5
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
+slow_query_log = SlowQueryLog()
+slow_query_log.init_app(app)
+
+query_instrumentation = QueryInstrumentation(slow_query_log)
+query_instrumentation.init_app(app)
+
+tag_index = TagIndex(Project_Tag.list_pairs, app.config['TAG_INDEX_MAX_AGE'])
+listen_for_project_changes(tag_index.apply)
+
+text_index = TextIndex(Project.list_texts, app.config['TEXT_INDEX_MAX_AGE'])
+listen_for_project_changes(text_index.apply)
+
+user_cache = TTLCache(app.config['USER_CACHE_ENTRIES'], app.config['USER_CACHE_MAX_AGE'])
+
+
+@event.listens_for(db.metadata, 'after_drop')
+def clear_user_cache(target, connection, **kw):
+    """ Forgets the cached users once every table was dropped """
+    user_cache.clear()
+
+
+tag_catalogue = VersionedCatalogue(Tag.list_all, lambda: Tag.catalogue_version,
+    app.config['TAG_CATALOGUE_MAX_AGE'])
+
+tag_completer = TagCompleter(tag_catalogue, tag_index.usage,
+    app.config['TAG_COMPLETE_MAX_LIMIT'], app.config['TAG_COMPLETE_MAX_AGE'])
+
+geocode_cache = PersistentCache(app.config['GEOCODE_CACHE_PATH'],
+    app.config['GEOCODE_CACHE_ENTRIES'], app.config['GEOCODE_CACHE_TTL'],
+    app.config['GEOCODE_CACHE_MAX_STALE'])
+
+geocode_governor = QuotaGovernor(app.config['GEOCODE_RATE'], app.config['GEOCODE_BURST'],
+    app.config['GEOCODE_CLIENT_RATE'], app.config['GEOCODE_CLIENT_BURST'])
+
+geocoder = GeocodingClient(app.config['GEOCODE_URL'], API_KEY, geocode_cache,
+    connect_timeout=app.config['GEOCODE_CONNECT_TIMEOUT'],
+    read_timeout=app.config['GEOCODE_READ_TIMEOUT'],
+    retries=app.config['GEOCODE_RETRIES'],
+    backoff=app.config['GEOCODE_BACKOFF'],
+    pool_size=app.config['GEOCODE_POOL_SIZE'],
+    governor=geocode_governor,
+    local=Gazetteer.load(app.config['GAZETTEER_PATH']) if app.config['GAZETTEER_PATH'] else None)
+
+neighborhood_cache = RegionCache(app.config['NEIGHBORHOOD_CACHE_BYTES'],
+    app.config['NEIGHBORHOOD_CACHE_MAX_AGE'])
+
+recommendation_queue = matchmaker.RefreshQueue()
+recommendation_queue.init_app(app)
+
+
+@listen_for_project_changes
+def invalidate_neighborhood_cache(changes):
+    """ Drops the cached neighborhood responses covering the old and
+    new positions of every changed project """
+
+    if changes is None:
+        neighborhood_cache.clear()
+        return
+    for change in changes:
+        for lat, long in change.positions:
+            neighborhood_cache.invalidate_point(lat, long)
+
+
+@listen_for_user_changes
+def clear_neighborhood_cache():
+    """ Drops every cached neighborhood response, as they show the display
+    names of the project owners """
+
+    neighborhood_cache.clear()
+
+
+@app.cli.command('rebuild-recommendations')
+def rebuild_recommendations():
+    """ Recomputes the stored project recommendations of every user """
+
+    count = matchmaker.rebuild_all(app.config['RECOMMENDATIONS_LIMIT'])
+    click.echo(f"Rebuilt recommendations for {count} users")
+
+
+@app.cli.command('import-projects')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format', type=click.Choice(['csv', 'ndjson']),
+    help="File format, guessed from the file extension by default.")
+@click.option('--user-id', type=int, help="Owner of the rows without a user_id column.")
+@click.option('--chunk-size', type=int, help="Rows inserted per transaction.")
+@click.option('--rejects', type=click.Path(dir_okay=False),
+    help="File the rejected rows are written to, PATH.rejects.ndjson by default.")
+def import_projects_command(path, format, user_id, chunk_size, rejects):
+    """ Imports projects from a CSV or NDJSON file """
+
+    format = format or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+    chunk_size = chunk_size or app.config['IMPORT_CHUNK_SIZE']
+    rejects = rejects or f"{path}.rejects.ndjson"
+
+    def progress(report):
+        click.echo(f"{report['rows']} rows, {report['imported']} imported, "
+            f"{report['rejected']} rejected, {report['rows_per_second']:.0f} rows/s")
+
+    with open(path, newline='', encoding='utf-8') as lines, \
+            open(rejects, 'w', encoding='utf-8') as rejected:
+        report = import_projects(lines, format, user_id, chunk_size,
+            on_reject=lambda reject: rejected.write(json.dumps(reject) + '\n'),
+            on_progress=progress)
+
+    click.echo(f"Imported {report['imported']} of {report['rows']} rows in "
+        f"{report['seconds']:.1f}s ({report['rows_per_second']:.0f} rows/s)")
+    if report['rejected']:
+        click.echo(f"{report['rejected']} rejected rows written to {rejects}")
+    click.echo("Run flask rebuild-recommendations to match the new projects")
+
+
+@app.cli.command('generate-data')
+@click.option('--users', type=int, default=1000, show_default=True, help="Users to add.")
+@click.option('--projects', type=int, default=2000, show_default=True, help="Projects to add.")
+@click.option('--tags', type=int, default=500, show_default=True, help="Size of the tag vocabulary.")
+@click.option('--seed', type=int, default=0, show_default=True, help="Seed of the random data.")
+@click.option('--reset', is_flag=True, help="Drop and recreate every table first.")
+@click.option('--recommendations', is_flag=True, help="Rebuild the recommendations afterwards.")
+def generate_data(users, projects, tags, seed, reset, recommendations):
+    """ Adds deterministic synthetic users and projects for load testing """
+
+    if reset:
+        db.drop_all()
+        db.create_all()
+
+    started = time.perf_counter()
+    counts = synthetic.generate(users, projects, tags, seed,
+        on_progress=lambda table, rows: click.echo(f"{rows} {table}"))
+    click.echo(f"Added {counts['users']} users, {counts['projects']} projects and "
+        f"{counts['project_tags']} project tags in {time.perf_counter() - started:.1f}s")
+
+    if recommendations:
+        count = matchmaker.rebuild_all(app.config['RECOMMENDATIONS_LIMIT'])
+        click.echo(f"Rebuilt recommendations for {count} users")
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """ Asks the user to retry when too many passwords are being
+    checked at once """
+
+    flash("Too many sign ins right now, please try again in a moment.", "danger")
+    return render_template("landing.html"), 503, {'Retry-After': '5'}
+
 
 def browser_login(user):
     """ Adds the User instance to session and g variable """
@@ -37,18 +258,143 @@ def browser_logout():
     g.user = None
 
 
+def encode_cursor(after):
+    """ Encodes a page sort key as an opaque URL safe cursor string """
+
+    if after is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(after).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Decodes a cursor string back into a page sort key, aborting
+    with a 400 if the cursor is not valid """
+
+    try:
+        distance, project_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(distance), int(project_id)
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        abort(400)
+
+
+def neighborhood_payload(north, south, east, west, level, threshold, limit, after=None,
+        tags=(), match_all=False):
+    """ Builds the API response for the projects within the bounds,
+    limited to those carrying any (or all) of tags if given, as clusters
+    at the given grid level if there are more projects than the
+    threshold, otherwise as a page of at most limit projects (nearest to
+    the centre first) with a cursor for the next page and the total
+    number of projects, which is capped for large areas. The projects
+    are counted first so sparse areas skip the clustering queries """
+
+    cap = app.config['NEIGHBORHOOD_COUNT_CAP']
+    if level is not None:
+        cap = min(cap, threshold + 1)
+    total = Project.count_neighborhood(north, south, east, west, cap, tags, match_all)
+    total_exact = total < cap
+
+    if level is not None and total > threshold:
+        clusters = Project.query_neighborhood_clusters(north, south, east, west, level,
+            tags=tags, match_all=match_all)
+        return {'projects': [], 'clusters': clusters,
+            'total': sum(cluster['count'] for cluster in clusters),
+            'total_exact': True, 'next_cursor': None}
+
+    projects, next_after = Project.query_neighborhood_page(north, south, east, west,
+        limit, after, tags, match_all)
+    return {'projects': projects, 'clusters': [], 'total': total,
+        'total_exact': total_exact, 'next_cursor': encode_cursor(next_after)}
+
+
+def cached_neighborhood_json(key, bounds, level, threshold, limit):
+    """ Returns the JSON body of the neighborhood_payload for the bounds
+    from the neighborhood cache, building and caching it on a miss """
+
+    body = neighborhood_cache.get(key)
+    if body is None:
+        token = neighborhood_cache.begin()
+        payload = neighborhood_payload(*bounds, level, threshold, limit)
+        body = json.dumps(payload).encode('utf-8')
+        neighborhood_cache.put(key, bounds, body, len(body), token)
+    return body
+
+
+def cached_neighborhood_points(bounds):
+    """ Returns the spatial.PointSet of the projects within the bounds
+    from the neighborhood cache, loading and caching it on a miss, or
+    None if the bounds hold more than NEIGHBORHOOD_MAX_POINTS projects """
+
+    key = ('points', bounds)
+    points = neighborhood_cache.get(key)
+    if points is None:
+        token = neighborhood_cache.begin()
+        points = Project.query_points(*bounds, app.config['NEIGHBORHOOD_MAX_POINTS'])
+        if points is None:
+            neighborhood_cache.put(key, bounds, False, 0, token)
+        else:
+            neighborhood_cache.put(key, bounds, points, points.nbytes, token)
+    return None if points is False else points
+
+
+def points_payload(points, north, south, east, west, level, threshold, limit, after=None,
+        tags=(), match_all=False):
+    """ Builds the same API response as neighborhood_payload from a
+    spatial.PointSet holding at least every project within the bounds.
+    Tags are matched against the tag index """
+
+    points = points.select(points.within(north, south, east, west))
+    if tags:
+        points = points.select(np.array(tag_index.carrying(points.ids.tolist(), tags,
+            match_all), dtype=bool).reshape(-1))
+    if level is not None and len(points) > threshold:
+        return {'projects': [], 'clusters': points.clusters(level),
+            'total': len(points), 'total_exact': True, 'next_cursor': None}
+
+    ids, next_after = points.page((north + south) / 2, (east + west) / 2, limit, after)
+    return {'projects': Project.query_summaries(ids), 'clusters': [],
+        'total': len(points), 'total_exact': True, 'next_cursor': encode_cursor(next_after)}
+
+
+def load_current_user(user_id):
+    """ Returns the logged in User, from the user cache when possible,
+    or None if they no longer exist """
+
+    values = user_cache.get(user_id)
+    if values is not None:
+        return User.from_snapshot(values)
+    user = User.query.get(user_id)
+    if user:
+        user_cache.put(user_id, user.snapshot())
+    return user
+
+
+class RequestGlobals(_AppCtxGlobals):
+    """ Flask's g, loading the logged in user the first time g.user is
+    used in a request and logging out users who no longer exist """
+
+    def __getattr__(self, name):
+        if name != 'user':
+            raise AttributeError(name)
+        user = None
+        if has_request_context() and 'CURR_USER_KEY' in session:
+            user = load_current_user(session['CURR_USER_KEY'])
+            if not user:
+                session.pop('CURR_USER_KEY')
+        self.user = user
+        return user
+
+
+app.app_ctx_globals_class = RequestGlobals
+
+
 @app.before_request
 def add_user_to_g():
-    """ If we're logged in, add curr user to Flask global. """
+    """ If we're logged in, let g.user load curr user when first used,
+    or add the guest's geocode to Flask global. """
 
-    if 'CURR_USER_KEY' in session:
-        g.user = User.query.get(session['CURR_USER_KEY'])
-        if not g.user:
-            session.pop('CURR_USER_KEY')
-    else:
-        g.user = None
-        if 'GUEST_GEOCODE' in session:
-            g.guest = session['GUEST_GEOCODE']
+    g.pop('user', None)
+    if 'CURR_USER_KEY' not in session and 'GUEST_GEOCODE' in session:
+        g.guest = session['GUEST_GEOCODE']
 
 
 @app.before_request
@@ -63,7 +409,7 @@ def landing_page():
     """ Render initial landing page for user or redirect to
     the search page if the user is already logged in previously """
 
-    if 'CURR_USER_KEY' in session:
+    if g.user:
         return redirect("/search")
 
     return render_template("landing.html")
@@ -73,7 +419,7 @@ def landing_page():
 def sign_up_page():
     """ Render the signup form or process the information """
 
-    if 'CURR_USER_KEY' in session:
+    if g.user:
         flash("You are already logged into an account, please log out before creating a new account.", "danger")
         return redirect("/search")
     
@@ -85,14 +431,19 @@ def sign_up_page():
             'display_name': form.display_name.data,
             'email': form.email.data,
             'password': form.password.data,
-            'profile_pic': request.form.get('profile_pic'),
+            'profile_pic': form.profile_pic.data or None,
             'lat': form.lat.data,
             'long': form.long.data,
-            'privacy': request.form.get('privacy'),
-            'seeking_project': request.form.get('seeking_project'),
-            'seeking_help': request.form.get('seeking_help')
+            'privacy': form.privacy.data,
+            'seeking_project': form.seeking_project.data,
+            'seeking_help': form.seeking_help.data
         }
-        user_final = User.signup(user_obj)
+        try:
+            user_final = User.signup(user_obj)
+        except DuplicateUserError as error:
+            getattr(form, error.field).errors.append(f"This {error.field.replace('_', ' ')} is already taken.")
+            return render_template("profile-new.html", form=form)
+        recommendation_queue.refresh_users([user_final.id])
         browser_login(user_final)
 
         flash("Signed up successfully", "success")
@@ -105,7 +456,7 @@ def sign_up_page():
 def login_page():
     """ Render the login form or process the information """
 
-    if 'CURR_USER_KEY' in session:
+    if g.user:
         flash("You are already logged into an account.", "success")
         return redirect("/search")
     
@@ -139,7 +490,7 @@ def guest_page():
     """ Renders the guest access page and prepares user for
     the search page by collecting geocode data """
 
-    if 'CURR_USER_KEY' in session:
+    if g.user:
         flash("You are already logged into an account.", "success")
         return redirect("/search") 
 
@@ -159,13 +510,10 @@ def guest_page():
 def search_page():
     """ Renders the main search page """
 
-    if ('GUEST_GEOCODE' not in session) and ('CURR_USER_KEY' not in session):
+    if ('GUEST_GEOCODE' not in session) and not g.user:
        flash("Please choose an option, before searching for projects","danger")
        return redirect("/") 
 
-    if ('CURR_USER_KEY' in session):
-        g.user = User.lookup_user(session['CURR_USER_KEY'])
-
     return render_template("search.html")
 
 
@@ -173,7 +521,7 @@ def search_page():
 def profile_edit():
     """ Renders form to edit the profile or process the information """
 
-    if not 'CURR_USER_KEY' in session:
+    if not g.user:
         flash("Unauthorized access. Account needed to edit profile.", "danger")
         if 'GUEST_GEOCODE' in session:
             return redirect("/search")
@@ -194,6 +542,10 @@ def profile_edit():
             user.seeking_project = form.seeking_project.data
             user.seeking_help = form.seeking_help.data
             db.session.commit()
+            user_cache.invalidate(user.id)
+            recommendation_queue.refresh_users([user.id])
+            for project in user.projects:
+                recommendation_queue.refresh_project(project.id)
                 
             flash("Profile edited successfully.", "success")
             return redirect("/search")
@@ -207,7 +559,7 @@ def profile_edit():
 def profile_delete(user_id):
     """ Deletes the currently logged in user """
 
-    if not 'CURR_USER_KEY' in session or int(user_id) != g.user.id:
+    if not g.user or int(user_id) != g.user.id:
         flash("Unauthorized access. Correct account needed to delete profile.", "danger")
         if 'GUEST_GEOCODE' in session:
             return redirect("/search")
@@ -215,8 +567,12 @@ def profile_delete(user_id):
             return redirect("/")
 
     user = User.lookup_user(user_id)
+    affected = {other for project in user.projects
+        for other in Recommendation.users_for_project(project.id)}
     db.session.delete(user)
     db.session.commit()
+    user_cache.invalidate(int(user_id))
+    recommendation_queue.refresh_users(affected)
     
     browser_logout()
     flash("Profile deleted successfully.", "success")
@@ -227,7 +583,7 @@ def profile_delete(user_id):
 def project_new():
     """ Renders form to create new project or process the form """
 
-    if not 'CURR_USER_KEY' in session:
+    if not g.user:
         flash("Unauthorized access. Account needed to create.", "danger")
         if 'GUEST_GEOCODE' in session:
             return redirect("/search")
@@ -235,7 +591,6 @@ def project_new():
             return redirect("/")
 
     form = ProjectForm(prefix='form-project-new-')
-    tags_full_list = Tag.list_all()
 
     if form.validate_on_submit():
         optional_date_keys = ['inquiry_deadline', 'work_start', 'work_end']
@@ -270,26 +625,15 @@ def project_new():
             'pic_url1': request.form.get('pic_url1'),
             'pic_url2': request.form.get('pic_url2'),
         }
-        project_final = Project.create_project(project_obj)
-
         tags = request.form.get('tags')
-        if tags:
-            tags = tags.split('|')
-            tag_objs = []
-            if (len(tags) > 0):
-                for name in tags:
-                    tag_obj = Tag.lookup_tag(name)
-                    if not tag_obj:
-                        tag_obj = Tag.create_tag(name)
-
-                    tag_objs.append(tag_obj)
-                project_final.tags = tag_objs
-                db.session.commit()
+        tag_names = tags.split('|') if tags else []
+        project_final = Project.create_project(project_obj, tag_names)
+        recommendation_queue.refresh_project(project_final.id)
 
         flash("Project created successfully", "success")
         return redirect(f"/project/{project_final.id}")
 
-    return render_template("project-new.html", form=form, tags_full_list = tags_full_list)
+    return render_template("project-new.html", form=form)
 
 
 @app.route("/project/<project_id>")
@@ -306,7 +650,7 @@ def project_detail(project_id):
 def project_edit(project_id):
     """ Renders form to edit specific project or process the form """
 
-    if not 'CURR_USER_KEY' in session:
+    if not g.user:
         flash("Unauthorized access. Account needed to edit.", "danger")
         return redirect(f"/project/{project_id}")
 
@@ -318,7 +662,6 @@ def project_edit(project_id):
 
     form = ProjectForm(obj = project, prefix='form-project-edit-')
 
-    tags_full_list = Tag.list_all()
     project_tags = [tag.name for tag in project.tags]
     tags_list_str = "|".join(project_tags)
 
@@ -334,16 +677,7 @@ def project_edit(project_id):
         project.pic_url2 = request.form.get('pic_url2')
 
         tags = request.form.get('tags')
-        if (tags):
-            tags = tags.split('|')
-        tag_objs = []
-        if (tags and len(tags) > 0):
-            for name in tags:
-                tag_obj = Tag.lookup_tag(name)
-                if not tag_obj:
-                    tag_obj = Tag.create_tag(name)
-                tag_objs.append(tag_obj)
-        project.tags = tag_objs
+        project.tags = Tag.resolve_names(tags.split('|') if tags else [])
 
         optional_date_keys = ['inquiry_deadline', 'work_start', 'work_end']
         optional_date_values = []
@@ -364,18 +698,19 @@ def project_edit(project_id):
                 print('caught value error', optional_date_values)
         project.inquiry_deadline, project.work_start, project.work_end = optional_date_values      
         db.session.commit()
+        recommendation_queue.refresh_project(project.id)
 
         flash("Project edited successfully.", "success")
         return redirect(f"/project/{project_id}")
 
-    return render_template("project-edit.html", form=form, project=project, tags_list_str=tags_list_str, tags_full_list=tags_full_list)
+    return render_template("project-edit.html", form=form, project=project, tags_list_str=tags_list_str)
 
 
 @app.route("/project/<project_id>/delete", methods = ["POST"])
 def project_delete(project_id):
     """ Renders form to delete a specific project"""
 
-    if not 'CURR_USER_KEY' in session:
+    if not g.user:
         flash("Unauthorized access. Account needed to delete.", "danger")
         return redirect(f"/project/{project_id}")
 
@@ -384,8 +719,10 @@ def project_delete(project_id):
         flash("Unauthorized user. Correct user account needed.", "danger")
         return redirect(f"/project/{project_id}")
 
+    affected = Recommendation.users_for_project(project.id)
     db.session.delete(project)
     db.session.commit()
+    recommendation_queue.refresh_users(affected)
 
     flash("Project deleted successfully.", "success")
     return redirect("/search")
@@ -393,47 +730,259 @@ def project_delete(project_id):
 
 @app.route("/api/geocode")
 def api_geocode():
-    """ Handle geocoding api get requests """
-
-    address = request.args['address']
-    url = "https://maps.googleapis.com/maps/api/geocode/json?" 
-    resp = requests.get(url,
-        params={"key": API_KEY, "address": address})
-    json_data = resp.json()
-    return jsonify(json_data)
+    """ Handle geocoding api get requests, answered from the geocode
+    cache when the same address was looked up before """
+
+    client_id = g.user.id if g.user else request.remote_addr
+    try:
+        body = geocoder.lookup(request.args['address'], client_id)
+    except GeocodingThrottled as error:
+        resp = jsonify({'status': 'OVER_QUERY_LIMIT', 'results': []})
+        resp.status_code = 429
+        resp.headers['Retry-After'] = str(math.ceil(min(error.retry_after,
+            app.config['GEOCODE_MAX_RETRY_AFTER'])))
+        return resp
+    except GeocodingError:
+        abort(502)
+    return app.response_class(body, mimetype='application/json')
+
+
+@app.route("/api/geocode/stats")
+def api_geocode_stats():
+    """ Return the geocoding counters of this worker, to size the quota,
+    to the allowed client addresses only """
+
+    if request.remote_addr not in app.config['METRICS_ALLOWED_ADDRESSES']:
+        abort(404)
+    return jsonify(geocoder.counters())
+
+
+@app.route("/metrics")
+def metrics():
+    """ Return the request, SQL and geocoding counters of this worker in
+    the Prometheus text format, to the allowed client addresses only """
+
+    if request.remote_addr not in app.config['METRICS_ALLOWED_ADDRESSES']:
+        abort(404)
+    lines = query_instrumentation.prometheus()
+    lines.extend(prometheus_metric('geocoder_lookups_total',
+        "Geocoding lookups by how they were answered.", 'counter',
+        [({'result': result}, count) for result, count in sorted(geocoder.counters().items())]))
+    return app.response_class('\n'.join(lines) + '\n',
+        mimetype='text/plain', content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 @app.route("/api/neighborhood")
 def api_neighborhood():
-    """ Handle project querying in the map vicinity """
+    """ Handle project querying in the map vicinity. The projects of
+    the bounds widened to the cache grid are cached, so nearby viewports
+    share them, and narrowed down to the exact bounds in memory.
+    Projects are returned a page of limit at a time, continued by the
+    cursor of the previous page, and can be limited to those carrying
+    any (or all) of a pipe separated list of tags. When a zoom level is
+    given and the vicinity holds more projects than the cluster
+    threshold, clusters of nearby projects are returned instead """
 
     north = float(request.args['north'])
     south = float(request.args['south'])
     east = float(request.args['east'])
     west = float(request.args['west'])
+    zoom = request.args.get('zoom', type=int)
+
+    level = None
+    if zoom is not None:
+        grid = request.args.get('grid', app.config['CLUSTER_GRID_SIZE'], type=int)
+        level = cluster_level(zoom, grid)
+
+    limit = request.args.get('limit', app.config['NEIGHBORHOOD_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['NEIGHBORHOOD_MAX_PAGE_SIZE']))
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+
+    tags = tuple(sorted(set(filter(None, request.args.get('tags', '').split('|')))))
+    match_all = request.args.get('tag_match', 'any') == 'all'
+
+    threshold = app.config['CLUSTER_THRESHOLD']
+    viewport = (north, south, east, west)
+    snap_level, bounds = snap_bounds(*viewport)
+    key = ('neighborhood', viewport, level, threshold, limit, after, tags, match_all)
+    body = neighborhood_cache.get(key)
+    if body is None:
+        token = neighborhood_cache.begin()
+        points = cached_neighborhood_points(bounds)
+        if points is None:
+            payload = neighborhood_payload(*viewport, level, threshold, limit, after,
+                tags, match_all)
+        else:
+            payload = points_payload(points, *viewport, level, threshold, limit, after,
+                tags, match_all)
+        body = json.dumps(payload).encode('utf-8')
+        neighborhood_cache.put(key, bounds, body, len(body), token)
+    return app.response_class(body, mimetype='application/json')
+
+
+@app.route("/api/tiles/<int:z>/<int:x>/<int:y>")
+def api_tile(z, x, y):
+    """ Handle project querying for a single Web Mercator map tile,
+    with HTTP cache headers so repeated tiles are served by caches """
+
+    if z > app.config['TILE_MAX_ZOOM'] or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+
+    bounds = tile_bounds(z, x, y)
+    level = cluster_level(z, app.config['CLUSTER_GRID_SIZE'])
+    threshold = app.config['TILE_CLUSTER_THRESHOLD']
+    body = cached_neighborhood_json(('tile', z, x, y, threshold),
+        bounds, level, threshold, threshold)
+    resp = app.response_class(body, mimetype='application/json')
+
+    resp.cache_control.public = True
+    resp.cache_control.max_age = app.config['TILE_MAX_AGE']
+    resp.add_etag()
+    return resp.make_conditional(request)
+
+
+@app.route("/api/nearest")
+def api_nearest():
+    """ Handle querying for the projects nearest to a location, taken
+    from the lat&long arguments, the logged in user or the guest's
+    geocode, in that order """
+
+    k = request.args.get('k', app.config['NEAREST_DEFAULT_K'], type=int)
+    k = max(1, min(k, app.config['NEAREST_MAX_K']))
+
+    if 'lat' in request.args and 'long' in request.args:
+        lat = request.args.get('lat', type=float)
+        long = request.args.get('long', type=float)
+    elif g.user:
+        lat, long = g.user.lat, g.user.long
+    elif 'GUEST_GEOCODE' in session:
+        lat, long = session['GUEST_GEOCODE']
+    else:
+        abort(400)
+
+    if lat is None or long is None:
+        abort(400)
+
+    nearest = Project.query_nearest(lat, long, k)
+    return jsonify({'projects': nearest})
+
 
-    neighborhood = Project.query_neighborhood(north, south, east, west)
+@app.route("/api/search")
+def api_search():
+    """ Handle keyword searches over project names and descriptions,
+    ranked by relevance and optionally limited to lat&long bounds """
 
-    resp = { 'projects': []}
-    for project in neighborhood:
-        resp['projects'].append({'id': project.id,
-        'name': project.name,
-        'display_name': project.user.display_name,
-        'lat': project.lat,
-        'long': project.long,
-        'tags': [tag.name for tag in project.tags]
-        })
-    return jsonify(resp)
+    limit = request.args.get('limit', app.config['SEARCH_DEFAULT_LIMIT'], type=int)
+    limit = max(1, min(limit, app.config['SEARCH_MAX_LIMIT']))
+
+    scores = text_index.search(request.args.get('q', ''))
+    if scores and all(bound in request.args for bound in ['north', 'south', 'east', 'west']):
+        viewport = tuple(float(request.args[bound]) for bound in ['north', 'south', 'east', 'west'])
+        scores = scores_within(scores, viewport, limit)
+
+    ranked = dict(heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0])))
+    projects = Project.query_summaries(list(ranked))
+    for project in projects:
+        project['score'] = ranked[project['id']]
+    return jsonify({'projects': projects})
+
+
+def scores_within(scores, viewport, limit):
+    """ Narrows a dict of project ids to search scores down to the
+    projects within the (north, south, east, west) viewport, using the
+    cached positions of the neighborhood. Areas too large to hold are
+    checked a chunk of the best hits at a time until limit are found """
+
+    points = cached_neighborhood_points(snap_bounds(*viewport)[1])
+    if points is not None:
+        inside = set(points.select(points.within(*viewport)).ids.tolist())
+        return {id: score for id, score in scores.items() if id in inside}
+
+    ranking = sorted(scores, key=lambda id: (-scores[id], id))
+    chunk = app.config['SEARCH_CANDIDATE_CHUNK']
+    found = {}
+    for start in range(0, len(ranking), chunk):
+        inside = Project.query_neighborhood_ids(*viewport, ranking[start:start + chunk])
+        found.update((id, scores[id]) for id in ranking[start:start + chunk] if id in inside)
+        if len(found) >= limit:
+            break
+    return found
+
+
+IMPORT_FORMATS = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson'}
+
+
+@app.route("/api/projects/import", methods = ["POST"])
+def api_project_import():
+    """ Handle bulk imports of projects for the logged in user, from a
+    CSV (text/csv) or NDJSON (application/x-ndjson) request body streamed
+    as it is read. The CSRF token must be sent in an X-CSRFToken header """
+
+    if not g.user:
+        abort(401)
+
+    if app.config.get('WTF_CSRF_ENABLED', True):
+        try:
+            validate_csrf(request.headers.get('X-CSRFToken'))
+        except ValidationError:
+            abort(400)
+
+    format = IMPORT_FORMATS.get(request.mimetype)
+    if not format:
+        abort(415)
+
+    rejected = []
+    def reject(row):
+        if len(rejected) < app.config['IMPORT_MAX_REPORTED_REJECTS']:
+            rejected.append(row)
+
+    positions = set()
+    def imported(projects):
+        positions.update((project['lat'], project['long']) for project in projects)
+
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    report = import_projects(lines, format, g.user.id,
+        app.config['IMPORT_CHUNK_SIZE'], on_reject=reject, owners_from_rows=False,
+        on_import=imported)
+    if positions:
+        recommendation_queue.refresh_near(positions, [g.user.id])
+    return jsonify({**report, 'rejected_rows': rejected})
+
+
+@app.route("/api/recommendations")
+def api_recommendations():
+    """ Handle querying for the projects recommended to the logged in
+    user, best match first """
+
+    if not g.user:
+        abort(401)
+
+    scores = dict(Recommendation.list_for_user(g.user.id))
+    projects = Project.query_summaries(list(scores))
+    for project in projects:
+        project['score'] = scores[project['id']]
+    return jsonify({'projects': projects})
 
 
 @app.route("/api/tags")
 def api_tag_list():
-    """ Generate and return a json list of all existing tags """
-    
-    tags_full_list = Tag.list_all()
-    return jsonify(tags_full_list)
+    """ Return the json list of all existing tags from the tag catalogue,
+    with an ETag so unchanged lists can be answered with a 304 """
 
+    catalogue = tag_catalogue.get()
+    resp = app.response_class(catalogue.body, mimetype='application/json')
+    resp.set_etag(catalogue.etag)
+    return resp.make_conditional(request)
 
 
+@app.route("/api/tags/complete")
+def api_tag_complete():
+    """ Handle tag autocompletion, returning the most used tags whose
+    name starts with the prefix argument """
 
+    limit = request.args.get('limit', app.config['TAG_COMPLETE_DEFAULT_LIMIT'], type=int)
+    limit = max(1, min(limit, app.config['TAG_COMPLETE_MAX_LIMIT']))
 
+    completions = tag_completer.complete(request.args.get('prefix', ''), limit)
+    return jsonify([{'name': name, 'count': count} for name, count in completions])
@@ -0,0 +1,303 @@
+""" Endpoint benchmarks against synthetic datasets of several sizes.
+
+For each dataset size every table of the benchmark database is dropped,
+recreated and filled by synthetic.generate(), then each endpoint is driven
+through the Flask test client. Latency percentiles and SQL queries per
+request come from a first pass, allocations per request from a second,
+shorter pass under tracemalloc so tracing does not skew the latencies.
+
+The results can be stored as a baseline (per database dialect and size)
+and later runs fail when a metric regresses past the threshold:
+
+    python bench.py --update-baseline
+    python bench.py --database-url postgresql:///matchmaker_bench
+"""
+
+from collections import namedtuple
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import click
+import numpy as np
+from flask import json
+from sqlalchemy import event
+
+from app import app, recommendation_queue
+from models import db
+import synthetic
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+USERS_PER_PROJECT = 0.2
+TAGS = 500
+SEED = 0
+WARMUP = 5
+ALLOCATION_REQUESTS = 20
+PERCENTILES = (50, 95, 99)
+# Metrics compared against the baseline, with the absolute increase they
+# may show, or None to allow the relative threshold (timings are noisy,
+# query counts only vary with cache hits)
+CHECKED_METRICS = {'p50_ms': None, 'p95_ms': None, 'queries': 0.5, 'alloc_kib': None}
+
+Endpoint = namedtuple('Endpoint', ['name', 'request', 'share'])
+
+
+class Dataset:
+    """ What the endpoints need to know about the generated data """
+
+    def __init__(self, size, counts, rng):
+        self.size = size
+        self.users = counts['users']
+        self.projects = counts['projects']
+        self.tags = synthetic.tag_vocabulary(counts['tags'])
+        self.rng = rng
+        self.signups = 0
+
+    def user_id(self):
+        return int(self.rng.integers(self.users)) + 1
+
+    def project_id(self):
+        return int(self.rng.integers(self.projects)) + 1
+
+    def city(self):
+        return synthetic.DEFAULT_CITIES[int(self.rng.integers(len(synthetic.DEFAULT_CITIES)))]
+
+
+def _logged_in(client, user_id):
+    with client.session_transaction() as change_session:
+        change_session.clear()
+        if user_id is not None:
+            change_session['CURR_USER_KEY'] = user_id
+
+
+def get_neighborhood(client, data):
+    """ A viewport of a few km to a few tens of km around a city """
+    city = data.city()
+    lat, long = city.lat + data.rng.normal() * 0.1, city.long + data.rng.normal() * 0.1
+    half = data.rng.uniform(0.02, 0.2)
+    _logged_in(client, None)
+    return client.get("/api/neighborhood", query_string={'north': lat + half,
+        'south': lat - half, 'east': long + half, 'west': long - half, 'zoom': 12})
+
+
+def get_tags(client, data):
+    _logged_in(client, None)
+    return client.get("/api/tags")
+
+
+def get_project(client, data):
+    _logged_in(client, None)
+    return client.get(f"/project/{data.project_id()}")
+
+
+def post_project(client, data):
+    user_id = data.user_id()
+    city = data.city()
+    tags = data.rng.choice(len(data.tags), size=int(data.rng.integers(4)), replace=False)
+    _logged_in(client, user_id)
+    return client.post("/project/new", data={
+        'form-project-new-name': f"Bench project {user_id}",
+        'form-project-new-description': "Benchmark project",
+        'form-project-new-contact_info_type': 'email',
+        'form-project-new-contact_info': f"user{user_id}@example.com",
+        'form-project-new-lat': city.lat + data.rng.normal() * 0.1,
+        'form-project-new-long': city.long + data.rng.normal() * 0.1,
+        'tags': '|'.join(data.tags[tag] for tag in tags)})
+
+
+def post_login(client, data):
+    _logged_in(client, None)
+    return client.post("/login", data={
+        'form-user-login-email': f"user{data.user_id()}@example.com",
+        'form-user-login-password': 'password'})
+
+
+def post_signup(client, data):
+    data.signups += 1
+    name = f"bench{data.size}x{data.signups}"
+    city = data.city()
+    _logged_in(client, None)
+    return client.post("/profile/new", data={
+        'form-user-signup-first_name': 'Bench',
+        'form-user-signup-display_name': name[:20],
+        'form-user-signup-email': f"{name}@example.com",
+        'form-user-signup-password': 'password',
+        'form-user-signup-confirm_password': 'password',
+        'form-user-signup-lat': city.lat,
+        'form-user-signup-long': city.long,
+        'form-user-signup-accept_rules': True})
+
+
+# share scales the number of requests of the endpoints dominated by bcrypt
+ENDPOINTS = [
+    Endpoint('GET /api/neighborhood', get_neighborhood, 1),
+    Endpoint('GET /api/tags', get_tags, 1),
+    Endpoint('GET /project/<id>', get_project, 1),
+    Endpoint('POST /project/new', post_project, 1),
+    Endpoint('POST /login', post_login, 0.2),
+    Endpoint('POST /profile/new', post_signup, 0.2),
+]
+
+
+def percentile_ms(seconds, percentile):
+    return float(np.percentile(seconds, percentile)) * 1000
+
+
+def measure(endpoint, data, requests):
+    """ Returns the metrics of requests calls of an endpoint, after a few
+    unmeasured warm up calls """
+    queries = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    client = app.test_client()
+    for _ in range(WARMUP):
+        _check(endpoint, endpoint.request(client, data))
+
+    latencies = []
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        for _ in range(requests):
+            started = time.perf_counter()
+            resp = endpoint.request(client, data)
+            latencies.append(time.perf_counter() - started)
+            _check(endpoint, resp)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(min(requests, ALLOCATION_REQUESTS)):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            _check(endpoint, endpoint.request(client, data))
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    metrics = {f"p{percentile}_ms": percentile_ms(latencies, percentile)
+        for percentile in PERCENTILES}
+    metrics['queries'] = len(queries) / requests
+    metrics['alloc_kib'] = float(np.mean(peaks)) / 1024
+    return metrics
+
+
+def _check(endpoint, resp):
+    """ Fails the run on error responses, rejected forms and failed
+    logins, which would be fast for the wrong reasons """
+    expected = 302 if endpoint.name.startswith('POST') else 200
+    if resp.status_code != expected or (resp.location or '').endswith('/login'):
+        raise click.ClickException(f"{endpoint.name} answered {resp.status_code}")
+
+
+def run(sizes, requests):
+    """ Benchmarks every endpoint against a fresh dataset of each size.
+    Returns {size: {endpoint name: metrics}} """
+    results = {}
+    for size in sizes:
+        db.drop_all()
+        db.create_all()
+        started = time.perf_counter()
+        counts = synthetic.generate(max(1, int(size * USERS_PER_PROJECT)), size, TAGS, SEED)
+        click.echo(f"Generated {size} projects in {time.perf_counter() - started:.1f}s", err=True)
+
+        data = Dataset(size, counts, np.random.default_rng(SEED))
+        results[str(size)] = {endpoint.name: measure(endpoint, data,
+            max(1, int(requests * endpoint.share))) for endpoint in ENDPOINTS}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Returns a list of descriptions of the metrics of results worse
+    than in baseline by more than threshold (a fraction) """
+    regressions = []
+    for size, endpoints in results.items():
+        for name, metrics in endpoints.items():
+            expected = baseline.get(size, {}).get(name)
+            if not expected:
+                continue
+            for metric, slack in CHECKED_METRICS.items():
+                if metric not in expected:
+                    continue
+                if slack is None:
+                    limit = expected[metric] * (1 + threshold)
+                else:
+                    limit = expected[metric] + slack
+                if metrics[metric] > limit:
+                    regressions.append(f"{size} projects, {name}: {metric} "
+                        f"{metrics[metric]:.2f} > {expected[metric]:.2f}")
+    return regressions
+
+
+def report(results):
+    """ Formats results as a table """
+    columns = [f"p{percentile}_ms" for percentile in PERCENTILES] + ['queries', 'alloc_kib']
+    lines = [f"{'projects':>9} {'endpoint':<24}" + ''.join(f"{column:>11}" for column in columns)]
+    for size, endpoints in results.items():
+        for name, metrics in endpoints.items():
+            lines.append(f"{size:>9} {name:<24}" + ''.join(f"{metrics[column]:>11.2f}"
+                for column in columns))
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--database-url', help="Database to benchmark against. Every table in it is "
+    "dropped. A temporary SQLite file by default.")
+@click.option('--sizes', default='1000,10000,100000', show_default=True,
+    help="Comma separated numbers of projects to generate.")
+@click.option('--requests', type=int, default=100, show_default=True,
+    help="Measured requests per endpoint.")
+@click.option('--baseline', type=click.Path(dir_okay=False), default=DEFAULT_BASELINE,
+    show_default=True, help="Baseline results file.")
+@click.option('--threshold', type=float, default=0.25, show_default=True,
+    help="Allowed slowdown or allocation growth over the baseline, as a fraction.")
+@click.option('--update-baseline', is_flag=True, help="Store the results as the baseline.")
+def main(database_url, sizes, requests, baseline, threshold, update_baseline):
+    """ Benchmarks the main endpoints and compares them with a baseline """
+
+    if not database_url:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+    # Refresh recommendations on the request thread, whose queries are the
+    # only ones measure() can attribute to a request
+    app.config['RECOMMENDATIONS_IN_BACKGROUND'] = False
+    recommendation_queue.init_app(app)
+
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        results = run([int(size) for size in sizes.split(',')], requests)
+
+    click.echo(f"{dialect}, {requests} requests per endpoint")
+    click.echo(report(results))
+
+    stored = {}
+    if os.path.exists(baseline):
+        with open(baseline) as file:
+            stored = json.load(file)
+
+    if update_baseline:
+        stored.setdefault(dialect, {}).update(results)
+        with open(baseline, 'w') as file:
+            json.dump(stored, file, indent=2, sort_keys=True)
+        click.echo(f"Baseline written to {baseline}")
+        return
+
+    if dialect not in stored:
+        click.echo(f"No {dialect} baseline in {baseline}, run with --update-baseline to store one")
+        return
+
+    regressions = compare(results, stored[dialect], threshold)
+    for regression in regressions:
+        click.echo(f"Regression: {regression}", err=True)
+    if regressions:
+        sys.exit(1)
+    click.echo(f"No regressions over {threshold:.0%} against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+""" Caches for the requests of a worker. RegionCache, TTLCache and
+VersionedCatalogue live in the worker process; PersistentCache adds an
+on-disk SQLite tier shared by every worker on the host. """
+
+from collections import OrderedDict, namedtuple
+from threading import Lock, local
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+CatalogueSnapshot = namedtuple('CatalogueSnapshot', ['version', 'items', 'body', 'etag'])
+
+
+class RegionCache:
+    """ LRU cache of values that depend on the projects within a lat/long
+    region, bounded by the total size of its values in bytes.
+
+    Entries are dropped when a project inside their region changes
+    (invalidate_point), and expire after max_age seconds so that writes
+    made by other worker processes show up eventually. """
+
+    def __init__(self, max_bytes, max_age):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.size = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def begin(self):
+        """ Returns a token to pass to put() for a value about to be
+        computed, so values computed while the region was being changed
+        are not stored """
+        return self.generation
+
+    def get(self, key):
+        """ Returns the value stored for key, or None if it is missing
+        or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[3] > self.max_age:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, bounds, value, nbytes, token):
+        """ Stores value for the (north, south, east, west) bounds under
+        key, evicting the least recently used entries to stay within
+        max_bytes. Skipped if anything was invalidated since token """
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if token != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (bounds, value, nbytes, time.monotonic())
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_point(self, lat, long):
+        """ Drops every entry whose region contains the coordinate """
+        with self._lock:
+            self.generation += 1
+            stale = [key for key, (bounds, value, nbytes, created) in self._entries.items()
+                if bounds[1] <= lat <= bounds[0] and bounds[3] <= long <= bounds[2]]
+            for key in stale:
+                self._remove(key)
+
+    def clear(self):
+        """ Drops every entry """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        """ Drops one entry, the lock must be held """
+        bounds, value, nbytes, created = self._entries.pop(key)
+        self.size -= nbytes
+
+
+class TTLCache:
+    """ LRU cache of at most max_entries values, each expiring max_age
+    seconds after it was stored """
+
+    def __init__(self, max_entries, max_age):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Returns the value stored for key, or None if it is missing
+        or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.max_age:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        """ Stores value under key, evicting the least recently used
+        entries beyond max_entries """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """ Drops the value stored for key """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """ Drops every entry """
+        with self._lock:
+            self._entries.clear()
+
+
+class VersionedCatalogue:
+    """ Snapshot of a small, rarely changing list together with its
+    serialized JSON body and an ETag derived from that body.
+
+    The list is loaded by load() on first use and reloaded whenever
+    version() returns a different value, or after max_age seconds so
+    that changes made by other worker processes show up eventually. The
+    ETag only depends on the contents, so every worker hands out the
+    same one for the same list. """
+
+    def __init__(self, load, version, max_age):
+        self.load = load
+        self.version = version
+        self.max_age = max_age
+        self._snapshot = None
+        self._built = 0
+        self._lock = Lock()
+
+    def get(self):
+        """ Returns the current CatalogueSnapshot, reloading it if the
+        version changed or it is too old """
+        snapshot = self._snapshot
+        version = self.version()
+        if (snapshot is not None and snapshot.version == version
+                and time.monotonic() - self._built <= self.max_age):
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if (snapshot is None or snapshot.version != version
+                    or time.monotonic() - self._built > self.max_age):
+                items = list(self.load())
+                body = json.dumps(items, separators=(',', ':'))
+                etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+                snapshot = CatalogueSnapshot(version, items, body, etag)
+                self._snapshot = snapshot
+                self._built = time.monotonic()
+            return snapshot
+
+
+class PersistentCache:
+    """ Two tier cache of string values: an in-memory LRU of at most
+    max_entries in front of a SQLite file at path, which survives restarts
+    and is shared by every worker process on the host. Values expire ttl
+    seconds after they were stored, and are kept on disk for max_stale
+    more seconds in case a stale value is better than none.
+
+    Each thread opens its own connection to the file on first use. """
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, max_entries, ttl, max_stale=0):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._local = local()
+        self._puts = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, stale=False):
+        """ Returns the value stored for key, or None if it is missing
+        or expired. With stale set, values expired less than max_stale
+        seconds ago are returned too """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                del self._entries[key]
+
+        row = self._connection().execute(
+            "SELECT value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            return row[0] if stale and row[1] + self.max_stale > now else None
+        self._remember(key, row[0], row[1])
+        return row[0]
+
+    def put(self, key, value):
+        """ Stores value under key in both tiers """
+        expires = time.time() + self.ttl
+        self._remember(key, value, expires)
+
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, expires))
+            self._puts += 1
+            if self._puts % self.PURGE_EVERY == 0:
+                connection.execute("DELETE FROM entries WHERE expires <= ?",
+                    (time.time() - self.max_stale,))
+
+    def clear(self):
+        """ Drops every entry from both tiers """
+        with self._lock:
+            self._entries.clear()
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM entries")
+
+    def _remember(self, key, value, expires):
+        """ Stores an entry in the in-memory tier """
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _connection(self):
+        """ Returns this thread's connection to the SQLite file, creating
+        the file and its table if needed """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)""")
+            self._local.connection = connection
+        return connection
@@ -0,0 +1,306 @@
+""" Helpers for geocoding addresses with the Google Geocoding API. """
+
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from threading import Event, Lock
+import json
+import re
+import time
+import unicodedata
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+CACHEABLE_STATUSES = frozenset(['OK', 'ZERO_RESULTS'])
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+SEPARATOR_PATTERN = re.compile(r"[\s,;]+")
+
+
+def normalize_address(address):
+    """ Returns the cache key of an address, ignoring case, Unicode
+    compatibility forms, and the spacing and commas between its parts """
+    address = unicodedata.normalize('NFKC', address).casefold()
+    return SEPARATOR_PATTERN.sub(' ', address).strip()
+
+
+class Gazetteer:
+    """ Offline geocoder answering from a list of place names, such as
+    cities and postal codes, loaded from a file.
+
+    The normalized names are kept in a sorted array searched with bisect,
+    with the display names and a float array of coordinates in the same
+    order. When several places share a normalized name, the first one in
+    the file wins, so files should list the most important places
+    first. """
+
+    def __init__(self, places):
+        rows = {}
+        for name, lat, long in places:
+            rows.setdefault(normalize_address(name), (name, lat, long))
+        self.keys = sorted(rows)
+        self.names = [rows[key][0] for key in self.keys]
+        self.coordinates = np.array([rows[key][1:] for key in self.keys],
+            dtype=float).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def load(cls, path):
+        """ Loads a gazetteer from a UTF-8 file of tab-separated name,
+        latitude and longitude lines. Blank lines and lines starting
+        with # are skipped """
+        places = []
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                name, lat, long = line.rstrip('\n').split('\t')[:3]
+                places.append((name.strip(), float(lat), float(long)))
+        return cls(places)
+
+    def geocode(self, key):
+        """ Returns a Geocoding API shaped answer for a normalized
+        address, or None if it is not in the gazetteer """
+        index = bisect_left(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            return None
+
+        name = self.names[index]
+        lat, long = self.coordinates[index].tolist()
+        return {'status': 'OK', 'results': [{
+            'formatted_address': name,
+            'address_components': [{'long_name': name, 'short_name': name, 'types': ['locality']}],
+            'geometry': {'location': {'lat': lat, 'lng': long}, 'location_type': 'APPROXIMATE'},
+            'types': ['locality'],
+        }]}
+
+
+class GeocodingError(Exception):
+    """ Raised when the geocoding service could not be reached or did
+    not answer in time """
+
+
+class GeocodingThrottled(GeocodingError):
+    """ Raised when the geocoding quota is used up and no stale answer is
+    cached. retry_after is the number of seconds until a call would be
+    admitted """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Geocoding quota exhausted, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """ Holds up to capacity tokens, refilled at rate tokens per second """
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        """ Adds the tokens earned since the last refill """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self):
+        """ Returns the seconds until a whole token is available """
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else float('inf')
+
+
+class QuotaGovernor:
+    """ Admits upstream calls within a token bucket shared by everyone,
+    refilled at rate calls per second up to burst, and a smaller bucket
+    per client (client_rate and client_burst), so that a single client
+    cannot use up the shared budget. The buckets of at most max_clients
+    recently seen clients are kept.
+
+    The buckets live in this worker process, so the quota of the whole
+    service is rate times the number of workers. """
+
+    def __init__(self, rate, burst, client_rate, client_burst, max_clients=10000,
+            clock=time.monotonic):
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_clients = max_clients
+        self.clock = clock
+        self._bucket = TokenBucket(rate, burst, clock())
+        self._clients = OrderedDict()
+        self._lock = Lock()
+
+    def admit(self, client_id, shared=True):
+        """ Takes a token for one call by client_id from its bucket, and
+        from the shared bucket unless shared is False (for lookups joining
+        a call which was already admitted). Returns 0 if the call is
+        admitted, or else the seconds to wait before it would be """
+        with self._lock:
+            now = self.clock()
+            client = self._clients.pop(client_id, None)
+            if client is None:
+                client = TokenBucket(self.client_rate, self.client_burst, now)
+            self._clients[client_id] = client
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+
+            client.refill(now)
+            buckets = [self._bucket, client] if shared else [client]
+            if shared:
+                self._bucket.refill(now)
+            if any(bucket.tokens < 1 for bucket in buckets):
+                return max(bucket.wait() for bucket in buckets)
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return 0
+
+
+class _Flight:
+    """ One upstream lookup that concurrent callers wait on """
+
+    def __init__(self):
+        self.done = Event()
+        self.body = None
+        self.error = None
+
+
+class GeocodingClient:
+    """ Client for the Geocoding API, answering repeated addresses from
+    cache (a cache.PersistentCache, keyed on the normalized address).
+
+    Upstream calls share a pool of at most pool_size keep-alive
+    connections, are bounded by the connect and read timeouts in seconds,
+    and are retried up to retries times with exponential backoff on
+    connection errors and 429/5xx answers. Concurrent lookups of the same
+    address wait for a single upstream call (single-flight), and are
+    handed its answer or its exception.
+
+    When a governor (a QuotaGovernor) is given, upstream calls are only
+    made within its quota. Every lookup which is not answered locally or
+    from cache is charged to its own client, while only the one making
+    the upstream call is charged to the shared budget. Throttled or failed lookups are answered with
+    a stale cached answer when there is one.
+
+    When a local geocoder is given, such as a Gazetteer, it is asked
+    first and the service is only called for the addresses it does not
+    know. Any object whose geocode(key) method returns an answer dict or
+    None for a normalized address will do.
+
+    counters() reports how many lookups were answered locally, from
+    cache, called upstream, coalesced with another lookup, throttled,
+    answered stale and failed. """
+
+    def __init__(self, url, api_key, cache, connect_timeout=3.05, read_timeout=10,
+            retries=2, backoff=0.3, pool_size=10, governor=None, local=None):
+        self.url = url
+        self.api_key = api_key
+        self.cache = cache
+        self.governor = governor
+        self.local = local
+        self.timeout = (connect_timeout, read_timeout)
+        self._flights = {}
+        self._counters = Counter()
+        self._lock = Lock()
+
+        retry = Retry(total=retries, backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+            max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def counters(self):
+        """ Returns a dict of the lookup counters """
+        with self._lock:
+            return {name: self._counters[name] for name in
+                ['local', 'cached', 'called', 'coalesced', 'throttled', 'stale', 'failed']}
+
+    def lookup(self, address, client_id=None):
+        """ Returns the JSON body of the geocoding answer for an address,
+        raising GeocodingError if the service failed, or
+        GeocodingThrottled if client_id is over quota """
+        key = normalize_address(address)
+        if self.local is not None:
+            answer = self.local.geocode(key)
+            if answer is not None:
+                self._count('local')
+                return json.dumps(answer)
+
+        body = self.cache.get(key)
+        if body is not None:
+            self._count('cached')
+            return body
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            retry_after = self.governor.admit(client_id, shared=leader) if self.governor else 0
+            if retry_after:
+                self._counters['throttled'] += 1
+            elif leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self._counters['coalesced'] += 1
+
+        if retry_after:
+            return self._stale(key, GeocodingThrottled(retry_after))
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.body
+
+        try:
+            flight.body = self._call(key, address)
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.body
+
+    def _call(self, key, address):
+        """ Calls the geocoding service, falling back to a stale answer """
+        self._count('called')
+        try:
+            return self._fetch(key, address)
+        except GeocodingError as error:
+            self._count('failed')
+            return self._stale(key, error)
+
+    def _stale(self, key, error):
+        """ Returns the stale cached answer for key, or raises error if
+        there is none """
+        body = self.cache.get(key, stale=True)
+        if body is None:
+            raise error
+        self._count('stale')
+        return body
+
+    def _fetch(self, key, address):
+        """ Calls the geocoding service and caches successful answers """
+        try:
+            resp = self.session.get(self.url,
+                params={"key": self.api_key, "address": address},
+                timeout=self.timeout)
+            json_data = resp.json()
+        except (requests.RequestException, ValueError) as error:
+            raise GeocodingError(f"Geocoding failed for {address!r}: {error}") from error
+
+        body = json.dumps(json_data)
+        if json_data.get('status') in CACHEABLE_STATUSES:
+            self.cache.put(key, body)
+        return body
+
+    def _count(self, name):
+        """ Increments one of the counters """
+        with self._lock:
+            self._counters[name] += 1
@@ -0,0 +1,198 @@
+""" Bulk import of projects from CSV or NDJSON files.
+
+Rows are streamed through a pipeline of generators: parsed one at a time,
+validated like the project form, and inserted in chunks of chunk_size rows
+with multi-row INSERT statements and one commit per chunk, so memory stays
+bounded however large the file is. Rejected rows are handed to on_reject
+with their line number and errors instead of stopping the import.
+
+The inserts bypass the ORM, so the project listeners are passed the
+ProjectChange records of every committed chunk directly. """
+
+import csv
+import itertools
+import json
+import time
+
+from werkzeug.datastructures import MultiDict
+
+from forms import ProjectForm
+from models import (db, insert_ignoring_conflicts, insert_rows, notify_project_listeners,
+    Project, Project_Tag, ProjectChange, Tag, User)
+from spatial import cell_key
+
+FORM_FIELDS = ['name', 'description', 'contact_info_type', 'contact_info', 'lat', 'long',
+    'inquiry_deadline', 'work_start', 'work_end', 'pic_url1', 'pic_url2']
+TAG_NAME_LENGTH = Tag.__table__.c.name.type.length
+
+
+def read_rows(lines, format):
+    """ Yields the (line number, row) of each record of a csv or ndjson
+    stream of text lines. NDJSON lines that are not valid JSON are
+    yielded as their text, to be rejected """
+    if format == 'csv':
+        yield from enumerate(csv.DictReader(lines), start=2)
+        return
+
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, line
+
+
+def _text(value):
+    """ Returns a row value as form text """
+    return '' if value is None else str(value)
+
+
+def _tag_names(value):
+    """ Returns the tag names of a row, given as a list or a pipe
+    separated string """
+    if isinstance(value, list):
+        names = [_text(name).strip() for name in value]
+    else:
+        names = _text(value).split('|')
+    return list(dict.fromkeys(name.strip() for name in names if name.strip()))
+
+
+def validate_row(row, user_id, owners_from_rows=True):
+    """ Validates one row like the project form does. The project is
+    owned by user_id, or by the row's own user_id if owners_from_rows is
+    set. Returns a dict of the project column values and tag names, or
+    None, and a dict of errors by field """
+    if not isinstance(row, dict):
+        return None, {'row': ['Not a JSON object.']}
+
+    form = ProjectForm(formdata=MultiDict({field: _text(row.get(field)) for field in FORM_FIELDS}),
+        meta={'csrf': False})
+    form.validate()
+    errors = {field: list(messages) for field, messages in form.errors.items()}
+
+    coordinates = {}
+    for field, limit in [('lat', 90), ('long', 180)]:
+        try:
+            coordinates[field] = float(row.get(field))
+            if not -limit <= coordinates[field] <= limit:
+                raise ValueError
+        except (TypeError, ValueError):
+            errors.setdefault(field, []).append(f"Must be a number between -{limit} and {limit}.")
+
+    tags = _tag_names(row.get('tags'))
+    if any(len(name) > TAG_NAME_LENGTH for name in tags):
+        errors['tags'] = [f"Tag names must be at most {TAG_NAME_LENGTH} characters long."]
+
+    try:
+        owner = int((owners_from_rows and row.get('user_id')) or user_id)
+    except (TypeError, ValueError):
+        errors['user_id'] = ["Must be a user id."]
+
+    if errors:
+        return None, errors
+
+    values = {field: form[field].data or None for field in FORM_FIELDS}
+    values.update(coordinates, user_id=owner, tags=tags)
+    return values, {}
+
+
+def _allocate_ids(count):
+    """ Reserves count project ids from the Postgres sequence """
+    return [id for (id,) in db.session.execute(
+        "SELECT nextval(pg_get_serial_sequence('projects', 'id')) FROM generate_series(1, :count)",
+        {'count': count})]
+
+
+def insert_chunk(rows):
+    """ Inserts a chunk of validated rows with their tags, in one
+    transaction. Returns the column values of the projects inserted,
+    with their ids """
+    names = sorted({name for row in rows for name in row['tags']})
+    insert_rows(insert_ignoring_conflicts(Tag.__table__), [{'name': name} for name in names])
+
+    projects = [{field: value for field, value in row.items() if field != 'tags'}
+        for row in rows]
+    for project in projects:
+        project['cell'] = cell_key(project['lat'], project['long'])
+
+    table = Project.__table__
+    if db.session.get_bind().dialect.name == 'postgresql':
+        for project, id in zip(projects, _allocate_ids(len(projects))):
+            project['id'] = id
+        insert_rows(table.insert(), projects)
+    else:
+        # Without the Postgres sequence the ids are only known one row at a time
+        for project in projects:
+            project['id'] = db.session.execute(table.insert(), project).inserted_primary_key[0]
+
+    insert_rows(Project_Tag.__table__.insert(), [{'project_id': project['id'], 'tag_name': name}
+        for project, row in zip(projects, rows) for name in row['tags']])
+    db.session.commit()
+    return projects
+
+
+def import_projects(lines, format, user_id=None, chunk_size=500, on_reject=None,
+        on_progress=None, owners_from_rows=True, on_import=None):
+    """ Imports the projects of a csv or ndjson stream of text lines,
+    owned by user_id unless a row names its own user_id and
+    owners_from_rows is set. on_reject is
+    called with a dict of the line number, errors and row of every
+    rejected row, on_import with the list of the column values (id
+    included) of the projects of every committed chunk, and on_progress
+    with the report after every chunk.
+    Returns a report dict of the rows read, imported and rejected, the
+    seconds taken and the rows per second """
+    report = {'rows': 0, 'imported': 0, 'rejected': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+    started = time.monotonic()
+
+    def reject(number, errors, row):
+        report['rejected'] += 1
+        if on_reject:
+            on_reject({'line': number, 'errors': errors, 'row': row})
+
+    def validated():
+        for number, row in read_rows(lines, format):
+            report['rows'] += 1
+            values, errors = validate_row(row, user_id, owners_from_rows)
+            if errors:
+                reject(number, errors, row)
+            else:
+                yield number, row, values
+
+    rows = validated()
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            owners = {values['user_id'] for number, row, values in chunk}
+            known = {id for (id,) in db.session.query(User.id).filter(User.id.in_(owners))}
+            valid = []
+            for number, row, values in chunk:
+                if values['user_id'] in known:
+                    valid.append(values)
+                else:
+                    reject(number, {'user_id': ["No such user."]}, row)
+
+            if valid:
+                projects = insert_chunk(valid)
+                report['imported'] += len(projects)
+                Tag.bump_catalogue_version()
+                notify_project_listeners([ProjectChange(project['id'],
+                    {(float(project['lat']), float(project['long']))}, False, row['tags'],
+                    (project['name'], project['description']))
+                    for project, row in zip(projects, valid)])
+                if on_import:
+                    on_import(projects)
+            report['seconds'] = time.monotonic() - started
+            report['rows_per_second'] = report['rows'] / report['seconds'] if report['seconds'] else 0.0
+            if on_progress:
+                on_progress(dict(report))
+    finally:
+        db.session.rollback()
+
+    report['seconds'] = time.monotonic() - started
+    report['rows_per_second'] = report['rows'] / report['seconds'] if report['seconds'] else 0.0
+    return report
@@ -0,0 +1,330 @@
+""" In-memory indexes over the projects, kept up to date from committed
+project changes (see models.listen_for_project_changes). """
+
+from bisect import bisect_left
+from collections import Counter
+from threading import Lock
+import heapq
+import math
+import re
+import time
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset("""a an and are as at be but by for from has have i if in
+    into is it its me my of on or so that the their them they this to was we
+    with you your""".split())
+
+
+def tokenize(text):
+    """ Splits text into lowercase words, leaving out stop words """
+    return [word for word in WORD_PATTERN.findall(text.lower())
+        if word not in STOP_WORDS]
+
+
+class LoadedIndex:
+    """ Base of the indexes built from the rows returned by load() and then
+    kept up to date from committed project changes by apply().
+
+    Builds run outside the lock, so readers keep using the current data
+    while it is rebuilt, and are swapped in with the changes applied in
+    the meantime replayed on them. Only the first build, or one after a
+    wholesale change, makes readers wait. When max_age is set the index is
+    also rebuilt that many seconds after the last build, so that writes
+    made by other worker processes show up.
+
+    Subclasses implement _build(rows), returning the data, and
+    _update(data, change) for one ProjectChange. """
+
+    def __init__(self, load, max_age=None):
+        self.load = load
+        self.max_age = max_age
+        self._data = None
+        self._built = 0
+        self._pending = None
+        self._lock = Lock()
+        self._build_lock = Lock()
+
+    def apply(self, changes):
+        """ Updates the index from a list of ProjectChange records, or
+        drops the index when changes is None """
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(changes)
+            if changes is None:
+                self._data = None
+            elif self._data is not None:
+                for change in changes:
+                    self._update(self._data, change)
+
+    def _read(self, read):
+        """ Returns read(data) run under the lock, building the data first
+        if it is missing or too old """
+        while True:
+            self._refresh()
+            with self._lock:
+                if self._data is not None:
+                    return read(self._data)
+
+    def _refresh(self):
+        """ Builds the data if it is missing, waiting for a build already
+        running, or rebuilds it if it is older than max_age unless another
+        thread is already doing so """
+        with self._lock:
+            missing = self._data is None
+            stale = not missing and self.max_age is not None and (
+                time.monotonic() - self._built > self.max_age)
+        if not missing and not stale:
+            return
+        if not self._build_lock.acquire(blocking=missing):
+            return
+        try:
+            with self._lock:
+                if missing and self._data is not None:
+                    return
+                self._pending = []
+            started = time.monotonic()
+            data = None
+            try:
+                data = self._build(self.load())
+            finally:
+                with self._lock:
+                    pending, self._pending = self._pending, None
+                    if data is not None and None not in pending:
+                        for changes in pending:
+                            for change in changes:
+                                self._update(data, change)
+                        self._data = data
+                        self._built = started
+        finally:
+            self._build_lock.release()
+
+
+class _TagData:
+    """ The posting sets of a TagIndex """
+
+    __slots__ = ('postings', 'project_tags')
+
+    def __init__(self):
+        self.postings = {}
+        self.project_tags = {}
+
+    def set_tags(self, project_id, tags):
+        """ Replaces the tags of one project """
+        old = self.project_tags.pop(project_id, set())
+        new = set(tags)
+        for tag in old - new:
+            self.postings[tag].discard(project_id)
+        for tag in new - old:
+            self.postings.setdefault(tag, set()).add(project_id)
+        if new:
+            self.project_tags[project_id] = new
+
+
+class TagIndex(LoadedIndex):
+    """ Posting lists of the project ids carrying each tag, built from the
+    (project_id, tag_name) pairs returned by load() (see LoadedIndex) """
+
+    def carrying(self, project_ids, tags, match_all=False):
+        """ Returns a list of whether each of project_ids carries any of
+        the tags, or all of them if match_all is set """
+        test = all if match_all else any
+        def read(data):
+            postings = [data.postings.get(tag, ()) for tag in tags]
+            return [test(project_id in posting for posting in postings)
+                for project_id in project_ids]
+        return self._read(read)
+
+    def usage(self, tags):
+        """ Returns a dict of the number of projects carrying each tag """
+        return self._read(lambda data: {tag: len(data.postings.get(tag, ())) for tag in tags})
+
+    def _build(self, rows):
+        data = _TagData()
+        for project_id, tag_name in rows:
+            data.postings.setdefault(tag_name, set()).add(project_id)
+            data.project_tags.setdefault(project_id, set()).add(tag_name)
+        return data
+
+    def _update(self, data, change):
+        if change.deleted:
+            data.set_tags(change.id, ())
+        elif change.tags is not None:
+            data.set_tags(change.id, change.tags)
+
+
+class _TextData:
+    """ The postings and document lengths of a TextIndex """
+
+    __slots__ = ('postings', 'lengths', 'words', 'total_length')
+
+    def __init__(self):
+        self.postings = {}
+        self.lengths = {}
+        self.words = {}
+        self.total_length = 0
+
+    def add(self, project_id, frequencies):
+        """ Indexes one project from a Counter of its words """
+        for word, frequency in frequencies.items():
+            self.postings.setdefault(word, {})[project_id] = frequency
+        length = sum(frequencies.values())
+        self.lengths[project_id] = length
+        self.words[project_id] = list(frequencies)
+        self.total_length += length
+
+    def remove(self, project_id):
+        """ Removes one project from the index """
+        length = self.lengths.pop(project_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for word in self.words.pop(project_id):
+            postings = self.postings[word]
+            del postings[project_id]
+            if not postings:
+                del self.postings[word]
+
+
+class TextIndex(LoadedIndex):
+    """ Inverted index of the words in project names and descriptions,
+    ranking matches with BM25. Words in the name count name_weight times.
+    It is built from the (id, name, description) rows returned by load()
+    (see LoadedIndex) """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, load, max_age=None, name_weight=3):
+        super().__init__(load, max_age)
+        self.name_weight = name_weight
+
+    def search(self, query):
+        """ Returns a dict of the ids of the projects matching any word of
+        the query to their BM25 score """
+        words = set(tokenize(query))
+        return self._read(lambda data: self._score(data, words))
+
+    def _score(self, data, words):
+        """ Scores the projects matching any of words """
+        count = len(data.lengths)
+        if not words or not count:
+            return {}
+
+        average_length = data.total_length / count or 1
+        scores = {}
+        for word in words:
+            postings = data.postings.get(word)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for project_id, frequency in postings.items():
+                norm = self.K1 * (1 - self.B + self.B * data.lengths[project_id] / average_length)
+                score = idf * frequency * (self.K1 + 1) / (frequency + norm)
+                scores[project_id] = scores.get(project_id, 0) + score
+        return scores
+
+    def _frequencies(self, name, description):
+        """ Counts the words of a project, those of its name name_weight
+        times """
+        frequencies = Counter(tokenize(description or ''))
+        for word in tokenize(name or ''):
+            frequencies[word] += self.name_weight
+        return frequencies
+
+    def _build(self, rows):
+        data = _TextData()
+        for project_id, name, description in rows:
+            data.add(project_id, self._frequencies(name, description))
+        return data
+
+    def _update(self, data, change):
+        if change.deleted:
+            data.remove(change.id)
+        elif change.text is not None:
+            data.remove(change.id)
+            data.add(change.id, self._frequencies(*change.text))
+
+
+class _Completions:
+    """ The lookup tables of a TagCompleter for one catalogue snapshot """
+
+    __slots__ = ('snapshot', 'built', 'keys', 'names', 'counts', 'best')
+
+    def __init__(self, snapshot, counts, max_limit):
+        pairs = sorted((name.lower(), name) for name in snapshot.items)
+        self.snapshot = snapshot
+        self.built = time.monotonic()
+        self.keys = [key for key, name in pairs]
+        self.names = [name for key, name in pairs]
+        self.counts = counts
+
+        prefixes = {}
+        for key, name in pairs:
+            for length in range(TagCompleter.PREFIX_LENGTH + 1):
+                prefixes.setdefault(key[:length], []).append(name)
+        rank = lambda name: (-counts[name], name)
+        self.best = {prefix: heapq.nsmallest(max_limit, names, key=rank)
+            for prefix, names in prefixes.items()}
+
+
+class TagCompleter:
+    """ Completes tag name prefixes from the tag catalogue (a
+    cache.VersionedCatalogue), ranking the matches by usage.
+
+    The best max_limit matches of every prefix of up to PREFIX_LENGTH
+    characters are computed when the catalogue hands out a new snapshot,
+    or when the counts are over max_age seconds old, from the counts
+    usage(names) returns (the number of projects carrying each tag).
+    Longer prefixes, which match few names, are searched with bisect in
+    a sorted array of the lowercased names and ranked from the same
+    counts. The tables are built outside the lock, by one thread at a
+    time, while the others keep using the previous ones. """
+
+    PREFIX_LENGTH = 3
+
+    def __init__(self, catalogue, usage, max_limit=50, max_age=30):
+        self.catalogue = catalogue
+        self.usage = usage
+        self.max_limit = max_limit
+        self.max_age = max_age
+        self._tables = None
+        self._lock = Lock()
+
+    def complete(self, prefix, limit):
+        """ Returns a list of (name, count) of at most limit (and at most
+        max_limit) tags whose name starts with prefix, ignoring case. An
+        exact match comes first, then the most used tags """
+        prefix = prefix.strip().lower()
+        limit = min(limit, self.max_limit)
+        tables = self._current()
+        counts = tables.counts
+        rank = lambda name: (-counts[name], name)
+
+        start = bisect_left(tables.keys, prefix)
+        if len(prefix) > self.PREFIX_LENGTH:
+            end = bisect_left(tables.keys, prefix + '\U0010ffff', start)
+            best = heapq.nsmallest(limit, tables.names[start:end],
+                key=lambda name: (name.lower() != prefix, -counts[name], name))
+        else:
+            end = bisect_left(tables.keys, prefix + '\x00', start)
+            exact = sorted(tables.names[start:end], key=rank)
+            best = exact + [name for name in tables.best.get(prefix, ())
+                if name.lower() != prefix]
+        return [(name, counts[name]) for name in best[:limit]]
+
+    def _current(self):
+        """ Returns the tables of the current catalogue snapshot, building
+        them if they are missing or too old """
+        snapshot = self.catalogue.get()
+        tables = self._tables
+        if tables is not None and tables.snapshot is snapshot and (
+                time.monotonic() - tables.built <= self.max_age):
+            return tables
+        if not self._lock.acquire(blocking=tables is None or tables.snapshot is not snapshot):
+            return tables
+        try:
+            if self._tables is tables:
+                self._tables = _Completions(snapshot, self.usage(snapshot.items), self.max_limit)
+            return self._tables
+        finally:
+            self._lock.release()
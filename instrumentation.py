@@ -0,0 +1,341 @@
+""" Per-request SQL query counting and timing, and the slow query log.
+
+Engine cursor events count and time every statement run while a request
+is being handled, and request hooks fold each request's totals into
+per-endpoint aggregates, exported in the Prometheus text format. The
+work per statement is two clock reads and a few additions, so it can
+stay on under load. Aggregates are kept per worker process.
+
+Statements slower than a threshold are written to a rotating log file
+with their parameters (passwords, emails and contact info left out),
+route and user, and the plan of the first one of each fingerprint. """
+
+from logging.handlers import RotatingFileHandler
+from threading import Lock
+import hashlib
+import logging
+import os
+import re
+import time
+
+from flask import g, has_app_context, has_request_context, request, session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+MAX_STATEMENT_LENGTH = 200
+# Columns whose values are left out of the slow query log
+SENSITIVE_COLUMNS = frozenset(['password', 'email', 'contact_info'])
+REDACTED = '***'
+
+
+def _one_line(statement, limit=MAX_STATEMENT_LENGTH):
+    """ Collapses the whitespace of a statement and shortens it to limit
+    characters """
+    statement = ' '.join(statement.split())
+    return statement if len(statement) <= limit else statement[:limit - 3] + '...'
+
+
+def _label(value):
+    """ Escapes a Prometheus label value """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_metric(name, help, type, samples):
+    """ Returns the lines of a Prometheus text format metric, samples being
+    a list of (labels dict, value) """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    for labels, value in samples:
+        label_text = ','.join(f'{key}="{_label(str(label))}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value!r}" if label_text else f"{name} {value!r}")
+    return lines
+
+
+def _bind_column(name):
+    """ Returns the column a bind parameter name was made from, such as
+    email for email_1 or email_m0 """
+    return re.sub(r"(?:_m?\d+)+$", '', name)
+
+
+def redact(parameters, names=None):
+    """ Returns a copy of the parameters of a statement, or of each row of
+    an executemany, with the values bound to SENSITIVE_COLUMNS replaced.
+    Positional parameters are matched to their columns through names,
+    the bind names in order, and every string among them is replaced
+    when names is not known """
+    if isinstance(parameters, list):
+        return [redact(row, names) for row in parameters]
+    if isinstance(parameters, dict):
+        return {name: REDACTED if _bind_column(name) in SENSITIVE_COLUMNS else value
+            for name, value in parameters.items()}
+    if isinstance(parameters, tuple):
+        if names is None or len(names) != len(parameters):
+            return tuple(REDACTED if isinstance(value, str) else value for value in parameters)
+        return tuple(REDACTED if _bind_column(name) in SENSITIVE_COLUMNS else value
+            for name, value in zip(names, parameters))
+    return parameters
+
+
+def fingerprint(statement):
+    """ Returns a short hash of a statement which ignores its literals,
+    bind parameter names and the lengths of IN lists """
+    normalized = re.sub(r"%\(\w+\)s|\?|:\w+|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", '?',
+        ' '.join(statement.split()))
+    normalized = re.sub(r"\?(?:\s*,\s*\?)+", '?', normalized)
+    return hashlib.sha1(normalized.encode('UTF-8')).hexdigest()[:12]
+
+
+class SlowQueryLog:
+    """ Logs the statements which take threshold seconds or more, with
+    their parameters (see redact()), the route and logged in user of the request running
+    them, and for the first statement of each fingerprint its plan
+    (EXPLAIN on Postgres, EXPLAIN QUERY PLAN on SQLite), to a file
+    rotated at max_bytes. threshold None turns the log off. Plans are
+    captured for at most max_plans fingerprints per worker """
+
+    def __init__(self, path=None, threshold=None, max_bytes=10 * 1024 * 1024, backups=5,
+            max_plans=10000):
+        self.path = path
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_plans = max_plans
+        self.logger = logging.getLogger('slow_queries')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self._explained = set()
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """ Reads the settings from the app config and opens the log file
+        on the first slow statement """
+        self.path = app.config.get('SLOW_QUERY_LOG_PATH', self.path)
+        self.threshold = app.config.get('SLOW_QUERY_THRESHOLD', self.threshold)
+        self.max_bytes = app.config.get('SLOW_QUERY_LOG_BYTES', self.max_bytes)
+        self.backups = app.config.get('SLOW_QUERY_LOG_BACKUPS', self.backups)
+        if self.path:
+            self.use_file(self.path)
+
+    def use_file(self, path):
+        """ Writes the log to path from now on """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=self.max_bytes,
+            backupCount=self.backups, encoding='utf-8', delay=True)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        for old in list(self.logger.handlers):
+            self.logger.removeHandler(old)
+            old.close()
+        self.logger.addHandler(handler)
+        self.path = path
+
+    def is_slow(self, seconds):
+        return self.threshold is not None and seconds >= self.threshold
+
+    def record(self, conn, cursor, statement, parameters, executemany, seconds, context=None):
+        """ Logs a slow statement, with the values of sensitive columns
+        redacted, explaining it if it is the first of its fingerprint.
+        executemany statements are logged without a plan, and do not
+        count as explained """
+        key = fingerprint(statement)
+        route, user = '-', '-'
+        if has_request_context():
+            route = f"{request.method} {request.path} ({request.endpoint})"
+            user = session.get('CURR_USER_KEY', '-')
+
+        compiled = context.compiled if context is not None else None
+        names = getattr(compiled, 'positiontup', None)
+        lines = [f"{seconds * 1000:.1f} ms fingerprint={key} route={route} user={user}",
+            statement.strip(),
+            f"parameters: {_one_line(repr(redact(parameters, names)), 2000)}"]
+
+        with self._lock:
+            first = (not executemany and key not in self._explained
+                and len(self._explained) < self.max_plans)
+            if first:
+                self._explained.add(key)
+        if first:
+            plan, captured = self._explain(conn, cursor, statement, parameters)
+            if not captured:
+                with self._lock:
+                    self._explained.discard(key)
+            lines.append("plan:")
+            lines.extend(f"  {line}" for line in plan)
+        self.logger.info('\n'.join(lines))
+
+    def _explain(self, conn, cursor, statement, parameters):
+        """ Returns the plan of a statement as lines of text, run on a
+        fresh DBAPI cursor so it is neither counted nor logged, and
+        whether it was captured (or the statement has no plan) rather
+        than failed """
+        if not re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", statement, re.IGNORECASE):
+            return ["(not explainable)"], True
+        dialect = conn.dialect.name
+        raw = cursor.connection.cursor()
+        try:
+            if dialect == 'postgresql':
+                # A failed EXPLAIN would abort the request's transaction
+                raw.execute("SAVEPOINT slow_query_explain")
+                try:
+                    raw.execute("EXPLAIN " + statement, parameters)
+                    rows = raw.fetchall()
+                except Exception:
+                    raw.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                    raise
+                raw.execute("RELEASE SAVEPOINT slow_query_explain")
+                return [row[0] for row in rows], True
+            if dialect == 'sqlite':
+                raw.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+                return [row[-1] for row in raw.fetchall()], True
+            return [f"(no plans on {dialect})"], True
+        except Exception as error:
+            return [f"(EXPLAIN failed: {_one_line(str(error))})"], False
+        finally:
+            raw.close()
+
+
+class RequestStats:
+    """ The statements run by one request so far """
+
+    __slots__ = ('started', 'queries', 'seconds', 'slowest', 'slowest_seconds')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.seconds = 0.0
+        self.slowest = None
+        self.slowest_seconds = 0.0
+
+
+class EndpointStats:
+    """ The totals of every request an endpoint handled """
+
+    __slots__ = ('requests', 'seconds', 'queries', 'db_seconds', 'slowest_seconds')
+
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest_seconds = 0.0
+
+
+class QueryInstrumentation:
+    """ Counts and times the SQL statements of every request, per request
+    (see request_stats(), and the X-SQL-* and Server-Timing response
+    headers when SQL_STATS_HEADERS is set) and per endpoint (see
+    endpoints() and prometheus()). Slow statements are passed on to the
+    SlowQueryLog slow_log, if given, whether or not they ran in a
+    request """
+
+    def __init__(self, slow_log=None):
+        self.headers = False
+        self.slow_log = slow_log
+        self._endpoints = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """ Starts counting the statements of every engine during the
+        requests of app """
+        self.headers = app.config.get('SQL_STATS_HEADERS', self.headers)
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        event.listen(Engine, 'handle_error', self._failed_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._add_headers)
+        app.teardown_request(self._finish_request)
+
+    def request_stats(self):
+        """ Returns the RequestStats of the current request """
+        stats = g.get('sql_stats')
+        if stats is None:
+            stats = g.sql_stats = RequestStats()
+        return stats
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('sql_stats_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['sql_stats_started'].pop()
+        if self.slow_log is not None and self.slow_log.is_slow(seconds):
+            self.slow_log.record(conn, cursor, statement, parameters, executemany, seconds, context)
+        if not has_app_context():
+            return
+        stats = self.request_stats()
+        stats.queries += 1
+        stats.seconds += seconds
+        if seconds > stats.slowest_seconds:
+            stats.slowest = statement
+            stats.slowest_seconds = seconds
+
+    def _failed_execute(self, context):
+        started = context.connection.info.get('sql_stats_started') if context.connection else None
+        if started:
+            started.pop()
+
+    def _start_request(self):
+        g.sql_stats = RequestStats()
+
+    def _add_headers(self, response):
+        if self.headers:
+            stats = self.request_stats()
+            response.headers['X-SQL-Queries'] = str(stats.queries)
+            response.headers['X-SQL-Time'] = f"{stats.seconds * 1000:.2f}"
+            if stats.slowest:
+                response.headers['X-SQL-Slowest'] = (f"{stats.slowest_seconds * 1000:.2f} "
+                    f"{_one_line(stats.slowest)}")
+            response.headers.add('Server-Timing',
+                f'db;dur={stats.seconds * 1000:.2f};desc="{stats.queries} queries"')
+        return response
+
+    def _finish_request(self, error=None):
+        # A teardown rather than an after_request function, so that
+        # requests failing with an unhandled error are counted too
+        stats = self.request_stats()
+        seconds = time.perf_counter() - stats.started
+        with self._lock:
+            endpoint = self._endpoints.get(request.endpoint)
+            if endpoint is None:
+                endpoint = self._endpoints[request.endpoint] = EndpointStats()
+            endpoint.requests += 1
+            endpoint.seconds += seconds
+            endpoint.queries += stats.queries
+            endpoint.db_seconds += stats.seconds
+            endpoint.slowest_seconds = max(endpoint.slowest_seconds, stats.slowest_seconds)
+
+    def endpoints(self):
+        """ Returns a dict of endpoint names to copies of their
+        EndpointStats. Requests no route matched are under None """
+        with self._lock:
+            copies = {}
+            for name, stats in self._endpoints.items():
+                copy = copies[name] = EndpointStats()
+                for attr in EndpointStats.__slots__:
+                    setattr(copy, attr, getattr(stats, attr))
+            return copies
+
+    def reset(self):
+        """ Forgets the endpoint aggregates """
+        with self._lock:
+            self._endpoints.clear()
+
+    def prometheus(self):
+        """ Returns the endpoint aggregates as Prometheus text format
+        lines, labelled by endpoint only so the series stay the same. The
+        slowest statements themselves are in the X-SQL-Slowest header and
+        the slow query log """
+        endpoints = sorted(self.endpoints().items(), key=lambda item: item[0] or '')
+        labelled = [({'endpoint': name or 'unmatched'}, stats) for name, stats in endpoints]
+
+        lines = []
+        for name, help, type, attr in [
+                ('http_requests_total', "Requests handled.", 'counter', 'requests'),
+                ('http_request_seconds_total', "Time spent handling requests.", 'counter', 'seconds'),
+                ('sql_queries_total', "SQL statements run by requests.", 'counter', 'queries'),
+                ('sql_seconds_total', "Time spent running the SQL statements of requests.",
+                    'counter', 'db_seconds'),
+                ('sql_slowest_seconds', "Duration of the slowest SQL statement run by a request.",
+                    'gauge', 'slowest_seconds')]:
+            lines.extend(prometheus_metric(name, help, type,
+                [(labels, getattr(stats, attr)) for labels, stats in labelled]))
+        return lines
@@ -0,0 +1,392 @@
+""" Matchmaking of users seeking projects with projects seeking help.
+
+Every (user, project) pair is scored on how close the project is and how
+much its tags overlap the tags of the user's own projects. Scores are
+computed with NumPy for a batch of users against an array of candidate
+projects at once, and the best TOP_N projects for each user are stored in
+the recommendations table. Pairs further apart than MAX_DISTANCE_KM are
+never matched, so incremental refreshes only need nearby rows. """
+
+from threading import Condition, Thread
+import math
+import os
+
+import numpy as np
+
+from models import db, insert_rows, Project, Project_Tag, Recommendation, User
+from spatial import haversine_km, radius_boxes
+
+TOP_N = 20
+MAX_DISTANCE_KM = 100.0
+DISTANCE_SCALE_KM = 25.0
+DISTANCE_WEIGHT = 0.6
+TAG_WEIGHT = 0.4
+BATCH_CELLS = 20000000
+# Size of the grid squares new project positions are grouped by when
+# looking for the users near them
+NEAR_CELL_DEGREES = 0.5
+
+
+class ProjectMatrix:
+    """ Arrays describing candidate projects: ids, owners, positions, and
+    their tags in compressed sparse row form (the tag indices of project
+    i are indices[indptr[i]:indptr[i + 1]]) """
+
+    def __init__(self, rows, tags_by_project):
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.owners = np.array([row[1] for row in rows], dtype=np.int64)
+        self.lats = np.array([row[2] for row in rows], dtype=float)
+        self.longs = np.array([row[3] for row in rows], dtype=float)
+
+        self.vocabulary = {}
+        indices = []
+        indptr = [0]
+        for project_id in self.ids.tolist():
+            for name in tags_by_project.get(project_id, ()):
+                indices.append(self.vocabulary.setdefault(name, len(self.vocabulary)))
+            indptr.append(len(indices))
+        self.indices = np.array(indices, dtype=np.int64)
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.tag_counts = np.diff(self.indptr)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, boxes=None, project_ids=None):
+        """ Loads the projects whose owners are seeking help, limited to
+        the (north, south, east, west) boxes or project_ids if given """
+        base = db.session.query(Project.id, Project.user_id, Project.lat, Project.long
+            ).join(User, Project.user_id == User.id).filter(User.seeking_help == True)
+        if project_ids is not None:
+            queries = [base.filter(Project.id.in_(list(project_ids)))] if project_ids else []
+        elif boxes is not None:
+            queries = []
+            for box in boxes:
+                filters = Project.neighborhood_filters(*box)
+                if filters is not None:
+                    queries.append(base.filter(*filters))
+        else:
+            queries = [base]
+
+        rows = {}
+        for query in queries:
+            rows.update((row[0], row) for row in query)
+        rows = sorted(rows.values())
+        return cls(rows, _tags_by_project([row[0] for row in rows]))
+
+
+def _tags_by_project(project_ids=None):
+    """ Maps project ids to lists of their tag names """
+    query = db.session.query(Project_Tag.project_id, Project_Tag.tag_name)
+    if project_ids is not None:
+        if not project_ids:
+            return {}
+        query = query.filter(Project_Tag.project_id.in_(project_ids))
+
+    tags = {}
+    for project_id, tag_name in query:
+        tags.setdefault(project_id, []).append(tag_name)
+    return tags
+
+
+def _tags_by_owner(user_ids=None):
+    """ Maps user ids to the set of tag names on their own projects """
+    query = db.session.query(Project.user_id, Project_Tag.tag_name
+        ).join(Project_Tag, Project_Tag.project_id == Project.id)
+    if user_ids is not None:
+        if not user_ids:
+            return {}
+        query = query.filter(Project.user_id.in_(list(user_ids)))
+
+    tags = {}
+    for user_id, tag_name in query:
+        tags.setdefault(user_id, set()).add(tag_name)
+    return tags
+
+
+def _load_users(user_ids=None, box=None):
+    """ Loads (id, lat, long) of the users seeking projects, limited to
+    user_ids or a (north, south, east, west) box if given """
+    query = db.session.query(User.id, User.lat, User.long
+        ).filter(User.seeking_project == True)
+    if user_ids is not None:
+        if not user_ids:
+            return []
+        query = query.filter(User.id.in_(list(user_ids)))
+    if box is not None:
+        north, south, east, west = box
+        query = query.filter(User.lat < north, User.lat >= south,
+            User.long >= west, User.long < east)
+    return query.order_by(User.id).all()
+
+
+def score(users, user_tags, projects):
+    """ Scores a batch of users against the candidate projects.
+    users is a list of (id, lat, long) and user_tags maps user ids to
+    tag name sets. Returns a (users x projects) array in which pairs
+    that must not be matched (too far apart, or the user's own project)
+    are -inf """
+    user_ids = np.array([user[0] for user in users], dtype=np.int64)
+    lats = np.array([user[1] for user in users], dtype=float)
+    longs = np.array([user[2] for user in users], dtype=float)
+
+    distances = haversine_km(lats[:, None], longs[:, None],
+        projects.lats[None, :], projects.longs[None, :])
+    closeness = np.exp(-distances / DISTANCE_SCALE_KM)
+
+    masks = np.zeros((len(users), len(projects.vocabulary)), dtype=np.int32)
+    tag_counts = np.zeros(len(users), dtype=np.int64)
+    for row, user in enumerate(users):
+        names = user_tags.get(user[0], ())
+        tag_counts[row] = len(names)
+        for name in names:
+            column = projects.vocabulary.get(name)
+            if column is not None:
+                masks[row, column] = 1
+
+    hits = np.zeros((len(users), len(projects.indices) + 1), dtype=np.int32)
+    np.cumsum(masks[:, projects.indices], axis=1, out=hits[:, 1:])
+    shared = hits[:, projects.indptr[1:]] - hits[:, projects.indptr[:-1]]
+    union = tag_counts[:, None] + projects.tag_counts[None, :] - shared
+    affinity = np.divide(shared, union, out=np.zeros(shared.shape), where=union > 0)
+
+    scores = DISTANCE_WEIGHT * closeness + TAG_WEIGHT * affinity
+    scores[(distances > MAX_DISTANCE_KM) | (user_ids[:, None] == projects.owners[None, :])] = -np.inf
+    return scores
+
+
+def _best(users, scores, projects, top_n):
+    """ Picks the best top_n projects of each row of a score array,
+    returning recommendation row dicts """
+    count = min(top_n, len(projects))
+    if count == 0:
+        return []
+
+    best = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+    rows = []
+    for row, user in enumerate(users):
+        for column in best[row]:
+            if np.isfinite(scores[row, column]):
+                rows.append({'user_id': user[0],
+                    'project_id': int(projects.ids[column]),
+                    'score': float(scores[row, column])})
+    return rows
+
+
+def _batches(users, projects):
+    """ Splits users into batches small enough for the score arrays """
+    size = max(1, BATCH_CELLS // max(len(projects), len(projects.indices), 1))
+    for start in range(0, len(users), size):
+        yield users[start:start + size]
+
+
+def _replace(user_ids, rows):
+    """ Replaces the stored recommendations of the users with rows """
+    if user_ids:
+        Recommendation.query.filter(Recommendation.user_id.in_(list(user_ids))
+            ).delete(synchronize_session=False)
+    insert_rows(Recommendation.__table__.insert(), rows)
+
+
+def rebuild_all(top_n=TOP_N):
+    """ Recomputes the recommendations of every user seeking projects.
+    Each batch of users has its recommendations replaced in its own
+    transaction, so users keep their old ones until the new ones are
+    stored. Returns the number of users """
+    projects = ProjectMatrix.load()
+    users = _load_users()
+    user_tags = _tags_by_owner()
+
+    for batch in _batches(users, projects):
+        _replace([user[0] for user in batch],
+            _best(batch, score(batch, user_tags, projects), projects, top_n))
+        db.session.commit()
+    Recommendation.query.filter(Recommendation.user_id.in_(
+        db.session.query(User.id).filter(User.seeking_project == False))
+        ).delete(synchronize_session=False)
+    db.session.commit()
+    return len(users)
+
+
+def refresh_users(user_ids, top_n=TOP_N):
+    """ Recomputes the recommendations of the given users only, scoring
+    them against the projects within MAX_DISTANCE_KM of each of them """
+    user_ids = set(user_ids)
+    users = _load_users(user_ids)
+    rows = []
+    if users:
+        boxes = [box for user in users
+            for box in radius_boxes(user[1], user[2], MAX_DISTANCE_KM)]
+        projects = ProjectMatrix.load(boxes=boxes)
+        user_tags = _tags_by_owner([user[0] for user in users])
+        for batch in _batches(users, projects):
+            rows.extend(_best(batch, score(batch, user_tags, projects), projects, top_n))
+
+    _replace(user_ids, rows)
+    db.session.commit()
+
+
+def refresh_near(positions, user_ids=(), top_n=TOP_N):
+    """ Recomputes the recommendations of the given users and of every
+    user seeking projects within MAX_DISTANCE_KM of any of the (lat, long)
+    positions, such as those of imported projects. Positions are grouped
+    in NEAR_CELL_DEGREES squares so that the users near many projects are
+    found with a few queries """
+    recomputed = set(user_ids)
+    half = NEAR_CELL_DEGREES / 2
+    radius = MAX_DISTANCE_KM + haversine_km(0.0, 0.0, half, half)
+    centres = {((math.floor(lat / NEAR_CELL_DEGREES) + 0.5) * NEAR_CELL_DEGREES,
+        (math.floor(long / NEAR_CELL_DEGREES) + 0.5) * NEAR_CELL_DEGREES) for lat, long in positions}
+    for lat, long in sorted(centres):
+        for box in radius_boxes(lat, long, radius):
+            recomputed.update(user[0] for user in _load_users(box=box))
+    refresh_users(recomputed, top_n)
+    return len(recomputed)
+
+
+def refresh_project(project_id, top_n=TOP_N):
+    """ Updates the recommendations after one project was created, edited
+    or deleted. Users it was recommended to are recomputed, and nearby
+    users for whom it now scores in their top_n get it added """
+    project = Project.query.get(project_id)
+    recomputed = set(Recommendation.users_for_project(project_id))
+    if project:
+        recomputed.add(project.user_id)
+    refresh_users(recomputed, top_n)
+
+    projects = ProjectMatrix.load(project_ids=[project_id])
+    if not len(projects):
+        return
+
+    users = []
+    for box in radius_boxes(project.lat, project.long, MAX_DISTANCE_KM):
+        users.extend(user for user in _load_users(box=box) if user[0] not in recomputed)
+    if not users:
+        return
+
+    scores = score(users, _tags_by_owner([user[0] for user in users]), projects)[:, 0]
+    candidates = {user[0]: float(value) for user, value in zip(users, scores) if np.isfinite(value)}
+    if not candidates:
+        return
+
+    standing = {}
+    for user_id, value in db.session.query(Recommendation.user_id, Recommendation.score
+            ).filter(Recommendation.user_id.in_(list(candidates))):
+        standing.setdefault(user_id, []).append(value)
+
+    added = [user_id for user_id, value in candidates.items()
+        if len(standing.get(user_id, [])) < top_n or value > min(standing[user_id])]
+    if not added:
+        return
+
+    insert_rows(Recommendation.__table__.insert(), [{'user_id': user_id,
+        'project_id': project_id,
+        'score': candidates[user_id]} for user_id in added])
+    for user_id in added:
+        if len(standing.get(user_id, [])) >= top_n:
+            lowest = Recommendation.query.filter_by(user_id=user_id
+                ).order_by(Recommendation.score, Recommendation.project_id.desc()).first()
+            db.session.delete(lowest)
+    db.session.commit()
+
+
+class RefreshQueue:
+    """ Runs the recommendation refreshes asked for by requests on a
+    background thread, so that responses do not wait for them. Refreshes
+    queued while one runs are merged into the next, each project and user
+    being refreshed once however many times it was queued. The thread is
+    started on first use in each process, so forked workers do not
+    inherit a queue without a thread.
+
+    With background False refreshes run right away in the caller, as
+    tests and scripts need. """
+
+    def __init__(self, top_n=TOP_N, background=True):
+        self.app = None
+        self.top_n = top_n
+        self.background = background
+        self._users = set()
+        self._projects = set()
+        self._positions = set()
+        self._running = False
+        self._pid = None
+        self._condition = Condition()
+
+    def init_app(self, app):
+        """ Reads the settings from the app config, whose app context the
+        refreshes run in """
+        self.app = app
+        self.top_n = app.config.get('RECOMMENDATIONS_LIMIT', self.top_n)
+        self.background = app.config.get('RECOMMENDATIONS_IN_BACKGROUND', self.background)
+
+    def refresh_users(self, user_ids):
+        """ Queues refresh_users() for the users """
+        self._queue(users=user_ids)
+
+    def refresh_project(self, project_id):
+        """ Queues refresh_project() for a project """
+        self._queue(projects=[project_id])
+
+    def refresh_near(self, positions, user_ids=()):
+        """ Queues refresh_near() for the positions and users """
+        self._queue(users=user_ids, positions=positions)
+
+    def wait(self, timeout=None):
+        """ Waits until every queued refresh ran. Returns False if they
+        did not within timeout seconds """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._running and not self._queued(), timeout)
+
+    def _queue(self, users=(), projects=(), positions=()):
+        with self._condition:
+            self._users.update(users)
+            self._projects.update(projects)
+            self._positions.update(positions)
+            if self.background:
+                self._start()
+                self._condition.notify_all()
+                return
+        self._run(*self._take())
+
+    def _queued(self):
+        return self._users or self._projects or self._positions
+
+    def _take(self):
+        """ Returns and clears the queued work, the condition must be
+        held or the queue used by one thread """
+        work = self._users, self._projects, self._positions
+        self._users, self._projects, self._positions = set(), set(), set()
+        return work
+
+    def _start(self):
+        """ Starts the thread if this process has none, the condition
+        must be held """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            Thread(target=self._work, name='recommendations', daemon=True).start()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(self._queued)
+                work = self._take()
+                self._running = True
+            try:
+                with self.app.app_context():
+                    self._run(*work)
+            except Exception:
+                self.app.logger.exception("Refreshing recommendations failed")
+            finally:
+                with self._condition:
+                    self._running = False
+                    self._condition.notify_all()
+
+    def _run(self, users, projects, positions):
+        for project_id in sorted(projects):
+            refresh_project(project_id, self.top_n)
+        if positions:
+            refresh_near(positions, users, self.top_n)
+        elif users:
+            refresh_users(users, self.top_n)
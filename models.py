@@ -1,15 +1,99 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
+from sqlalchemy import and_, event, func, inspect, or_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from collections import namedtuple
 from datetime import datetime
+import math
+import re
+
+import numpy as np
+
+from passwords import PasswordHasher
+from spatial import CELL_LEVEL, EARTH_RADIUS_KM, PointSet, cell_key, covering_ranges, haversine_km, radius_boxes
 
 bcrypt = Bcrypt()
+password_hasher = PasswordHasher(bcrypt)
 db = SQLAlchemy()
 
 
+# Most bind parameters a single statement may carry, SQLite builds before
+# 3.32 allow 999
+MAX_BIND_PARAMETERS = {'postgresql': 32767, 'sqlite': 999}
+
+ProjectChange = namedtuple('ProjectChange', ['id', 'positions', 'deleted', 'tags', 'text'])
+
+project_listeners = []
+user_listeners = []
+
+
 def connect_db(app):
     """Connect to database."""
     db.app = app
     db.init_app(app)
+    password_hasher.init_app(app)
+
+
+def listen_for_project_changes(listener):
+    """ Registers a function to be called after every commit that
+    changed projects, with the list of ProjectChange records holding
+    each project's id, the (lat, long) positions it occupied before
+    and after the change, whether it was deleted, its tag names if they
+    changed and its (name, description) if either changed (None
+    otherwise). It is called with None when stored
+    data was changed wholesale and anything derived from it must be
+    dropped """
+    project_listeners.append(listener)
+    return listener
+
+
+def listen_for_user_changes(listener):
+    """ Registers a function to be called without arguments after every
+    commit that deleted a user or changed a display name, for anything
+    derived from projects that also shows their owner. The projects of
+    a deleted user are passed to the project listeners as deleted """
+    user_listeners.append(listener)
+    return listener
+
+
+def insert_ignoring_conflicts(table):
+    """ Returns an INSERT statement for table that skips the rows which
+    conflict with existing ones instead of failing """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert().prefix_with('IGNORE')
+
+
+def insert_rows(statement, rows):
+    """ Runs an INSERT statement for a list of row dicts sharing the same
+    keys as multi-row VALUES statements, each within the bind parameter
+    limit of the database, instead of one execution per row. Returns
+    the number of statements run """
+    if not rows:
+        return 0
+    limit = MAX_BIND_PARAMETERS.get(db.session.get_bind().dialect.name, 999)
+    batch = max(1, limit // len(rows[0]))
+    for start in range(0, len(rows), batch):
+        db.session.execute(statement.values(rows[start:start + batch]))
+    return (len(rows) + batch - 1) // batch
+
+
+def notify_project_listeners(changes):
+    """ Passes the committed project changes (or None) to every
+    registered listener """
+    for listener in project_listeners:
+        listener(changes)
+
+
+def notify_user_listeners():
+    """ Tells every registered user listener that users changed """
+    for listener in user_listeners:
+        listener()
 
 class Project_Tag(db.Model):
     """ Project_Tag Model """
@@ -30,6 +114,35 @@ class Project_Tag(db.Model):
         """ Show more useful info on Project_Tag """
         return f"<Project_Tag {self.project_id} {self.tag_name}>"
 
+    @classmethod
+    def list_pairs(cls):
+        """ Lists every (project_id, tag_name) pair """
+        return db.session.query(cls.project_id, cls.tag_name).all()
+
+
+class DuplicateUserError(ValueError):
+    """ Raised by User.signup when the email or display name (the field
+    attribute) already belongs to another user """
+
+    def __init__(self, field):
+        super().__init__(f"A user with this {field} already exists")
+        self.field = field
+
+    # The unique constraints of the users table, by their Postgres name
+    # and the column SQLite reports
+    CONSTRAINTS = {'users_email_key': 'email', 'users.email': 'email',
+        'users_display_name_key': 'display_name', 'users.display_name': 'display_name'}
+
+    @classmethod
+    def field_of(cls, error):
+        """ Returns the field whose unique constraint an IntegrityError
+        violated, or None if it is about anything else """
+        constraint = getattr(getattr(error.orig, 'diag', None), 'constraint_name', None)
+        if constraint is None:
+            match = re.fullmatch(r"UNIQUE constraint failed: (\S+)", str(error.orig))
+            constraint = match and match.group(1)
+        return cls.CONSTRAINTS.get(constraint)
+
 
 class User(db.Model):
     """ User Model """
@@ -74,38 +187,63 @@ class User(db.Model):
 
     @classmethod
     def signup(cls, user_obj):
-        """ Signs up new User with required info """
+        """ Signs up new User with required info and any optional info
+        given, in a single insert. Raises DuplicateUserError if the email
+        or display name is already taken """
         optional_params = ['profile_pic', 'privacy', 'seeking_project', 'seeking_help']
 
-        hashed_password = bcrypt.generate_password_hash(user_obj['password']).decode('UTF-8')
+        hashed_password = password_hasher.hash(user_obj['password'])
         user = cls(
             first_name= user_obj['first_name'],
             display_name= user_obj['display_name'],
             email= user_obj['email'],
             password=hashed_password,
             lat= user_obj['lat'],
-            long= user_obj['long']
+            long= user_obj['long'],
+            **{each: user_obj[each] for each in optional_params
+                if user_obj.get(each) is not None}
         )
         db.session.add(user)
-        db.session.commit()
-
-        for each in optional_params:
-            if user_obj[each] != None:
-                user.each = user_obj[each]
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            field = DuplicateUserError.field_of(error)
+            if field is None:
+                raise
+            raise DuplicateUserError(field) from error
 
         return user
 
     @classmethod
     def login(cls, email, password):
-        """ Authenticates User with required info """
+        """ Authenticates User with required info, upgrading the stored
+        hash if it was made with fewer rounds than configured """
 
         user = cls.query.filter_by(email=email).first()   
-        if user and bcrypt.check_password_hash(user.password, password):
+        if user and password_hasher.check(user.password, password):
+            if password_hasher.needs_rehash(user.password):
+                user.password = password_hasher.hash(password)
+                db.session.commit()
             return user
         else:
             return False
 
+    def snapshot(self):
+        """ Returns a dict of the column values of the user but the
+        password hash, to be cached and attached again with
+        from_snapshot(). The hash is loaded from the database if used """
+        return {attr.key: getattr(self, attr.key) for attr in inspect(User).column_attrs
+            if attr.key != 'password'}
+
+    @classmethod
+    def from_snapshot(cls, values):
+        """ Attaches a user saved by snapshot() to the session as if it
+        had been loaded, without querying the database """
+        user = cls(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     @classmethod
     def lookup_user(cls, id):
         """ Looks up User instance and returns it """
@@ -136,6 +274,9 @@ class Project(db.Model):
     long = db.Column(db.Float,
         nullable = False,
         index=True)
+    cell = db.Column(db.BigInteger,
+        nullable = False,
+        index=True)
     time_posted = db.Column(db.DateTime,
         nullable=False,
         default=datetime.utcnow())
@@ -162,9 +303,9 @@ class Project(db.Model):
         return f"<Project {self.name}>"
 
     @classmethod
-    def create_project(cls, project_obj):
+    def create_project(cls, project_obj, tag_names=()):
         """ Creates a new project instance by the current
-        user """
+        user, with the tags named in tag_names """
         optional_params = ['inquiry_deadline', 'work_start', 'work_end', 'pic_url1', 'pic_url2']
 
         project = cls(
@@ -181,26 +322,282 @@ class Project(db.Model):
             pic_url1= project_obj['pic_url1'] or None,
             pic_url2= project_obj['pic_url2'] or None
         )
+        project.tags = Tag.resolve_names(tag_names)
         db.session.add(project)
         db.session.commit()
 
         return project
 
+    @classmethod
+    def list_texts(cls):
+        """ Lists the (id, name, description) of every project """
+        return db.session.query(cls.id, cls.name, cls.description).all()
+
     @classmethod
     def lookup_project(cls, project_id):
         """ Queries for a specific project """
         project = cls.query.get_or_404(project_id)
         return project
 
+    @classmethod
+    def neighborhood_filters(cls, north, south, east, west, project_ids=None, tags=(),
+            match_all=False):
+        """ Builds the filter criteria for projects within specific
+        lat&long bounds, limited to project_ids if given and to projects
+        carrying any (or all, with match_all) of tags if given. The bounds
+        are half open (south and west are included) so adjacent map tiles
+        never share a project. Returns None if nothing can match """
+        ranges = covering_ranges(north, south, east, west)
+        if not ranges or (project_ids is not None and not project_ids):
+            return None
+
+        filters = [or_(*[cls.cell.between(low, high) for low, high in ranges]),
+            cls.lat < north,
+            cls.lat >= south, 
+            cls.long >= west, 
+            cls.long < east]
+        if project_ids is not None:
+            filters.append(cls.id.in_(sorted(project_ids)))
+        for names in ([[tag] for tag in tags] if match_all else [tags] if tags else []):
+            filters.append(db.session.query(Project_Tag.id).filter(
+                Project_Tag.project_id == cls.id, Project_Tag.tag_name.in_(names)).exists())
+        return filters
+
     @classmethod
     def query_neighborhood(cls, north, south, east, west):
         """ Queries for projects within specific lat&long bounds """
-        neighborhood = cls.query.filter(Project.lat < north,
-            Project.lat > south, 
-            Project.long > west, 
-            Project.long < east).all()
+        filters = cls.neighborhood_filters(north, south, east, west)
+        if filters is None:
+            return []
+
+        neighborhood = cls.query.filter(*filters).all()
         return neighborhood
 
+    @classmethod
+    def summary_query(cls):
+        """ Returns a query for the (id, name, lat, long, display_name)
+        rows used in project listings, joined to the owner in SQL """
+        return db.session.query(cls.id, cls.name, cls.lat, cls.long,
+            User.display_name).join(User, cls.user_id == User.id)
+
+    @classmethod
+    def attach_tags(cls, rows):
+        """ Converts summary rows to plain dicts and fills in their
+        tag names with a single query for all of the rows """
+        summaries = [{'id': id,
+            'name': name,
+            'display_name': display_name,
+            'lat': lat,
+            'long': long,
+            'tags': []
+            } for id, name, lat, long, display_name in rows]
+        if not summaries:
+            return summaries
+
+        by_id = {summary['id']: summary for summary in summaries}
+        tag_rows = db.session.query(Project_Tag.project_id, Project_Tag.tag_name
+            ).filter(Project_Tag.project_id.in_(list(by_id))
+            ).order_by(Project_Tag.id).all()
+        for project_id, tag_name in tag_rows:
+            by_id[project_id]['tags'].append(tag_name)
+        return summaries
+
+    @classmethod
+    def count_neighborhood(cls, north, south, east, west, cap, tags=(), match_all=False):
+        """ Counts the projects within specific lat&long bounds carrying
+        any (or all) of tags if given, stopping at cap so the count stays
+        cheap for very large areas """
+        filters = cls.neighborhood_filters(north, south, east, west, None, tags, match_all)
+        if filters is None:
+            return 0
+
+        capped = db.session.query(cls.id).filter(*filters).limit(cap).subquery()
+        return db.session.query(func.count()).select_from(capped).scalar()
+
+    @classmethod
+    def query_neighborhood_page(cls, north, south, east, west, limit, after=None,
+            tags=(), match_all=False):
+        """ Queries for a page of plain dict summaries of the projects
+        within specific lat&long bounds, nearest to the centre of the
+        bounds first. after is the (distance, id) sort key of the last
+        project of the previous page. Returns the summaries and the sort
+        key to continue from, which is None on the last page """
+        filters = cls.neighborhood_filters(north, south, east, west, None, tags, match_all)
+        if filters is None:
+            return [], None
+
+        centre_lat = (north + south) / 2
+        centre_long = (east + west) / 2
+        scale = math.cos(math.radians(centre_lat))
+        distance = ((cls.lat - centre_lat) * (cls.lat - centre_lat) +
+            (cls.long - centre_long) * (cls.long - centre_long) * scale * scale)
+
+        query = cls.summary_query().add_columns(distance).filter(*filters)
+        if after is not None:
+            query = query.filter(or_(distance > after[0],
+                and_(distance == after[0], cls.id > after[1])))
+        rows = query.order_by(distance, cls.id).limit(limit + 1).all()
+
+        next_after = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_after = (rows[-1][5], rows[-1][0])
+        return cls.attach_tags([row[:5] for row in rows]), next_after
+
+    @classmethod
+    def query_points(cls, north, south, east, west, max_points=None):
+        """ Queries for the spatial.PointSet of the projects within
+        specific lat&long bounds. Returns None if there are more than
+        max_points of them """
+        filters = cls.neighborhood_filters(north, south, east, west)
+        if filters is None:
+            return PointSet.from_rows([])
+
+        query = db.session.query(cls.id, cls.lat, cls.long, cls.cell).filter(*filters)
+        if max_points is not None:
+            query = query.limit(max_points + 1)
+        rows = query.all()
+        if max_points is not None and len(rows) > max_points:
+            return None
+        return PointSet.from_rows(rows)
+
+    @classmethod
+    def query_neighborhood_ids(cls, north, south, east, west, project_ids):
+        """ Queries for which of project_ids are within specific lat&long
+        bounds. Returns a set of ids """
+        filters = cls.neighborhood_filters(north, south, east, west, project_ids)
+        if filters is None:
+            return set()
+
+        return {id for (id,) in db.session.query(cls.id).filter(*filters)}
+
+    @classmethod
+    def query_summaries(cls, project_ids):
+        """ Queries for plain dict summaries of the given projects, in the
+        order of project_ids """
+        if not project_ids:
+            return []
+
+        rows = cls.summary_query().filter(cls.id.in_(list(project_ids))).all()
+        by_id = {summary['id']: summary for summary in cls.attach_tags(rows)}
+        return [by_id[id] for id in project_ids if id in by_id]
+
+    @classmethod
+    def query_nearest(cls, lat, long, k, radius_km=5.0):
+        """ Queries for plain dict summaries of the k projects nearest to
+        lat&long by great-circle distance, nearest first, each with its
+        distance_km. Candidates are fetched through the cell index from
+        a box around a search radius, which is widened until k projects
+        are within it, and ranked in one vectorized pass """
+        lat = float(lat)
+        long = float(long)
+        max_radius_km = math.pi * EARTH_RADIUS_KM
+
+        while True:
+            rows = []
+            for north, south, east, west in radius_boxes(lat, long, radius_km):
+                filters = cls.neighborhood_filters(north, south, east, west)
+                if filters is not None:
+                    rows.extend(db.session.query(cls.id, cls.lat, cls.long
+                        ).filter(*filters).all())
+
+            candidates = np.array(rows, dtype=float).reshape(-1, 3)
+            distances = haversine_km(lat, long, candidates[:, 1], candidates[:, 2])
+            within = distances <= radius_km
+            if within.sum() >= k or radius_km >= max_radius_km:
+                break
+            radius_km = min(radius_km * 2, max_radius_km)
+
+        ids = candidates[within, 0].astype(int)
+        distances = distances[within]
+        order = np.lexsort((ids, distances))[:k]
+        ranked = {int(ids[i]): float(distances[i]) for i in order}
+        if not ranked:
+            return []
+
+        summaries = cls.query_summaries(list(ranked))
+        for summary in summaries:
+            summary['distance_km'] = ranked[summary['id']]
+        return summaries
+
+    @classmethod
+    def query_neighborhood_clusters(cls, north, south, east, west, level, sample_size=3,
+            tags=(), match_all=False):
+        """ Groups the projects within specific lat&long bounds by their
+        grid cell at the given level. Returns a list of dicts with the
+        centroid, the project count and a sample of project ids for each
+        cell, aggregated in SQL so only one row per cell is transferred """
+        filters = cls.neighborhood_filters(north, south, east, west, None, tags, match_all)
+        if filters is None:
+            return []
+
+        bucket = cls.cell / (1 << (2 * (CELL_LEVEL - level)))
+        rows = db.session.query(bucket, func.count(cls.id),
+            func.avg(cls.lat), func.avg(cls.long)
+            ).filter(*filters).group_by(bucket).order_by(bucket).all()
+        clusters = {bucket_id: {'lat': lat,
+            'long': long,
+            'count': count,
+            'ids': []
+            } for bucket_id, count, lat, long in rows}
+
+        ranked = db.session.query(bucket.label('bucket'), cls.id.label('id'),
+            func.row_number().over(partition_by=bucket, order_by=cls.id).label('rank')
+            ).filter(*filters).subquery()
+        samples = db.session.query(ranked.c.bucket, ranked.c.id
+            ).filter(ranked.c.rank <= sample_size).order_by(ranked.c.id).all()
+        for bucket_id, project_id in samples:
+            clusters[bucket_id]['ids'].append(project_id)
+
+        return list(clusters.values())
+
+
+@event.listens_for(Project, 'before_insert')
+@event.listens_for(Project, 'before_update')
+def update_project_cell(mapper, connection, project):
+    """ Keeps the spatial cell key in sync with the project's
+    lat&long on every create and edit """
+    project.cell = cell_key(project.lat, project.long)
+
+
+class Recommendation(db.Model):
+    """ Recommendation Model, a project suggested to a user seeking
+    projects by the matchmaker """
+
+    __tablename__ = "recommendations"
+
+    id = db.Column(db.Integer,
+        primary_key = True)
+    user_id = db.Column(db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True)
+    project_id = db.Column(db.Integer,
+        db.ForeignKey('projects.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True)
+    score = db.Column(db.Float,
+        nullable = False)
+
+    def __repr__(self):
+        """ Show more useful info on Recommendation """
+        return f"<Recommendation {self.user_id} {self.project_id} {self.score}>"
+
+    @classmethod
+    def list_for_user(cls, user_id):
+        """ Lists the (project_id, score) recommended to a user, best
+        first """
+        return db.session.query(cls.project_id, cls.score
+            ).filter(cls.user_id == user_id
+            ).order_by(cls.score.desc(), cls.project_id).all()
+
+    @classmethod
+    def users_for_project(cls, project_id):
+        """ Lists the ids of the users a project is recommended to """
+        return [user_id for (user_id,) in db.session.query(cls.user_id
+            ).filter(cls.project_id == project_id)]
+
+
 class Tag(db.Model):
     """ Tag Model """
 
@@ -216,6 +613,8 @@ class Tag(db.Model):
         secondary = "project_tags"
     )
 
+    catalogue_version = 0
+
     def __repr__(self):
         """ Show more useful info on Tag """
         return f"<Tag {self.name}>"
@@ -226,17 +625,112 @@ class Tag(db.Model):
         tag = cls(name = name)
         db.session.add(tag)
         db.session.commit()
+        cls.bump_catalogue_version()
         return tag
 
+    @classmethod
+    def bump_catalogue_version(cls):
+        """ Marks cached lists of the tag names as stale, to be called
+        once new tags are committed """
+        cls.catalogue_version += 1
+
     @classmethod
     def list_all(cls):
-        """ Creates a list of all existing tags """
-        object_list = cls.query.all()
-        return [tag.name for tag in object_list]
+        """ Creates a list of all existing tag names, in alphabetical
+        order. See the tag catalogue in app.py for a cached copy """
+        return [name for (name,) in db.session.query(cls.name).order_by(cls.name)]
+
+    @classmethod
+    def resolve_names(cls, names):
+        """ Returns the tag instances for a list of names, in order and
+        without duplicates, with one query for the existing tags and one
+        insert for the missing ones. Does not commit """
+        names = list(dict.fromkeys(name for name in names if name))
+        if not names:
+            return []
+
+        tags = {tag.name: tag for tag in cls.query.filter(cls.name.in_(names))}
+        missing = [name for name in names if name not in tags]
+        if missing:
+            insert_rows(insert_ignoring_conflicts(cls.__table__),
+                [{'name': name} for name in missing])
+            for name in missing:
+                tag = cls(name = name)
+                make_transient_to_detached(tag)
+                tags[name] = db.session.merge(tag, load=False)
+            db.session.info['tags_created'] = True
+
+        return [tags[name] for name in names]
 
     @classmethod
     def lookup_tag(cls, name):
         """ Looks up tag object based on name and returns it
         Returns None if not found """
         tag = cls.query.filter_by(name=name).first()
-        return tag
\ No newline at end of file
+        return tag
+
+
+def _project_change(project, deleted):
+    """ Builds the ProjectChange record of a flushed project """
+    state = inspect(project)
+    lats = list(state.attrs.lat.history.deleted) + [project.lat]
+    longs = list(state.attrs.long.history.deleted) + [project.long]
+    positions = {(float(lat), float(long)) for lat, long in zip(lats, longs)}
+
+    tags = None
+    if not deleted and state.attrs.tags.history.has_changes():
+        tags = [tag.name for tag in project.tags]
+
+    text = None
+    if not deleted and (state.attrs.name.history.has_changes() or
+            state.attrs.description.history.has_changes()):
+        text = (project.name, project.description)
+    return ProjectChange(project.id, positions, deleted, tags, text)
+
+
+@event.listens_for(db.session, 'after_flush')
+def record_project_changes(session, flush_context):
+    """ Records the projects touched by a flush, including those of
+    deleted users, and whether a user was deleted or changed their
+    display name, until the transaction is committed """
+    changes = session.info.setdefault('project_changes', [])
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Project) and (obj in session.new or
+                obj in session.deleted or session.is_modified(obj)):
+            changes.append(_project_change(obj, obj in session.deleted))
+        elif isinstance(obj, User) and obj in session.deleted:
+            changes.extend(_project_change(project, True) for project in obj.projects)
+            session.info['user_changed'] = True
+        elif isinstance(obj, User) and inspect(obj).attrs.display_name.history.has_changes():
+            session.info['user_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def dispatch_project_changes(session):
+    """ Notifies the project and user listeners and the tag catalogue
+    once the changes are committed """
+    changes = session.info.pop('project_changes', None)
+    if session.info.pop('tags_created', False):
+        Tag.bump_catalogue_version()
+    if changes:
+        notify_project_listeners(changes)
+    if session.info.pop('user_changed', False):
+        notify_user_listeners()
+
+
+@event.listens_for(db.session, 'after_transaction_end')
+def discard_project_changes(session, transaction):
+    """ Forgets the changes of a transaction that ended without
+    being committed """
+    if transaction.parent is None:
+        session.info.pop('project_changes', None)
+        session.info.pop('user_changed', None)
+        session.info.pop('tags_created', None)
+
+
+@event.listens_for(db.metadata, 'after_drop')
+def reset_project_listeners(target, connection, **kw):
+    """ Tells the project listeners and the tag catalogue that every
+    table was dropped """
+    notify_project_listeners(None)
+    Tag.bump_catalogue_version()
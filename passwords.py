@@ -0,0 +1,84 @@
+""" Password hashing and checking on a bounded pool of threads. """
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+import os
+
+
+class PasswordHasherBusy(Exception):
+    """ Raised when too many passwords are already being hashed or
+    checked and no slot frees up in time """
+
+
+class PasswordHasher:
+    """ Hashes and checks passwords with bcrypt (a flask_bcrypt.Bcrypt) on
+    a small pool of max_workers threads, so at most max_workers hashes are
+    computed at once however many requests are logging in. The calling
+    thread still waits for its result. Up to max_waiting more calls are
+    queued for a thread; others wait at most wait_timeout seconds for a
+    place in the queue and then raise PasswordHasherBusy, so an overloaded
+    worker turns requests away quickly instead of piling them up.
+
+    Hashes are made with the configured number of rounds (the bcrypt work
+    factor); needs_rehash() tells which stored hashes are weaker. """
+
+    def __init__(self, bcrypt, rounds=12, max_workers=2, max_waiting=8, wait_timeout=0.1):
+        self.bcrypt = bcrypt
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """ Reads the settings from the app config """
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.max_workers = app.config.get('PASSWORD_HASH_WORKERS', self.max_workers)
+        self.max_waiting = app.config.get('PASSWORD_HASH_WAITING', self.max_waiting)
+        self.wait_timeout = app.config.get('PASSWORD_HASH_WAIT_TIMEOUT', self.wait_timeout)
+
+    def hash(self, password):
+        """ Returns the bcrypt hash of a password as a string """
+        hashed = self._run(self.bcrypt.generate_password_hash, password, self.rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """ Returns whether password matches a bcrypt hash """
+        return self._run(self.bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """ Returns whether a bcrypt hash was made with fewer rounds than
+        are configured now """
+        try:
+            return int(hashed.split('$')[2]) < self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def _run(self, function, *args):
+        """ Calls function on the pool and returns its result, raising
+        PasswordHasherBusy if no slot frees up in time """
+        executor, slots = self._pool()
+        if not slots.acquire(timeout=self.wait_timeout):
+            raise PasswordHasherBusy()
+        try:
+            future = executor.submit(function, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda future: slots.release())
+        return future.result()
+
+    def _pool(self):
+        """ Returns the executor and the semaphore bounding its queue,
+        created on first use in each process so forked workers do not
+        inherit a pool without threads """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(self.max_workers,
+                    thread_name_prefix='password-hasher')
+                self._slots = BoundedSemaphore(self.max_workers + self.max_waiting)
+                self._pid = os.getpid()
+            return self._executor, self._slots
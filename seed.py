@@ -1,9 +1,6 @@
 from app import db
 from models import User, Project, Tag
 
-db.drop_all()
-db.create_all()
-
 
 def seed_database():
     u1 = User(first_name='Pat',
@@ -71,4 +68,7 @@ def seed_database():
     db.session.commit()
 
 
-seed_database()
+if __name__ == '__main__':
+    db.drop_all()
+    db.create_all()
+    seed_database()
@@ -0,0 +1,234 @@
+""" Spatial helpers for indexing projects on a lat/long grid.
+
+Every coordinate maps to a cell of a 2^CELL_LEVEL x 2^CELL_LEVEL grid laid
+over the whole lat/long plane. A cell key interleaves the bits of the cell's
+column and row (a Z-order curve), so every coarser cell covers one contiguous
+range of keys and a viewport can be looked up as a few B-tree range scans
+on a single indexed column. """
+
+import math
+
+import numpy as np
+
+CELL_LEVEL = 16
+MAX_COVERING_CELLS = 32
+TILE_SIZE = 256
+EARTH_RADIUS_KM = 6371.0088
+WHOLE_WORLD = (90.0, -90.0, 180.0, -180.0)
+
+
+def _clamp(value, low, high):
+    """ Limits value to the range [low, high] """
+    return max(low, min(high, value))
+
+
+def _interleave(x, y):
+    """ Interleaves the bits of x (even bits) and y (odd bits) """
+    key = 0
+    for bit in range(CELL_LEVEL):
+        key |= ((x >> bit) & 1) << (2 * bit)
+        key |= ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def _grid_position(lat, long, level):
+    """ Returns the (column, row) of the cell holding a coordinate
+    on the grid of the given level """
+    size = 1 << level
+    x = int((_clamp(long, -180.0, 180.0) + 180.0) / 360.0 * size)
+    y = int((_clamp(lat, -90.0, 90.0) + 90.0) / 180.0 * size)
+    return min(x, size - 1), min(y, size - 1)
+
+
+def cluster_level(zoom, grid_size):
+    """ Returns the grid level whose cells are roughly grid_size pixels
+    wide on a web map at the given zoom level """
+    world_width = TILE_SIZE * 2 ** _clamp(zoom, 0, 30)
+    level = round(math.log2(world_width / max(grid_size, 1)))
+    return int(_clamp(level, 0, CELL_LEVEL))
+
+
+def tile_bounds(zoom, x, y):
+    """ Returns the (north, south, east, west) bounds of a Web Mercator
+    slippy-map tile """
+    size = 2 ** zoom
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / size))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / size))))
+    east = (x + 1) / size * 360.0 - 180.0
+    west = x / size * 360.0 - 180.0
+    return north, south, east, west
+
+
+def haversine_km(lat, long, lats, longs):
+    """ Returns an array of the great-circle distances in km between
+    coordinates, broadcasting lat&long against the lats and longs arrays """
+    lat = np.radians(lat)
+    lats = np.radians(lats)
+    half_dlat = (lats - lat) / 2
+    half_dlong = np.radians(np.asarray(longs) - long) / 2
+    a = np.sin(half_dlat) ** 2 + np.cos(lat) * np.cos(lats) * np.sin(half_dlong) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def radius_boxes(lat, long, radius_km):
+    """ Returns a list of (north, south, east, west) bounds which together
+    contain every coordinate within radius_km of lat&long. Circles that
+    cross the antimeridian are split in two boxes """
+    angle = radius_km / EARTH_RADIUS_KM
+    north = lat + math.degrees(angle)
+    south = lat - math.degrees(angle)
+    if north >= 90 or south <= -90 or math.sin(angle) >= math.cos(math.radians(lat)):
+        return [(min(north, 90.0), max(south, -90.0), 180.0, -180.0)]
+
+    dlong = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+    east = long + dlong
+    west = long - dlong
+    if west < -180:
+        return [(north, south, east, -180.0), (north, south, 180.0, west + 360)]
+    if east > 180:
+        return [(north, south, east - 360, -180.0), (north, south, 180.0, west)]
+    return [(north, south, east, west)]
+
+
+def cell_key(lat, long):
+    """ Returns the cell key of a coordinate at CELL_LEVEL """
+    x, y = _grid_position(float(lat), float(long), CELL_LEVEL)
+    return _interleave(x, y)
+
+
+def cell_keys(lats, longs):
+    """ Returns an array of the cell keys of arrays of coordinates, the
+    same as cell_key gives for each of them """
+    size = 1 << CELL_LEVEL
+    x = ((np.clip(np.asarray(longs, dtype=float), -180.0, 180.0) + 180.0) / 360.0 * size).astype(np.int64)
+    y = ((np.clip(np.asarray(lats, dtype=float), -90.0, 90.0) + 90.0) / 180.0 * size).astype(np.int64)
+    x = np.minimum(x, size - 1)
+    y = np.minimum(y, size - 1)
+
+    keys = np.zeros(x.shape, dtype=np.int64)
+    for bit in range(CELL_LEVEL):
+        keys |= ((x >> bit) & 1) << (2 * bit)
+        keys |= ((y >> bit) & 1) << (2 * bit + 1)
+    return keys
+
+
+class PointSet:
+    """ Arrays of the ids, lats, longs and cell keys of a set of projects,
+    to be narrowed down to a viewport, clustered and paged in memory """
+
+    def __init__(self, ids, lats, longs, cells):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.lats = np.asarray(lats, dtype=float)
+        self.longs = np.asarray(longs, dtype=float)
+        self.cells = np.asarray(cells, dtype=np.int64)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Builds a PointSet from (id, lat, long, cell) rows """
+        columns = np.array(rows, dtype=float).reshape(-1, 4)
+        return cls(columns[:, 0], columns[:, 1], columns[:, 2], columns[:, 3])
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.lats.nbytes + self.longs.nbytes + self.cells.nbytes
+
+    def select(self, mask):
+        """ Returns the PointSet of the points where mask is set """
+        return PointSet(self.ids[mask], self.lats[mask], self.longs[mask], self.cells[mask])
+
+    def within(self, north, south, east, west):
+        """ Returns a mask of the points within lat/long bounds, half open
+        like Project.neighborhood_filters """
+        return ((self.lats < north) & (self.lats >= south) &
+            (self.longs >= west) & (self.longs < east))
+
+    def clusters(self, level, sample_size=3):
+        """ Groups the points by their grid cell at the given level, in
+        cell order. Returns a list of dicts with the centroid, the count
+        and the sample_size lowest ids of each cell """
+        buckets = self.cells >> (2 * (CELL_LEVEL - level))
+        order = np.lexsort((self.ids, buckets))
+        buckets, starts, counts = np.unique(buckets[order], return_index=True,
+            return_counts=True)
+        lat_sums = np.add.reduceat(self.lats[order], starts) if len(starts) else []
+        long_sums = np.add.reduceat(self.longs[order], starts) if len(starts) else []
+        ids = self.ids[order]
+        return [{'lat': float(lat_sum / count),
+            'long': float(long_sum / count),
+            'count': int(count),
+            'ids': ids[start:start + min(count, sample_size)].tolist()
+            } for start, count, lat_sum, long_sum in zip(starts, counts, lat_sums, long_sums)]
+
+    def page(self, lat, long, limit, after=None):
+        """ Returns the ids of at most limit points nearest to lat&long,
+        by the same planar distance as Project.query_neighborhood_page,
+        and the (distance, id) sort key to continue from after them, which
+        is None on the last page """
+        scale = math.cos(math.radians(lat))
+        distances = (self.lats - lat) ** 2 + ((self.longs - long) * scale) ** 2
+        ids = self.ids
+        if after is not None:
+            later = (distances > after[0]) | ((distances == after[0]) & (ids > after[1]))
+            distances, ids = distances[later], ids[later]
+        if len(ids) > limit + 1:
+            nearest = distances <= np.partition(distances, limit)[limit]
+            distances, ids = distances[nearest], ids[nearest]
+
+        order = np.lexsort((ids, distances))[:limit + 1]
+        next_after = None
+        if len(order) > limit:
+            order = order[:limit]
+            next_after = (float(distances[order[-1]]), int(ids[order[-1]]))
+        return ids[order].tolist(), next_after
+
+
+def snap_bounds(north, south, east, west, span=8):
+    """ Widens lat/long bounds outward to the edges of the cells of the
+    finest grid level at which they span at most span cells along each
+    axis. Returns (level, snapped bounds) so nearby viewports share the
+    same snapped bounds """
+    for level in range(CELL_LEVEL, -1, -1):
+        x_low, y_low = _grid_position(south, west, level)
+        x_high, y_high = _grid_position(north, east, level)
+        if x_high - x_low < span and y_high - y_low < span:
+            break
+
+    size = 1 << level
+    return level, ((y_high + 1) / size * 180.0 - 90.0,
+        y_low / size * 180.0 - 90.0,
+        (x_high + 1) / size * 360.0 - 180.0,
+        x_low / size * 360.0 - 180.0)
+
+
+def covering_ranges(north, south, east, west, max_cells=MAX_COVERING_CELLS):
+    """ Returns a sorted list of inclusive (low, high) cell key ranges
+    covering the lat/long bounds, using the finest grid level at which
+    the bounds span at most max_cells cells. Adjacent ranges are merged.
+    Returns an empty list for empty bounds """
+
+    if north <= south or east <= west:
+        return []
+
+    for level in range(CELL_LEVEL, -1, -1):
+        x_low, y_low = _grid_position(south, west, level)
+        x_high, y_high = _grid_position(north, east, level)
+        if (x_high - x_low + 1) * (y_high - y_low + 1) <= max_cells:
+            break
+
+    shift = 2 * (CELL_LEVEL - level)
+    prefixes = sorted(_interleave(x, y)
+        for x in range(x_low, x_high + 1)
+        for y in range(y_low, y_high + 1))
+
+    ranges = []
+    for prefix in prefixes:
+        low = prefix << shift
+        high = low + (1 << shift) - 1
+        if ranges and ranges[-1][1] + 1 == low:
+            ranges[-1] = (ranges[-1][0], high)
+        else:
+            ranges.append((low, high))
+    return ranges
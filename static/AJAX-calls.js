@@ -1,6 +1,9 @@
 const GEOCODE_BASE_URL = `http://127.0.0.1:5000/api/geocode`;
 const NEIGHBORHOOD_BASE_URL = `http://127.0.0.1:5000/api/neighborhood`;
 const TAG_LIST_BASE_URL = `http://127.0.0.1:5000/api/tags`
+const TAG_COMPLETE_BASE_URL = `http://127.0.0.1:5000/api/tags/complete`;
+const TILES_BASE_URL = `http://127.0.0.1:5000/api/tiles`;
+const MAX_TILE_LAT = 85.0511287798;
 
 class Geocode {
     constructor(coordinates){
@@ -31,17 +34,74 @@ class Project {
     within the given map viewport boundaries
         Input Parameter: object with keys called north (high lat range), 
         south (low lat range), east (high long range) and west (low 
-        long range).
-        Returns: an array of Project instances */
-    static async searchForNearbyMarkers({ north, south, east, west }){
+        long range), the current map zoom level, and optionally the
+        cursor of the previous page of results.
+        Returns: an object with an array of Project instances, an
+        array of clusters (lat, long, count and sample ids) which is
+        only filled when the viewport holds too many projects to list,
+        the total number of projects and the cursor of the next page
+        (null on the last page) */
+    static async searchForNearbyMarkers({ north, south, east, west }, zoom, cursor){
         const projects = [];
         const response = await axios.get(NEIGHBORHOOD_BASE_URL,
-            { params: { north, south, east, west } });
+            { params: { north, south, east, west, zoom, cursor } });
         
         for (let each of response.data.projects){
             projects.push(new Project(each));
         }
-        return projects
+        return { projects, clusters: response.data.clusters,
+            total: response.data.total, nextCursor: response.data.next_cursor }
+    }
+
+    /* Lists the Web Mercator tiles (as "z/x/y" strings) which cover the
+    given map viewport boundaries at the given zoom level.
+        Input Parameter: object with keys called north, south, east and
+        west, and the integer map zoom level.
+        Returns: an array of tile path strings */
+    static tilesForViewport({ north, south, east, west }, zoom){
+        const size = 2 ** zoom;
+        const tileX = (lng) => Math.min(size - 1, Math.floor((lng + 180) / 360 * size));
+        const tileY = (lat) => {
+            const rad = Math.max(-MAX_TILE_LAT, Math.min(MAX_TILE_LAT, lat)) * Math.PI / 180;
+            const y = (1 - Math.log(Math.tan(rad) + 1 / Math.cos(rad)) / Math.PI) / 2;
+            return Math.max(0, Math.min(size - 1, Math.floor(y * size)));
+        };
+
+        let xWest = tileX(west);
+        let xEast = tileX(east);
+        if (xEast < xWest) {
+            xEast += size;
+        }
+        const tiles = [];
+        for (let x = xWest; x <= xEast && x - xWest < size; x++) {
+            for (let y = tileY(north); y <= tileY(south); y++) {
+                tiles.push(`${zoom}/${x % size}/${y}`);
+            }
+        }
+        return tiles
+    }
+
+    /* Creates Project instances and clusters from the map tiles covering
+    the given map viewport boundaries. Tiles are fetched in parallel and
+    repeated tiles are answered by the browser's HTTP cache.
+        Input Parameter: object with keys called north, south, east and
+        west, and the integer map zoom level.
+        Returns: an object with an array of Project instances and an
+        array of clusters for the tiles too crowded to list */
+    static async searchTiles(viewport, zoom){
+        const projects = [];
+        const clusters = [];
+        const responses = await Promise.all(
+            Project.tilesForViewport(viewport, zoom).map(
+                tile => axios.get(`${TILES_BASE_URL}/${tile}`)));
+
+        for (let response of responses){
+            for (let each of response.data.projects){
+                projects.push(new Project(each));
+            }
+            clusters.push(...response.data.clusters);
+        }
+        return { projects, clusters }
     }
 }
 
@@ -51,4 +111,9 @@ class Tag {
         const response = await axios.get(TAG_LIST_BASE_URL);
         return response.data;
     }
+
+    static async complete(prefix) {
+        const response = await axios.get(TAG_COMPLETE_BASE_URL, { params: { prefix } });
+        return response.data.map(each => each.name);
+    }
 }
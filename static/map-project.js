@@ -1,4 +1,5 @@
-let tagsFullList = [];
+let tagsCompletions = [];
+let tagsCompletionRequest = 0;
 let tagsSelectedList = [];
 const tagSelectInput = document.getElementById("tag-select")
 const tagButton = document.getElementById("create-tag-button")
@@ -7,12 +8,11 @@ const hiddenTagInput = document.getElementById("tags")
 tagSetUp();
 
 
-/* Function initializes the list of existing tags (async operation), the hidden tag DOM field, adds the 
+/* Function initializes the hidden tag DOM field, adds the 
 event listener on any existing tags to remove the tag and on the input field
 for whenever the user types, and appends to the DOM any existing tags. 
     Called above automatically on load.*/
-async function tagSetUp() {
-    tagsFullList = await Tag.getTagFullList();
+function tagSetUp() {
     tagSelectInput.addEventListener("keyup", checkTag)
     document.getElementById("selected-tags").addEventListener("click", tagRemove)
     
@@ -52,11 +52,13 @@ function tagRemove(event){
 
 /* Function hides the Add button when the project tag input field is empty
 and renders it depending on the results of its comparison, whether the 
-input matches any existing tags, or requires a new tag to be created. When
-Add button is rendered, an event listener to add the tag is attached.
+input matches any existing tags, or requires a new tag to be created. The
+existing tags starting with the input are fetched (async operation) and
+offered as suggestions. When Add button is rendered, an event listener to
+add the tag is attached.
     Called in tagSetUp() function as the event listener callback function
     on the tagSelectInput (project tag input field). */
-function checkTag(event) {
+async function checkTag(event) {
     event.preventDefault();
 
     if (tagSelectInput.value == ""){
@@ -66,7 +68,16 @@ function checkTag(event) {
     tagButton.style.display = "inline";
     tagButton.addEventListener("click", addTag)
 
-    if (tagsFullList.includes(tagSelectInput.value)){
+    const request = ++tagsCompletionRequest;
+    const completions = await Tag.complete(tagSelectInput.value);
+    if (request != tagsCompletionRequest) {
+        return;
+    }
+    tagsCompletions = completions;
+    document.getElementById("tags-all").innerHTML = tagsCompletions
+        .map(each => `<option value="${each}" />`).join("");
+
+    if (tagsCompletions.includes(tagSelectInput.value)){
         tagButton.innerText = "Add Existing Tag";
     } else {
         tagButton.innerText = "Add New Tag"
@@ -86,10 +97,6 @@ function addTag(event){
         tagSelectInput.value = "";
         return;
     }
-    if (tagButton.innerText == "Add New Tag"){
-        tagsFullList.push(tag_name);
-        document.getElementById("tags-all").innerHTML += `<option value="${tag_name}" />`;
-    };
     document.getElementById("selected-tags").innerHTML +=
     `<li class="tag-tile" 
         data-name="${tag_name}">${tag_name}   <button><i class="fas fa-trash-alt text-danger"></i></button>
@@ -2,7 +2,8 @@
 JavaScript API on the page.
     Called in the API script tag in the template page head section. */
 function initMap() {
-    let myLatlong, viewport, markersNearby, markerCurrentLocation;
+    let myLatlong, viewport, markerCurrentLocation;
+    let markersNearby = [];
     let neighborhood;
     let zoomLevel = 11;
     retrieveUserCoords();
@@ -58,7 +59,8 @@ function initMap() {
 
     /* Function updates the map viewport boundaries and updates the localStorage
     with the most recent map orientation. Then it awaits the nearby projects 
-    (neighborhood global variable) within those boundaries. Based on those projects,
+    (neighborhood global variable) from the map tiles covering those boundaries. 
+    Based on those projects and the project clusters of any crowded tiles,
     markers are generated and DOM elements are created to show the search results.
         Called as event listener callback function on the on the map upon it's first 
         load, and whenever the map object is dragged or zoomed. */
@@ -66,10 +68,17 @@ function initMap() {
         generateViewportBounds();
         updateLocalStorage();
 
-        neighborhood = await Project.searchForNearbyMarkers(viewport)
-        console.log(viewport)
-        generate_markersNearby(neighborhood);
-        generate_projectListing(neighborhood);
+        neighborhood = await Project.searchTiles(viewport, map.getZoom())
+        const bounds = map.getBounds();
+        const visible = neighborhood.projects.filter(
+            each => bounds.contains(new google.maps.LatLng(each.lat, each.long)));
+        const clustered = neighborhood.clusters.filter(
+            each => bounds.contains(new google.maps.LatLng(each.lat, each.long)));
+
+        clearMarkersNearby();
+        generate_markersNearby(visible);
+        generate_markersClusters(clustered);
+        generate_projectListing(visible, clustered);
     }
 
 
@@ -95,50 +104,81 @@ function initMap() {
     }
 
 
-    /* Function clears the map object of any markersNearby objects,
-    and iterates through the array to create a marker for each one.
+    /* Function clears the map object of all the markersNearby objects.
+        Called in the populate_projects() function. */
+    function clearMarkersNearby(){
+        for (let marker of markersNearby) {
+            marker.setMap(null);
+        }
+        markersNearby = [];
+    };
+
+
+    /* Function iterates through the array to create a marker for each one.
         Input Parameter: an array of instances with lat & long 
         properties.
         Called in the populate_projects() function. */
     function generate_markersNearby(list){
-        try {
-            markersNearby.setMap(null);
-        } catch (err) {};
-
         for (let i = 0; i < list.length; i++) {
-            markersNearby = new google.maps.Marker({
+            markersNearby.push(new google.maps.Marker({
                 position: new google.maps.LatLng(list[i].lat, list[i].long),
                 map,
                 label: `${i+1}`
-            });};
+            }));};
+    };
+
+
+    /* Function iterates through the array to create a marker for each
+    cluster, labelled with its project count. Clicking a cluster marker
+    zooms the map in on it.
+        Input Parameter: an array of clusters with lat, long & count 
+        properties.
+        Called in the populate_projects() function. */
+    function generate_markersClusters(list){
+        for (let cluster of list) {
+            const marker = new google.maps.Marker({
+                position: new google.maps.LatLng(cluster.lat, cluster.long),
+                map,
+                label: `${cluster.count}`
+            });
+            marker.addListener("click", () => {
+                map.setCenter(marker.getPosition());
+                map.setZoom(map.getZoom() + 2);
+            });
+            markersNearby.push(marker);
+        };
     };
 
 
     /* Function selects the DOM element and either appends a message,
-    saying no results found, or prints the Project instances.
+    saying no results found, or prints the Project instances, followed
+    by a message with the number of projects in crowded areas. The rows
+    are joined and written to the DOM at once.
         Input Parameter: an array of instances with text properties 
-        to append to the DOM.
+        to append to the DOM, and an array of clusters with a count
+        property.
         Called in the populate_projects() function. */
-    function generate_projectListing(list) {
+    function generate_projectListing(list, clusters) {
         const results = document.getElementById("project-results")
-        if (list.length == 0){
+        const clusteredTotal = clusters.reduce((sum, cluster) => sum + cluster.count, 0);
+        if (list.length == 0 && clusteredTotal == 0){
             results.innerHTML = "<tr><td>No projects near by..</td></tr>";
-        } else {
-            results.innerHTML = "";
+            return;
         }
         
-        for (let i = 0; i < list.length; i++) {
-            // tagList = String(...neighborhood[i].tags);
-            let content = `<tr><td>${i+1}</td>
+        const rows = list.map((project, i) => `<tr><td>${i+1}</td>
                     <td>
                         <a class="text-light" 
-                            href="/project/${list[i].id}"><b>${list[i].name}</b></a>
+                            href="/project/${project.id}"><b>${project.name}</b></a>
                     </td>
-                    <td>${list[i].tags.join(", ")}</td>
-                    <td>${list[i].display_name}</td>
-                    </tr>`
-            results.innerHTML += content;
+                    <td>${project.tags.join(", ")}</td>
+                    <td>${project.display_name}</td>
+                    </tr>`);
+
+        if (clusteredTotal > 0){
+            rows.push(`<tr><td colspan="4">${clusteredTotal} more projects in crowded areas, zoom in to list them..</td></tr>`);
         }
+        results.innerHTML = rows.join("");
     }
 
 
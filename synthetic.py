@@ -0,0 +1,178 @@
+""" Deterministic synthetic data for load testing and benchmarks.
+
+Generates users and projects clustered around city centres, with tags
+drawn from a Zipf distributed vocabulary, and bulk loads them with Core
+multi-row INSERT statements. Rows are generated in blocks of BLOCK_SIZE,
+each from its own random stream seeded from the seed and the block
+number, so the same seed and counts always produce the same positions,
+flags and tags. The ids continue after the existing rows, along with the
+names and emails derived from them, so the data is only identical when
+generated into empty tables. """
+
+from collections import namedtuple
+
+import numpy as np
+
+from models import (db, insert_ignoring_conflicts, insert_rows, notify_project_listeners,
+    password_hasher, Project, Project_Tag, Tag, User)
+from spatial import cell_keys
+
+City = namedtuple('City', ['name', 'lat', 'long', 'spread_km', 'weight'])
+
+DEFAULT_CITIES = [
+    City('Vancouver', 49.2827, -123.1207, 15.0, 4.0),
+    City('Seattle', 47.6062, -122.3321, 15.0, 4.0),
+    City('Portland', 45.5152, -122.6784, 12.0, 2.0),
+    City('Calgary', 51.0447, -114.0719, 12.0, 2.0),
+    City('Toronto', 43.6532, -79.3832, 20.0, 5.0),
+    City('New York', 40.7128, -74.0060, 20.0, 6.0),
+    City('London', 51.5072, -0.1276, 20.0, 5.0),
+    City('Sydney', -33.8688, 151.2093, 20.0, 3.0),
+]
+
+TAG_STEMS = ['garden', 'painting', 'woodwork', 'glass art', 'welding', 'sewing',
+    'compost', 'repair', 'bikes', 'solar', 'pottery', 'mural', 'plumbing',
+    'roofing', 'fencing', 'tiling', 'knitting', 'hardware', 'wiring', 'mosaic']
+FILLER_WORDS = ['help', 'need', 'weekend', 'tools', 'old', 'build', 'fix', 'neighbours',
+    'backyard', 'materials', 'learn', 'together', 'community', 'space', 'ideas']
+FIRST_NAMES = ['Pat', 'Jill', 'Sam', 'Alex', 'Robin', 'Kim', 'Lee', 'Jo', 'Ari', 'Max']
+
+BLOCK_SIZE = 10000
+ZIPF_EXPONENT = 1.1
+MAX_TAGS = 6
+KM_PER_DEGREE = 111.32
+
+
+def tag_vocabulary(count):
+    """ Returns count distinct tag names, the common stems first """
+    names = TAG_STEMS[:count]
+    number = 2
+    while len(names) < count:
+        names.extend(f"{stem} {number}" for stem in TAG_STEMS[:count - len(names)])
+        number += 1
+    return names
+
+
+def zipf_cdf(count, exponent=ZIPF_EXPONENT):
+    """ Returns the cumulative probabilities of ranks 1 to count under a
+    Zipf distribution """
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def clustered_points(rng, count, cities):
+    """ Returns arrays of count lats and longs scattered around the
+    cities, picked in proportion to their weights """
+    weights = np.array([city.weight for city in cities], dtype=float)
+    picks = rng.choice(len(cities), size=count, p=weights / weights.sum())
+    centres = np.array([(city.lat, city.long, city.spread_km) for city in cities])[picks]
+
+    north_km, east_km = rng.normal(size=(2, count)) * centres[:, 2]
+    lats = np.clip(centres[:, 0] + north_km / KM_PER_DEGREE, -89.9, 89.9)
+    longs = centres[:, 1] + east_km / (KM_PER_DEGREE * np.cos(np.radians(lats)))
+    longs = (longs + 180.0) % 360.0 - 180.0
+    return lats, longs
+
+
+def _next_id(model):
+    """ Returns the id after the largest one of a table """
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def _reset_sequence(table):
+    """ Moves the Postgres id sequence of a table past the explicit ids """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"(SELECT max(id) FROM {table}))")
+
+
+def _blocks(total):
+    """ Yields the (number, start, count) of the blocks of total rows """
+    for number, start in enumerate(range(0, total, BLOCK_SIZE)):
+        yield number, start, min(BLOCK_SIZE, total - start)
+
+
+def generate(users, projects, tags=500, seed=0, cities=DEFAULT_CITIES, on_progress=None):
+    """ Adds users users and projects projects with tags from a
+    vocabulary of tags names, deterministically from seed. Every user's
+    password is "password". on_progress is called with the table name
+    and the number of rows inserted so far after every block. Returns
+    a dict of the number of rows added to each table """
+    vocabulary = tag_vocabulary(tags)
+    insert_rows(insert_ignoring_conflicts(Tag.__table__), [{'name': name} for name in vocabulary])
+    cdf = zipf_cdf(len(vocabulary)) if vocabulary else None
+    password = password_hasher.hash('password')
+
+    first_user = _next_id(User)
+    for number, start, count in _blocks(users):
+        rng = np.random.default_rng([seed, 0, number])
+        lats, longs = clustered_points(rng, count, cities)
+        names = rng.integers(len(FIRST_NAMES), size=count)
+        flags = rng.random(size=(3, count))
+        rows = []
+        for offset in range(count):
+            id = first_user + start + offset
+            rows.append({'id': id,
+                'email': f"user{id}@example.com",
+                'password': password,
+                'display_name': f"user{id}",
+                'first_name': FIRST_NAMES[names[offset]],
+                'lat': float(lats[offset]),
+                'long': float(longs[offset]),
+                'privacy': bool(flags[0, offset] < 0.1),
+                'seeking_project': bool(flags[1, offset] < 0.6),
+                'seeking_help': bool(flags[2, offset] < 0.7)})
+        insert_rows(User.__table__.insert(), rows)
+        db.session.commit()
+        if on_progress:
+            on_progress('users', start + count)
+
+    first_project = _next_id(Project)
+    tag_rows = 0
+    for number, start, count in _blocks(projects if users else 0):
+        rng = np.random.default_rng([seed, 1, number])
+        lats, longs = clustered_points(rng, count, cities)
+        cells = cell_keys(lats, longs)
+        owners = first_user + rng.integers(users, size=count)
+        tag_counts = rng.integers(MAX_TAGS + 1, size=count)
+        tag_draws = np.searchsorted(cdf, rng.random(size=(count, MAX_TAGS))) if vocabulary else None
+        words = rng.integers(len(FILLER_WORDS), size=(count, 8))
+
+        rows = []
+        pairs = []
+        for offset in range(count):
+            id = first_project + start + offset
+            names = []
+            if vocabulary:
+                names = list(dict.fromkeys(vocabulary[rank]
+                    for rank in tag_draws[offset, :tag_counts[offset]]))
+            pairs.extend({'project_id': id, 'tag_name': name} for name in names)
+            topic = names[0] if names else 'community'
+            filler = ' '.join(FILLER_WORDS[word] for word in words[offset])
+            rows.append({'id': id,
+                'name': f"{topic} project {id}"[:30],
+                'description': f"{filler} {' '.join(names)}",
+                'user_id': int(owners[offset]),
+                'contact_info_type': 'email',
+                'contact_info': f"user{owners[offset]}@example.com",
+                'lat': float(lats[offset]),
+                'long': float(longs[offset]),
+                'cell': int(cells[offset])})
+        insert_rows(Project.__table__.insert(), rows)
+        insert_rows(Project_Tag.__table__.insert(), pairs)
+        tag_rows += len(pairs)
+        db.session.commit()
+        if on_progress:
+            on_progress('projects', start + count)
+
+    for table in ['users', 'projects', 'project_tags']:
+        _reset_sequence(table)
+    db.session.commit()
+    Tag.bump_catalogue_version()
+    notify_project_listeners(None)
+
+    return {'users': users,
+        'projects': projects if users else 0,
+        'tags': len(vocabulary),
+        'project_tags': tag_rows}
@@ -1,7 +1,27 @@
+import io
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import TestCase
-from flask import session, g
-from app import app
-from models import db, User, Project, Tag
+from flask import session, g, json
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from app import app, geocode_cache, geocoder, neighborhood_cache, query_instrumentation, recommendation_queue, slow_query_log, tag_index, text_index
+from models import db, bcrypt, password_hasher, DuplicateUserError, ProjectChange, User, Project, Tag, Recommendation
+from passwords import PasswordHasher, PasswordHasherBusy
+from cache import CatalogueSnapshot, PersistentCache, RegionCache
+from indexes import TagCompleter, TagIndex, TextIndex
+from instrumentation import fingerprint
+from importer import import_projects
+from geocoding import Gazetteer, GeocodingClient, GeocodingError, GeocodingThrottled, QuotaGovernor, normalize_address
+import bench
+import matchmaker
+import synthetic
+from spatial import cell_key, cell_keys, covering_ranges, haversine_km, radius_boxes, snap_bounds, tile_bounds
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///matchmaker_test'
 app.config['SQLALCHEMY_ECHO'] = False
@@ -9,6 +29,10 @@ app.config['SQLALCHEMY_ECHO'] = False
 app.config['TESTING'] = True
 app.config['WTF_CSRF_ENABLED'] = False
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+geocode_cache.path = os.path.join(tempfile.mkdtemp(), 'geocode-cache.sqlite3')
+slow_query_log.use_file(os.path.join(tempfile.mkdtemp(), 'slow-queries.log'))
+password_hasher.rounds = 4
+recommendation_queue.background = False
 
 db.drop_all()
 db.create_all()
@@ -141,6 +165,78 @@ class UserViewsTestCase(TestCase):
 			self.assertEqual(resp.location, "http://localhost/search")
 			
 	
+	def test_signup_optional_fields(self):
+		"""Ensures the optional fields are saved with the new user"""
+
+		with app.test_client() as client:
+			client.post(
+				"/profile/new", data={
+					'form-user-signup-first_name': user_data2['first_name'],
+					'form-user-signup-display_name': user_data2['display_name'] ,
+					'form-user-signup-email': user_data2['email'],
+					'form-user-signup-password': 'password',
+					'form-user-signup-confirm_password': 'password',
+					'form-user-signup-profile_pic': '/static/images/me.jpg',
+					'form-user-signup-lat': user_data2['lat'],
+					'form-user-signup-long': user_data2['long'],
+					'form-user-signup-privacy': True,
+					'form-user-signup-seeking_help': True,
+					'form-user-signup-accept_rules': True
+				})
+
+		user = User.query.filter_by(email=user_data2['email']).one()
+		self.assertEqual(user.profile_pic, '/static/images/me.jpg')
+		self.assertEqual((user.privacy, user.seeking_project, user.seeking_help), (True, False, True))
+
+	def test_signup_single_commit(self):
+		"""Ensures signing up takes a single commit"""
+
+		commits = []
+		def record(conn):
+			commits.append(conn)
+
+		event.listen(db.engine, 'commit', record)
+		try:
+			User.signup({**user_data2, 'password': 'password', 'privacy': True,
+				'profile_pic': None, 'seeking_project': None, 'seeking_help': False})
+		finally:
+			event.remove(db.engine, 'commit', record)
+
+		self.assertEqual(len(commits), 1)
+		user = User.query.filter_by(email=user_data2['email']).one()
+		self.assertEqual((user.privacy, user.seeking_project, user.seeking_help), (True, True, False))
+
+	def test_signup_duplicate(self):
+		"""Ensures taken emails are reported on the form"""
+
+		with app.test_client() as client:
+			resp = client.post(
+				"/profile/new", data={
+					'form-user-signup-first_name': user_data2['first_name'],
+					'form-user-signup-display_name': user_data2['display_name'] ,
+					'form-user-signup-email': user_data['email'],
+					'form-user-signup-password': 'password',
+					'form-user-signup-confirm_password': 'password',
+					'form-user-signup-lat': user_data2['lat'],
+					'form-user-signup-long': user_data2['long'],
+					'form-user-signup-accept_rules': True
+				})
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertIn("This email is already taken.", resp.get_data(as_text=True))
+			self.assertEqual(User.query.filter_by(display_name=user_data2['display_name']).count(), 0)
+
+	def test_signup_duplicate_fields(self):
+		"""Ensures only unique violations are reported as taken fields"""
+
+		with app.app_context():
+			with self.assertRaises(DuplicateUserError) as caught:
+				User.signup({**user_data2, 'display_name': user_data['display_name'], 'password': 'password'})
+			self.assertEqual(caught.exception.field, 'display_name')
+
+			with self.assertRaises(IntegrityError):
+				User.signup({**user_data2, 'first_name': None, 'password': 'password'})
+
 	def test_signup_post_redirected(self):
 		"""Ensure Post request loads redirected page correctly"""
 
@@ -352,6 +448,31 @@ class UserViewsTestCase(TestCase):
 			self.assertEqual(resp.status_code,302)
 			self.assertEqual(resp.location, "http://localhost/search")
 
+	def test_user_edit_post_cached_user(self):
+		"""Ensures the edited profile is shown right away even when the
+		user was cached"""
+
+		with app.test_client() as client:
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.user.id
+			client.get("/profile/edit")
+			client.post(
+				"/profile/edit", data={
+					'form-user-edit-first_name': user_data['first_name'],
+					'form-user-edit-display_name': user_data['display_name'] ,
+					'form-user-edit-email': user_data['email'],
+					'form-user-edit-password': 'password',
+					'form-user-edit-profile_pic': "#",
+					'form-user-edit-lat': 10.5,
+					'form-user-edit-long': user_data['long'],
+					'form-user-edit-privacy': False,
+					'form-user-edit-seeking_project': True,
+					'form-user-edit-seeking_help': True
+				})
+			resp = client.get("/search")
+
+			self.assertIn('data-lat=10.5', resp.get_data(as_text=True))
+
 	def test_user_edit_post_redirected(self):
 		"""Ensures redirected page renders correctly after correctly processing
 		Post request data"""
@@ -454,6 +575,30 @@ class SearchViewTestCase(TestCase):
 			with self.assertRaises(KeyError):
 				session['GUEST_GEOCODE']
 
+	def test_search_get_user_cached(self):
+		"""Ensures the logged in user is only loaded when used, and from
+		the user cache after the first request"""
+
+		statements = []
+		def record(conn, cursor, statement, parameters, context, executemany):
+			statements.append(statement)
+
+		with app.test_client() as client:
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.user.id
+			event.listen(db.engine, 'before_cursor_execute', record)
+			try:
+				client.get("/api/tags")
+				self.assertFalse([each for each in statements if 'FROM users' in each])
+				client.get("/search")
+				client.get("/search")
+				resp = client.get("/search")
+			finally:
+				event.remove(db.engine, 'before_cursor_execute', record)
+
+			self.assertEqual(len([each for each in statements if 'FROM users' in each]), 1)
+			self.assertIn(f'data-lat={user_data["lat"]}', resp.get_data(as_text=True))
+
 	def test_search_get_guest(self):
 		"""Ensures search page renders correctly for a guest user"""
 
@@ -531,10 +676,44 @@ class ProjectViewsTestCase(TestCase):
 			self.assertEqual(resp.status_code,200)
 			self.assertIn("Log out</button>", html)
 			self.assertIn("<h2>New Project</h2>", html)
-			self.assertIn('<option value="glass art" />', html)
+			self.assertIn('<datalist id="tags-all">', html)
+			self.assertNotIn('<option value="glass art" />', html)
 			with self.assertRaises(KeyError):
 				session['GUEST_GEOCODE']
 
+	def test_project_new_deleted_user(self):
+		"""Ensures a session naming a user who no longer exists is logged
+		out instead of reaching the views"""
+
+		with app.test_client() as client:
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.user.id + 1
+			get = client.get("/project/new")
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.user.id + 1
+			post = client.post("/project/new", data={
+				'form-project-new-name': project2['name']})
+
+			self.assertEqual((get.status_code, get.location), (302, "http://localhost/"))
+			self.assertEqual((post.status_code, post.location), (302, "http://localhost/"))
+			with self.assertRaises(KeyError):
+				session['CURR_USER_KEY']
+
+	def test_user_cache_skips_password(self):
+		"""Ensures cached users do not carry their password hash, which
+		is loaded from the database when used"""
+
+		with app.test_client() as client:
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.user.id
+			client.get("/search")
+			User.query.filter_by(id=self.user.id).update({'password': 'changed'})
+			db.session.commit()
+			client.get("/search")
+
+			self.assertNotIn('password', User.from_snapshot(self.user.snapshot()).__dict__)
+			self.assertEqual(g.user.password, 'changed')
+
 	def test_project_new_post(self):
 		"""Ensures new project form Post request redirects"""
 
@@ -554,6 +733,39 @@ class ProjectViewsTestCase(TestCase):
 
 			self.assertEqual(resp.status_code,302)
 	
+	def test_project_new_post_tags(self):
+		"""Ensures new and existing tags are resolved with one query and
+		one insert"""
+
+		statements = []
+		def record(conn, cursor, statement, parameters, context, executemany):
+			statements.append(statement)
+
+		with app.test_client() as client:
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.user.id
+			event.listen(db.engine, 'before_cursor_execute', record)
+			try:
+				resp = client.post(
+					"/project/new", data={
+						'form-project-new-name': project2['name'],
+						'form-project-new-description': project2['description'],
+						'form-project-new-contact_info_type': project2['contact_info_type'],
+						'form-project-new-contact_info': project2['contact_info'],
+						'form-project-new-lat': project2['lat'],
+						'form-project-new-long': project2['long'],
+						'tags': 'welding|glass art|welding',
+					})
+			finally:
+				event.remove(db.engine, 'before_cursor_execute', record)
+
+		self.assertEqual(resp.status_code, 302)
+		project = Project.query.filter_by(name=project2['name']).one()
+		self.assertEqual([tag.name for tag in project.tags], ['welding', 'glass art'])
+		self.assertEqual(Tag.list_all(), ['glass art', 'welding'])
+		self.assertEqual(len([statement for statement in statements
+			if 'FROM tags' in statement or 'INTO tags' in statement]), 2)
+
 	def test_project_new_post_redirected(self):
 		"""Ensures redirected page and data is processed correctly from
 		the Post request"""
@@ -705,6 +917,45 @@ class APIGeocodeTestCase(TestCase):
 			data = resp.json
 			self.assertEqual(data['results'][0]['address_components'][0]['long_name'], "3211")
 
+	def test_api_geocode_cached(self):
+		"""Ensures addresses looked up before are answered from the cache"""
+
+		body = json.dumps({'status': 'OK', 'results': [{'geometry': {'location': {'lat': 1, 'lng': 2}}}]})
+		geocode_cache.put(normalize_address('1 Main St, Vancouver'), body)
+
+		with app.test_client() as client:
+			resp = client.get("/api/geocode?address=1%20MAIN%20St%20%20Vancouver")
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual(resp.json['results'][0]['geometry']['location'], {'lat': 1, 'lng': 2})
+
+	def test_api_geocode_throttled(self):
+		"""Ensures lookups over quota get 429 with a bounded Retry-After,
+		even when the quota is set to no calls at all"""
+
+		governor = geocoder.governor
+		geocoder.governor = QuotaGovernor(rate=0, burst=0, client_rate=0, client_burst=0)
+		try:
+			with app.test_client() as client:
+				resp = client.get("/api/geocode?address=2%20Main%20St%20Nowhere")
+		finally:
+			geocoder.governor = governor
+
+		self.assertEqual(resp.status_code, 429)
+		self.assertEqual(resp.headers['Retry-After'], str(app.config['GEOCODE_MAX_RETRY_AFTER']))
+
+	def test_api_geocode_stats_allowed_addresses(self):
+		"""Ensures the geocoding counters are only answered to the
+		allowed addresses"""
+
+		with app.test_client() as client:
+			allowed = client.get("/api/geocode/stats")
+			refused = client.get("/api/geocode/stats", environ_base={'REMOTE_ADDR': '203.0.113.9'})
+
+		self.assertEqual(allowed.status_code, 200)
+		self.assertIn('called', allowed.json)
+		self.assertEqual(refused.status_code, 404)
+
 class APINeighbourhoodTestCase(TestCase):
 	"""Tests for api neighbourhood"""
 
@@ -746,6 +997,466 @@ class APINeighbourhoodTestCase(TestCase):
 			data = resp.json
 			self.assertEqual(data['projects'][0]['name'], project1['name'] )
 
+	def test_api_neighborhood_query_count(self):
+		"""Ensures the number of queries does not grow with the
+		number of projects returned"""
+
+		statements = []
+		def count_statement(*args):
+			statements.append(args)
+
+		event.listen(db.engine, 'before_cursor_execute', count_statement)
+		try:
+			with app.test_client() as client:
+				client.get("""api/neighborhood?north=49.376019219200614&south=49.107045276672984&east=-122.75234442225093&west=-123.5310004281103""")
+				single_count = len(statements)
+
+				for i in range(5):
+					project = Project(**project2, user_id=self.user.id)
+					project.tags = [self.tag1]
+					db.session.add(project)
+				db.session.commit()
+
+				statements.clear()
+				resp = client.get("""api/neighborhood?north=49.376019219200614&south=49.107045276672984&east=-122.75234442225093&west=-123.5310004281103""")
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+		self.assertEqual(len(resp.json['projects']), 6)
+		for project in resp.json['projects']:
+			self.assertEqual(project['tags'], ['glass art'])
+		self.assertEqual(len(statements), single_count)
+
+	def test_api_neighborhood_cached(self):
+		"""Ensures a repeated viewport is answered without queries until
+		a project inside it changes"""
+
+		statements = []
+		def count_statement(*args):
+			statements.append(args)
+
+		url = """api/neighborhood?north=49.376019219200614&south=49.107045276672984&east=-122.75234442225093&west=-123.5310004281103"""
+		with app.test_client() as client:
+			client.get(url)
+			event.listen(db.engine, 'before_cursor_execute', count_statement)
+			try:
+				cached = client.get(url)
+				self.assertEqual(len(statements), 0)
+
+				project = Project.query.get(self.project1_id)
+				project.name = 'Renamed'
+				db.session.commit()
+				statements.clear()
+				resp = client.get(url)
+			finally:
+				event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+		self.assertEqual(cached.json['projects'][0]['name'], project1['name'])
+		self.assertTrue(len(statements) > 0)
+		self.assertEqual(resp.json['projects'][0]['name'], 'Renamed')
+
+	def test_user_rename_keeps_indexes(self):
+		"""Ensures a display name change drops the cached neighborhoods
+		but not the tag and text indexes"""
+
+		url = """api/neighborhood?north=49.376019219200614&south=49.107045276672984&east=-122.75234442225093&west=-123.5310004281103"""
+		with app.test_client() as client:
+			client.get(url)
+			tag_index.usage(['glass art'])
+			text_index.search('glass')
+			tag_data, text_data = tag_index._data, text_index._data
+
+			user = User.query.get(self.user.id)
+			user.display_name = 'renamed'
+			db.session.commit()
+			resp = client.get(url)
+
+		self.assertIs(tag_index._data, tag_data)
+		self.assertIs(text_index._data, text_data)
+		self.assertEqual(resp.json['projects'][0]['display_name'], 'renamed')
+
+	def test_api_neighborhood_clusters(self):
+		"""Ensures dense viewports are returned as clusters"""
+
+		app.config['CLUSTER_THRESHOLD'] = 0
+		try:
+			with app.test_client() as client:
+				resp = client.get("""api/neighborhood?north=49.376019219200614&south=49.107045276672984&east=-122.75234442225093&west=-123.5310004281103&zoom=3""")
+		finally:
+			app.config['CLUSTER_THRESHOLD'] = 200
+
+		self.assertEqual(resp.status_code, 200)
+		data = resp.json
+		self.assertEqual(data['projects'], [])
+		self.assertEqual(data['clusters'][0]['count'], 1)
+		self.assertEqual(data['clusters'][0]['ids'], [self.project1_id])
+		self.assertAlmostEqual(data['clusters'][0]['lat'], project1['lat'])
+
+	def test_api_neighborhood_sparse_zoom(self):
+		"""Ensures sparse viewports list projects even when zoom is given"""
+
+		with app.test_client() as client:
+			resp = client.get("""api/neighborhood?north=49.376019219200614&south=49.107045276672984&east=-122.75234442225093&west=-123.5310004281103&zoom=3""")
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual(resp.json['clusters'], [])
+			self.assertEqual(resp.json['projects'][0]['name'], project1['name'])
+
+	def test_api_neighborhood_sparse_zoom_skips_clusters(self):
+		"""Ensures sparse viewports are counted first and never clustered"""
+
+		statements = []
+		def record(conn, cursor, statement, parameters, context, executemany):
+			statements.append(statement)
+
+		event.listen(db.engine, 'before_cursor_execute', record)
+		try:
+			with app.test_client() as client:
+				resp = client.get("""api/tiles/3/1/2""")
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', record)
+
+		self.assertEqual(resp.json['total'], 1)
+		self.assertFalse([statement for statement in statements if 'GROUP BY' in statement])
+		self.assertEqual(len(statements), 3)
+
+	def test_api_neighborhood_pages(self):
+		"""Ensures projects are paged nearest first with a cursor"""
+
+		for i in range(5):
+			db.session.add(Project(**{**project2,
+				'lat': project2['lat'] + 0.01 * (i + 1),
+				'long': project2['long']}, user_id=self.user.id))
+		db.session.commit()
+
+		url = """api/neighborhood?north=49.376019219200614&south=49.107045276672984&east=-122.75234442225093&west=-123.5310004281103&limit=2"""
+		ids = []
+		with app.test_client() as client:
+			resp = client.get(url)
+			self.assertEqual(resp.json['total'], 6)
+			self.assertTrue(resp.json['total_exact'])
+			while True:
+				self.assertTrue(len(resp.json['projects']) <= 2)
+				ids.extend(project['id'] for project in resp.json['projects'])
+				cursor = resp.json['next_cursor']
+				if not cursor:
+					break
+				resp = client.get(url + "&cursor=" + cursor)
+
+		centre = (49.376019219200614 + 49.107045276672984) / 2
+		distances = [abs(Project.query.get(id).lat - centre) for id in ids]
+		self.assertEqual(len(set(ids)), 6)
+		self.assertEqual(distances, sorted(distances))
+
+	def test_api_neighborhood_bad_cursor(self):
+		"""Ensures an invalid cursor is rejected"""
+
+		with app.test_client() as client:
+			resp = client.get("""api/neighborhood?north=10&south=9&east=11&west=10&cursor=nonsense""")
+
+			self.assertEqual(resp.status_code, 400)
+
+	def test_api_neighborhood_tags(self):
+		"""Ensures projects can be filtered by any or all of their tags"""
+
+		t2 = Tag(name='green living')
+		project = Project(**project2, user_id=self.user.id)
+		project.tags = [self.tag1, t2]
+		db.session.add(project)
+		db.session.commit()
+		project_id = project.id
+
+		url = """api/neighborhood?north=49.376019219200614&south=49.107045276672984&east=-122.75234442225093&west=-123.5310004281103"""
+		statements = []
+		def record(conn, cursor, statement, parameters, context, executemany):
+			statements.append(statement)
+
+		try:
+			# The second pass has too many points to hold and filters tags in SQL
+			for max_points in [100000, 0]:
+				app.config['NEIGHBORHOOD_MAX_POINTS'] = max_points
+				neighborhood_cache.clear()
+				project = Project.query.get(project_id)
+				project.tags = [Tag.query.get('glass art'), Tag.query.get('green living')]
+				db.session.commit()
+
+				event.listen(db.engine, 'before_cursor_execute', record)
+				with app.test_client() as client:
+					any_ids = [each['id'] for each in
+						client.get(url + "&tags=glass art|green living").json['projects']]
+					all_ids = [each['id'] for each in
+						client.get(url + "&tags=glass art|green living&tag_match=all").json['projects']]
+				event.remove(db.engine, 'before_cursor_execute', record)
+
+				project = Project.query.get(project_id)
+				project.tags = [Tag.query.get('glass art')]
+				db.session.commit()
+				with app.test_client() as client:
+					edited_ids = [each['id'] for each in
+						client.get(url + "&tags=green living").json['projects']]
+
+				self.assertEqual(sorted(any_ids), sorted([self.project1_id, project_id]))
+				self.assertEqual(all_ids, [project_id])
+				self.assertEqual(edited_ids, [])
+		finally:
+			app.config['NEIGHBORHOOD_MAX_POINTS'] = 100000
+
+		self.assertFalse([statement for statement in statements
+			if 'projects.id IN' in statement and 'projects.cell' in statement])
+
+	def test_api_neighborhood_outside_bounds(self):
+		"""Ensures projects outside the viewport are not returned"""
+
+		with app.test_client() as client:
+			resp = client.get("""api/neighborhood?north=10&south=9&east=11&west=10""")
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual(resp.json['projects'], [])
+
+	def test_api_neighborhood_exact_bounds(self):
+		"""Ensures projects inside the cached widened bounds but outside
+		the viewport are neither returned nor counted, clustered or not"""
+
+		level, bounds = snap_bounds(49.2, 49.15, -123.05, -123.1)
+		outside = Project(**{**project2, 'lat': 49.205, 'long': -123.07}, user_id=self.user.id)
+		inside = Project(**{**project2, 'lat': 49.17, 'long': -123.07}, user_id=self.user.id)
+		db.session.add_all([outside, inside])
+		db.session.commit()
+		inside_id = inside.id
+		self.assertTrue(bounds[1] <= outside.lat < bounds[0])
+
+		url = "api/neighborhood?north=49.2&south=49.15&east=-123.05&west=-123.1"
+		app.config['CLUSTER_THRESHOLD'] = 0
+		try:
+			# The second pass has too many points to hold and queries the viewport
+			for max_points in [100000, 0]:
+				app.config['NEIGHBORHOOD_MAX_POINTS'] = max_points
+				neighborhood_cache.clear()
+				with app.test_client() as client:
+					listed = client.get(url).json
+					clustered = client.get(url + "&zoom=12").json
+
+				self.assertEqual([project['id'] for project in listed['projects']],
+					[self.project1_id, inside_id])
+				self.assertEqual(listed['total'], 2)
+				self.assertEqual(clustered['total'], 2)
+				self.assertEqual(sorted(id for cluster in clustered['clusters'] for id in cluster['ids']),
+					sorted([self.project1_id, inside_id]))
+		finally:
+			app.config['CLUSTER_THRESHOLD'] = 200
+			app.config['NEIGHBORHOOD_MAX_POINTS'] = 100000
+
+	def test_api_neighborhood_after_move(self):
+		"""Ensures an edited project is found at its new location"""
+
+		project = Project.query.get(self.project1_id)
+		project.lat = 9.5
+		project.long = 10.5
+		db.session.commit()
+
+		with app.test_client() as client:
+			resp = client.get("""api/neighborhood?north=10&south=9&east=11&west=10""")
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual(resp.json['projects'][0]['id'], self.project1_id)
+
+class APINearestTestCase(TestCase):
+	"""Tests for api nearest"""
+
+	def setUp(self):
+		"""Make demo data."""
+
+		db.drop_all()
+		db.create_all()
+		user = User(**user_data)
+		db.session.add(user)
+		db.session.commit()
+		self.user = user
+
+		self.project_ids = []
+		for offset in [3, 0.5, 40, 1]:
+			project = Project(**{**project2, 'lat': user_data['lat'] + offset},
+				user_id=user.id)
+			db.session.add(project)
+			db.session.commit()
+			self.project_ids.append(project.id)
+
+	def tearDown(self):
+		"""Clean up fouled transactions."""
+
+		db.session.rollback()
+
+	def test_api_nearest(self):
+		"""Ensures the nearest projects are returned nearest first"""
+
+		with app.test_client() as client:
+			resp = client.get(f"/api/nearest?k=3&lat={user_data['lat']}&long={user_data['long']}")
+
+			self.assertEqual(resp.status_code, 200)
+			projects = resp.json['projects']
+			self.assertEqual([project['id'] for project in projects],
+				[self.project_ids[1], self.project_ids[3], self.project_ids[0]])
+			self.assertAlmostEqual(projects[0]['distance_km'], 55.6, places=0)
+
+	def test_api_nearest_user_location(self):
+		"""Ensures the logged in user's location is used by default and
+		the search widens until far projects are found"""
+
+		with app.test_client() as client:
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.user.id
+			resp = client.get("/api/nearest?k=10")
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual(len(resp.json['projects']), 4)
+			self.assertEqual(resp.json['projects'][-1]['id'], self.project_ids[2])
+
+	def test_api_nearest_no_location(self):
+		"""Ensures a location is required"""
+
+		with app.test_client() as client:
+			resp = client.get("/api/nearest")
+
+			self.assertEqual(resp.status_code, 400)
+
+class APISearchTestCase(TestCase):
+	"""Tests for api search"""
+
+	def setUp(self):
+		"""Make demo data."""
+
+		db.drop_all()
+		db.create_all()
+		user = User(**user_data)
+		db.session.add(user)
+		db.session.commit()
+		self.user = user
+
+		p1 = Project(**project1, user_id=user.id)
+		p2 = Project(**{**project2, 'lat': 10, 'long': 10}, user_id=user.id)
+		db.session.add_all([p1, p2])
+		db.session.commit()
+		self.project1_id = p1.id
+		self.project2_id = p2.id
+
+	def tearDown(self):
+		"""Clean up fouled transactions."""
+
+		db.session.rollback()
+
+	def test_api_search(self):
+		"""Ensures projects are found by words in their name or description"""
+
+		with app.test_client() as client:
+			resp = client.get("/api/search?q=Glass")
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual([each['id'] for each in resp.json['projects']], [self.project1_id])
+
+	def test_api_search_ranking(self):
+		"""Ensures projects matching more of the words rank first"""
+
+		with app.test_client() as client:
+			resp = client.get("/api/search?q=compost glass window")
+
+			self.assertEqual([each['id'] for each in resp.json['projects']],
+				[self.project1_id, self.project2_id])
+
+	def test_api_search_bounds(self):
+		"""Ensures searches can be limited to the map viewport"""
+
+		with app.test_client() as client:
+			resp = client.get("/api/search?q=compost glass&north=11&south=9&east=11&west=9")
+
+			self.assertEqual([each['id'] for each in resp.json['projects']], [self.project2_id])
+
+	def test_api_search_bounds_chunked(self):
+		"""Ensures viewports too large to cache are checked a few hits at a time"""
+
+		try:
+			app.config['NEIGHBORHOOD_MAX_POINTS'] = 0
+			app.config['SEARCH_CANDIDATE_CHUNK'] = 1
+			neighborhood_cache.clear()
+			with app.test_client() as client:
+				resp = client.get("/api/search?q=compost glass&north=11&south=9&east=11&west=9")
+
+				self.assertEqual([each['id'] for each in resp.json['projects']], [self.project2_id])
+		finally:
+			app.config['NEIGHBORHOOD_MAX_POINTS'] = 100000
+			app.config['SEARCH_CANDIDATE_CHUNK'] = 500
+			neighborhood_cache.clear()
+
+	def test_api_search_after_edit(self):
+		"""Ensures edited descriptions are searchable right away"""
+
+		with app.test_client() as client:
+			client.get("/api/search?q=mosaic")
+			project = Project.query.get(self.project2_id)
+			project.description = 'A tile mosaic for the garden'
+			db.session.commit()
+			resp = client.get("/api/search?q=mosaic")
+
+			self.assertEqual([each['id'] for each in resp.json['projects']], [self.project2_id])
+
+class APITilesTestCase(TestCase):
+	"""Tests for api tiles"""
+
+	def setUp(self):
+		"""Make demo data."""
+
+		db.drop_all()
+		db.create_all()
+		user = User(**user_data)
+		db.session.add(user)
+		db.session.commit()
+
+		p1 = Project(
+			**project1,
+			user_id =user.id,
+		)
+		db.session.add(p1)
+		db.session.commit()
+		self.project1_id = p1.id
+
+		zoom = 10
+		lat = math.radians(project1['lat'])
+		self.tile_path = "/api/tiles/{}/{}/{}".format(zoom,
+			int((project1['long'] + 180) / 360 * 2 ** zoom),
+			int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * 2 ** zoom))
+
+	def tearDown(self):
+		"""Clean up fouled transactions."""
+
+		db.session.rollback()
+
+	def test_api_tile(self):
+		"""Ensures the tile holding a project returns it with cache headers"""
+
+		with app.test_client() as client:
+			resp = client.get(self.tile_path)
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual(resp.json['projects'][0]['id'], self.project1_id)
+			self.assertIn('max-age', resp.headers['Cache-Control'])
+			self.assertTrue(resp.headers['ETag'])
+
+	def test_api_tile_not_modified(self):
+		"""Ensures a repeated tile request with its ETag gets a 304"""
+
+		with app.test_client() as client:
+			etag = client.get(self.tile_path).headers['ETag']
+			resp = client.get(self.tile_path, headers={'If-None-Match': etag})
+
+			self.assertEqual(resp.status_code, 304)
+
+	def test_api_tile_out_of_range(self):
+		"""Ensures tiles outside the zoom level's grid are not found"""
+
+		with app.test_client() as client:
+			resp = client.get("/api/tiles/2/4/0")
+
+			self.assertEqual(resp.status_code, 404)
+
 class APITagsTestCase(TestCase):
 	"""Tests for api tags"""
 
@@ -772,4 +1483,1059 @@ class APITagsTestCase(TestCase):
 
 			self.assertEqual(resp.status_code, 200)
 			data = resp.json
-			self.assertEqual(data, ['glass art', 'renovations'] )
\ No newline at end of file
+			self.assertEqual(data, ['glass art', 'renovations'] )
+
+	def test_api_tags_complete(self):
+		"""Ensures tag prefixes are completed with the most used tags first"""
+
+		user = User(**user_data)
+		db.session.add(user)
+		db.session.commit()
+		Tag.create_tag('glassblowing')
+		Tag.create_tag('Glazing')
+		project = Project(**project1, user_id=user.id)
+		project.tags = Tag.resolve_names(['glazing', 'Glazing', 'glassblowing'])
+		db.session.add(project)
+		db.session.commit()
+
+		with app.test_client() as client:
+			resp = client.get("/api/tags/complete?prefix=GLA")
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual(resp.json, [{'name': 'Glazing', 'count': 1},
+				{'name': 'glassblowing', 'count': 1}, {'name': 'glazing', 'count': 1},
+				{'name': 'glass art', 'count': 0}])
+
+			resp = client.get("/api/tags/complete?prefix=glass art&limit=1")
+
+			self.assertEqual(resp.json, [{'name': 'glass art', 'count': 0}])
+
+	def test_resolve_names_multirow(self):
+		"""Ensures missing tags are inserted with multi-row statements"""
+
+		names = [f"tag{number}" for number in range(1500)]
+		inserts = []
+		def count(conn, cursor, statement, parameters, context, executemany):
+			if statement.lstrip().upper().startswith('INSERT'):
+				inserts.append(executemany)
+		event.listen(db.engine, 'before_cursor_execute', count)
+		try:
+			tags = Tag.resolve_names(names + ['glass art'])
+			db.session.commit()
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', count)
+
+		self.assertEqual([tag.name for tag in tags], names + ['glass art'])
+		self.assertEqual(inserts, [False, False])
+		self.assertEqual(Tag.query.count(), 1502)
+
+	def test_api_tags_not_modified(self):
+		"""Ensures unchanged tag lists are answered with a 304 and new
+		tags show up right away"""
+
+		with app.test_client() as client:
+			etag = client.get("/api/tags").headers['ETag']
+			resp = client.get("/api/tags", headers={'If-None-Match': etag})
+			self.assertEqual(resp.status_code, 304)
+
+			Tag.create_tag('woodworking')
+			resp = client.get("/api/tags", headers={'If-None-Match': etag})
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual(resp.json, ['glass art', 'renovations', 'woodworking'])
+
+class MatchmakerTestCase(TestCase):
+	"""Tests for the project recommendations"""
+
+	def setUp(self):
+		"""Make demo data."""
+
+		db.drop_all()
+		db.create_all()
+		seeker = User(**user_data)
+		helped = User(**user_data2)
+		db.session.add_all([seeker, helped])
+		db.session.commit()
+		self.seeker_id = seeker.id
+		self.helped_id = helped.id
+
+		glass = Tag(name='glass art')
+		own = Project(**project1, user_id=seeker.id, tags=[glass])
+		near = Project(**{**project2, 'lat': user_data['lat'] + 0.05}, user_id=helped.id)
+		tagged = Project(**{**project1, 'lat': user_data['lat'] + 0.2}, user_id=helped.id, tags=[glass])
+		far = Project(**{**project2, 'lat': user_data['lat'] + 5}, user_id=helped.id)
+		db.session.add_all([own, near, tagged, far])
+		db.session.commit()
+		self.own_id, self.near_id, self.tagged_id = own.id, near.id, tagged.id
+
+	def tearDown(self):
+		"""Clean up fouled transactions."""
+
+		db.session.rollback()
+
+	def test_rebuild_all(self):
+		"""Ensures nearby projects are ranked by distance and shared tags,
+		leaving out the user's own and far away projects"""
+
+		matchmaker.rebuild_all()
+
+		self.assertEqual([project_id for project_id, score in Recommendation.list_for_user(self.seeker_id)],
+			[self.tagged_id, self.near_id])
+		self.assertEqual([project_id for project_id, score in Recommendation.list_for_user(self.helped_id)],
+			[self.own_id])
+
+	def test_refresh_project(self):
+		"""Ensures new and deleted projects update existing recommendations"""
+
+		matchmaker.rebuild_all(top_n=1)
+		project = Project(**project2, user_id=self.helped_id, tags=[Tag.query.get('glass art')])
+		db.session.add(project)
+		db.session.commit()
+		matchmaker.refresh_project(project.id, top_n=1)
+
+		self.assertEqual(Recommendation.list_for_user(self.seeker_id)[0][0], project.id)
+		self.assertEqual(len(Recommendation.list_for_user(self.seeker_id)), 1)
+
+		affected = Recommendation.users_for_project(project.id)
+		db.session.delete(project)
+		db.session.commit()
+		matchmaker.refresh_users(affected, top_n=1)
+
+		self.assertEqual(Recommendation.list_for_user(self.seeker_id)[0][0], self.tagged_id)
+
+	def test_rebuild_all_replaces(self):
+		"""Ensures rebuilds replace the recommendations of each user, and
+		drop those of users no longer seeking projects"""
+
+		matchmaker.rebuild_all()
+		seeker = User.query.get(self.seeker_id)
+		seeker.seeking_project = False
+		db.session.commit()
+		statements = []
+		def record(conn, cursor, statement, parameters, context, executemany):
+			statements.append(' '.join(statement.split()))
+		event.listen(db.engine, 'before_cursor_execute', record)
+		try:
+			matchmaker.rebuild_all()
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', record)
+
+		self.assertEqual(Recommendation.list_for_user(self.seeker_id), [])
+		self.assertEqual([project_id for project_id, score in Recommendation.list_for_user(self.helped_id)],
+			[self.own_id])
+		self.assertFalse([statement for statement in statements
+			if statement.startswith('DELETE') and 'WHERE' not in statement])
+
+	def test_refresh_queue(self):
+		"""Ensures queued refreshes run on the background thread"""
+
+		queue = matchmaker.RefreshQueue(top_n=1)
+		queue.app = app
+		matchmaker.rebuild_all(top_n=1)
+		project = Project(**project2, user_id=self.helped_id, tags=[Tag.query.get('glass art')])
+		db.session.add(project)
+		db.session.commit()
+		queue.refresh_project(project.id)
+		queue.refresh_project(project.id)
+
+		self.assertTrue(queue.wait(5))
+		self.assertEqual(Recommendation.list_for_user(self.seeker_id)[0][0], project.id)
+
+	def test_api_recommendations(self):
+		"""Ensures the logged in user's recommendations are returned best first"""
+
+		matchmaker.rebuild_all()
+		with app.test_client() as client:
+			resp = client.get("/api/recommendations")
+			self.assertEqual(resp.status_code, 401)
+
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.seeker_id
+			resp = client.get("/api/recommendations")
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual([each['id'] for each in resp.json['projects']],
+				[self.tagged_id, self.near_id])
+			self.assertGreater(resp.json['projects'][0]['score'], resp.json['projects'][1]['score'])
+
+class PersistentCacheTestCase(TestCase):
+	"""Tests for the two tier persistent cache"""
+
+	def setUp(self):
+		"""Make a cache file."""
+
+		self.path = os.path.join(tempfile.mkdtemp(), 'cache.sqlite3')
+
+	def test_persistent_cache_restart(self):
+		"""Ensures values survive a new cache on the same file"""
+
+		PersistentCache(self.path, 10, 60).put('key', 'value')
+		cache = PersistentCache(self.path, 10, 60)
+
+		self.assertEqual(cache.get('key'), 'value')
+		self.assertEqual(len(cache), 1)
+		self.assertIsNone(cache.get('other'))
+
+	def test_persistent_cache_expiry(self):
+		"""Ensures values expire after the ttl in both tiers"""
+
+		cache = PersistentCache(self.path, 10, 0.01)
+		cache.put('key', 'value')
+		time.sleep(0.02)
+
+		self.assertIsNone(cache.get('key'))
+		self.assertIsNone(PersistentCache(self.path, 10, 0.01).get('key'))
+
+	def test_persistent_cache_memory_bound(self):
+		"""Ensures the in-memory tier keeps the most recently used entries"""
+
+		cache = PersistentCache(self.path, 2, 60)
+		cache.put('a', '1')
+		cache.put('b', '2')
+		cache.get('a')
+		cache.put('c', '3')
+
+		self.assertEqual(list(cache._entries), ['a', 'c'])
+		self.assertEqual(cache.get('b'), '2')
+
+	def test_normalize_address(self):
+		"""Ensures equivalent spellings of an address share a key"""
+
+		self.assertEqual(normalize_address(' 1 Main St.,  VANCOUVER '), '1 main st. vancouver')
+
+class StubGeocodeHandler(BaseHTTPRequestHandler):
+	"""Stub geocoding service answering with the queued statuses, after
+	a delay"""
+
+	statuses = []
+	delay = 0
+	hits = 0
+
+	def do_GET(self):
+		StubGeocodeHandler.hits += 1
+		time.sleep(StubGeocodeHandler.delay)
+		status = StubGeocodeHandler.statuses.pop(0) if StubGeocodeHandler.statuses else 200
+		body = json.dumps({'status': 'OK', 'results': [{'path': self.path}]}).encode()
+		try:
+			self.send_response(status)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		except (BrokenPipeError, ConnectionResetError):
+			pass
+
+	def log_message(self, *args):
+		pass
+
+class GeocodingClientTestCase(TestCase):
+	"""Tests for the geocoding client against a local stub service"""
+
+	def setUp(self):
+		"""Start the stub service."""
+
+		StubGeocodeHandler.statuses = []
+		StubGeocodeHandler.delay = 0
+		StubGeocodeHandler.hits = 0
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubGeocodeHandler)
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.url = f"http://127.0.0.1:{self.server.server_port}/geocode/json"
+		self.cache = PersistentCache(os.path.join(tempfile.mkdtemp(), 'cache.sqlite3'), 10, 60)
+
+	def tearDown(self):
+		"""Stop the stub service."""
+
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_geocoding_single_flight(self):
+		"""Ensures concurrent lookups of one address make one upstream call"""
+
+		StubGeocodeHandler.delay = 0.2
+		client = GeocodingClient(self.url, 'key', self.cache)
+		bodies = []
+		threads = [threading.Thread(target=lambda address=address: bodies.append(client.lookup(address)))
+			for address in ['1 Main St', '1 main st', '1  MAIN st', '1 Main St,']]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(StubGeocodeHandler.hits, 1)
+		self.assertEqual(len(set(bodies)), 1)
+		self.assertEqual(client.lookup('1 Main St'), bodies[0])
+		self.assertEqual(StubGeocodeHandler.hits, 1)
+
+	def test_geocoding_single_flight_quota(self):
+		"""Ensures lookups joining an upstream call are charged to their own
+		client only"""
+
+		StubGeocodeHandler.delay = 0.3
+		governor = QuotaGovernor(rate=0, burst=1, client_rate=0, client_burst=1)
+		client = GeocodingClient(self.url, 'key', self.cache, governor=governor)
+		bodies = []
+		leader = threading.Thread(target=lambda: bodies.append(client.lookup('1 Main St', 'a')))
+		leader.start()
+		time.sleep(0.1)
+
+		with self.assertRaises(GeocodingThrottled):
+			client.lookup('1 Main St', 'a')
+		body = client.lookup('1 Main St', 'b')
+		leader.join()
+
+		self.assertEqual(bodies, [body])
+		self.assertEqual(StubGeocodeHandler.hits, 1)
+		self.assertEqual(client.counters()['coalesced'], 1)
+
+	def test_geocoding_single_flight_error(self):
+		"""Ensures lookups joining an upstream call get its exception"""
+
+		client = GeocodingClient(self.url, 'key', self.cache)
+		def fetch(key, address):
+			time.sleep(0.3)
+			raise KeyError(address)
+		client._fetch = fetch
+		errors = []
+		def lookup():
+			try:
+				client.lookup('1 Main St')
+			except KeyError as error:
+				errors.append(error)
+		leader = threading.Thread(target=lookup)
+		leader.start()
+		time.sleep(0.1)
+
+		with self.assertRaises(KeyError):
+			client.lookup('1 Main St')
+		leader.join()
+		self.assertEqual(len(errors), 1)
+
+	def test_geocoding_retry(self):
+		"""Ensures failed upstream calls are retried"""
+
+		StubGeocodeHandler.statuses = [503]
+		client = GeocodingClient(self.url, 'key', self.cache, backoff=0.01)
+		body = json.loads(client.lookup('1 Main St'))
+
+		self.assertEqual(body['status'], 'OK')
+		self.assertEqual(StubGeocodeHandler.hits, 2)
+
+	def test_geocoding_timeout(self):
+		"""Ensures slow upstream calls fail after the read timeout"""
+
+		StubGeocodeHandler.delay = 0.5
+		client = GeocodingClient(self.url, 'key', self.cache, read_timeout=0.1, retries=0)
+
+		with self.assertRaises(GeocodingError):
+			client.lookup('1 Main St')
+		self.assertIsNone(self.cache.get(normalize_address('1 Main St')))
+
+	def test_geocoding_throttled(self):
+		"""Ensures lookups over quota are answered stale or refused"""
+
+		cache = PersistentCache(self.cache.path, 10, 0.01, max_stale=60)
+		governor = QuotaGovernor(rate=0, burst=1, client_rate=0, client_burst=1)
+		client = GeocodingClient(self.url, 'key', cache, governor=governor)
+		body = client.lookup('1 Main St', 'a')
+		time.sleep(0.02)
+
+		self.assertEqual(client.lookup('1 Main St', 'a'), body)
+		with self.assertRaises(GeocodingThrottled):
+			client.lookup('2 Main St', 'a')
+		self.assertEqual(StubGeocodeHandler.hits, 1)
+		self.assertEqual(client.counters(), {'local': 0, 'cached': 0, 'called': 1, 'coalesced': 0,
+			'throttled': 2, 'stale': 1, 'failed': 0})
+
+	def test_geocoding_gazetteer(self):
+		"""Ensures places in the gazetteer are answered without calling
+		the service"""
+
+		path = os.path.join(tempfile.mkdtemp(), 'places.tsv')
+		with open(path, 'w', encoding='utf-8') as file:
+			file.write("# name\tlat\tlong\nVancouver\t49.2827\t-123.1207\n"
+				"V6B 1A1\t49.28\t-123.11\nvancouver\t45.6\t-122.6\n")
+		gazetteer = Gazetteer.load(path)
+		client = GeocodingClient(self.url, 'key', self.cache, local=gazetteer)
+
+		self.assertEqual(len(gazetteer), 2)
+		location = json.loads(client.lookup(' VANCOUVER '))['results'][0]['geometry']['location']
+		self.assertEqual(location, {'lat': 49.2827, 'lng': -123.1207})
+		self.assertEqual(json.loads(client.lookup('v6b 1a1'))['results'][0]['formatted_address'], 'V6B 1A1')
+		self.assertEqual(StubGeocodeHandler.hits, 0)
+
+		client.lookup('Burnaby')
+		self.assertEqual(StubGeocodeHandler.hits, 1)
+		self.assertEqual(client.counters()['local'], 2)
+
+class QuotaGovernorTestCase(TestCase):
+	"""Tests for the geocoding quota governor"""
+
+	def setUp(self):
+		"""Make a governor on a fake clock."""
+
+		self.now = 0
+		self.governor = QuotaGovernor(rate=1, burst=3, client_rate=0.5, client_burst=2,
+			clock=lambda: self.now)
+
+	def test_quota_client_fairness(self):
+		"""Ensures one client cannot use up the shared budget"""
+
+		self.assertEqual([self.governor.admit('a') for each in range(3)], [0, 0, 2])
+		self.assertEqual(self.governor.admit('b'), 0)
+		self.assertGreater(self.governor.admit('c'), 0)
+
+	def test_quota_refill(self):
+		"""Ensures tokens are refilled over time"""
+
+		self.governor.admit('a')
+		self.governor.admit('a')
+		self.now = 2
+
+		self.assertEqual(self.governor.admit('a'), 0)
+
+class ImporterTestCase(TestCase):
+	"""Tests for the bulk project importer"""
+
+	def setUp(self):
+		"""Make demo data."""
+
+		db.drop_all()
+		db.create_all()
+		user = User(**user_data)
+		db.session.add(user)
+		db.session.add(Tag(name='glass art'))
+		db.session.commit()
+		self.user_id = user.id
+
+	def tearDown(self):
+		"""Clean up fouled transactions."""
+
+		db.session.rollback()
+
+	def test_import_csv(self):
+		"""Ensures valid rows are imported in chunks with their tags, and
+		added to the indexes, and invalid rows rejected"""
+
+		lines = io.StringIO(
+			"name,description,contact_info_type,contact_info,lat,long,work_start,tags\n"
+			"Mural,Paint a wall,email,a@b.c,49.2,-123.1,2021-05-01,painting|glass art\n"
+			",No name,email,a@b.c,49.2,-123.1,,\n"
+			"Bench,Build a bench,email,a@b.c,95,-123.1,,\n"
+			"Shed,Build a shed,email,a@b.c,49.3,-123.2,,woodworking|painting|woodworking\n"
+			"Kiln,Fire pottery,email,a@b.c,49.4,-123.3,,\n")
+		rejects = []
+		progress = []
+
+		with app.test_client() as client:
+			client.get("/api/tags")
+			tag_index.usage(['painting'])
+			text_index.search('shed')
+			tag_data, text_data = tag_index._data, text_index._data
+			report = import_projects(lines, 'csv', self.user_id, chunk_size=2,
+				on_reject=rejects.append, on_progress=progress.append)
+			tags = client.get("/api/tags").json
+
+		self.assertEqual((report['rows'], report['imported'], report['rejected']), (5, 3, 2))
+		self.assertEqual([(reject['line'], list(reject['errors'])) for reject in rejects],
+			[(3, ['name']), (4, ['lat'])])
+		self.assertEqual(len(progress), 2)
+		self.assertEqual(tags, ['glass art', 'painting', 'woodworking'])
+
+		shed = Project.query.filter_by(name='Shed').one()
+		self.assertEqual([tag.name for tag in shed.tags], ['woodworking', 'painting'])
+		self.assertEqual(shed.cell, cell_key(49.3, -123.2))
+		self.assertEqual(str(Project.query.filter_by(name='Mural').one().work_start), '2021-05-01')
+		self.assertIs(tag_index._data, tag_data)
+		self.assertIs(text_index._data, text_data)
+		self.assertEqual(tag_index.usage(['painting']), {'painting': 2})
+		self.assertEqual(list(text_index.search('shed')), [shed.id])
+
+	def test_api_import(self):
+		"""Ensures NDJSON uploads are imported for the logged in user only"""
+
+		body = "\n".join([
+			json.dumps({**project2, 'user_id': self.user_id + 1, 'tags': ['compost']}),
+			"not json",
+			""])
+		neighbor = User(**user_data2, seeking_project=True)
+		db.session.add(neighbor)
+		db.session.commit()
+		neighbor_id = neighbor.id
+
+		with app.test_client() as client:
+			resp = client.post("/api/projects/import", data=body, content_type='application/x-ndjson')
+			self.assertEqual(resp.status_code, 401)
+
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.user_id
+			resp = client.post("/api/projects/import", data=body, content_type='application/x-ndjson')
+
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual((resp.json['imported'], resp.json['rejected']), (1, 1))
+			self.assertEqual(resp.json['rejected_rows'][0]['line'], 2)
+			project = Project.query.filter_by(name=project2['name']).one()
+			self.assertEqual(project.user_id, self.user_id)
+
+			resp = client.get("/api/neighborhood?north=50&south=49&east=-123&west=-124")
+			self.assertEqual([each['id'] for each in resp.json['projects']], [project.id])
+			self.assertEqual([project_id for project_id, score in Recommendation.list_for_user(neighbor_id)],
+				[project.id])
+
+	def test_api_import_checks_request(self):
+		"""Ensures uploads without a CSRF token or of another content type
+		are refused, and those with the session's token accepted"""
+
+		body = json.dumps({**project2, 'tags': ['compost']})
+		with app.test_client() as client:
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.user_id
+			resp = client.post("/api/projects/import", data=body, content_type='application/json')
+			self.assertEqual(resp.status_code, 415)
+
+			app.config['WTF_CSRF_ENABLED'] = True
+			try:
+				resp = client.post("/api/projects/import", data=body, content_type='application/x-ndjson')
+				self.assertEqual(resp.status_code, 400)
+				resp = client.post("/api/projects/import", data=body, content_type='application/x-ndjson',
+					headers={'X-CSRFToken': 'forged'})
+				self.assertEqual(resp.status_code, 400)
+
+				html = client.get("/project/new").get_data(as_text=True)
+				token = re.search(r'csrf_token" type="hidden" value="([^"]+)"', html).group(1)
+				resp = client.post("/api/projects/import", data=body, content_type='application/x-ndjson',
+					headers={'X-CSRFToken': token})
+				self.assertEqual(resp.status_code, 200)
+			finally:
+				app.config['WTF_CSRF_ENABLED'] = False
+
+		self.assertEqual(Project.query.filter_by(name=project2['name']).count(), 1)
+
+	def test_import_command(self):
+		"""Ensures the CLI writes rejected rows to a side file"""
+
+		path = os.path.join(tempfile.mkdtemp(), 'projects.csv')
+		with open(path, 'w') as file:
+			file.write("name,description,contact_info_type,contact_info,lat,long\n"
+				"Mural,Paint a wall,email,a@b.c,49.2,-123.1\n"
+				"Bench,,email,a@b.c,49.2,-123.1\n")
+
+		result = app.test_cli_runner().invoke(args=['import-projects', path,
+			'--user-id', str(self.user_id)])
+
+		self.assertEqual(result.exit_code, 0, result.output)
+		self.assertIn("Imported 1 of 2 rows", result.output)
+		with open(path + '.rejects.ndjson') as file:
+			self.assertEqual(json.loads(file.readline())['errors'], {'description': ['This field is required.']})
+
+class SyntheticDataTestCase(TestCase):
+	"""Tests for the synthetic data generator"""
+
+	def setUp(self):
+		"""Start from empty tables."""
+
+		db.drop_all()
+		db.create_all()
+
+	def tearDown(self):
+		"""Clean up fouled transactions."""
+
+		db.session.rollback()
+
+	def dump(self):
+		"""Returns the generated rows without their ids."""
+
+		projects = db.session.query(Project.name, Project.description, Project.lat,
+			Project.long, Project.cell).order_by(Project.id).all()
+		users = db.session.query(User.email, User.lat, User.long,
+			User.seeking_project, User.seeking_help).order_by(User.id).all()
+		return projects, users
+
+	def test_generate(self):
+		"""Ensures the requested rows are added near the cities with
+		valid cells, owners and tags"""
+
+		counts = synthetic.generate(users=50, projects=120, tags=40, seed=7)
+
+		self.assertEqual(User.query.count(), 50)
+		self.assertEqual(Project.query.count(), 120)
+		self.assertEqual(Tag.query.count(), 40)
+		self.assertEqual(counts['project_tags'], sum(len(project.tags) for project in Project.query))
+
+		for project in Project.query:
+			self.assertEqual(project.cell, cell_key(project.lat, project.long))
+			self.assertIsNotNone(project.user)
+			self.assertTrue(min(haversine_km(project.lat, project.long,
+				[city.lat for city in synthetic.DEFAULT_CITIES],
+				[city.long for city in synthetic.DEFAULT_CITIES])) < 200)
+
+		user = User.signup({'first_name': 'New', 'display_name': 'new', 'email': 'new@test.com',
+			'password': 'password', 'lat': 49.2, 'long': -123.1})
+		self.assertEqual(user.id, 51)
+		self.assertEqual(User.login('user1@example.com', 'password').id, 1)
+
+	def test_generate_deterministic(self):
+		"""Ensures the same seed generates the same rows and another seed
+		different ones"""
+
+		synthetic.generate(users=30, projects=60, tags=20, seed=3)
+		first = self.dump()
+
+		db.drop_all()
+		db.create_all()
+		synthetic.generate(users=30, projects=60, tags=20, seed=3)
+		self.assertEqual(self.dump(), first)
+
+		db.drop_all()
+		db.create_all()
+		synthetic.generate(users=30, projects=60, tags=20, seed=4)
+		self.assertNotEqual(self.dump(), first)
+
+	def test_zipf_tags(self):
+		"""Ensures the most common tags are far more used than rare ones"""
+
+		synthetic.generate(users=100, projects=1000, tags=200, seed=1)
+		usage = dict(db.session.query(Tag.name, db.func.count()).join(Tag.projects
+			).group_by(Tag.name).all())
+		vocabulary = synthetic.tag_vocabulary(200)
+
+		self.assertTrue(usage[vocabulary[0]] > 10 * usage.get(vocabulary[-1], 0))
+		self.assertTrue(len(usage) > 50)
+
+
+class QueryInstrumentationTestCase(TestCase):
+	"""Tests for the per-request SQL instrumentation"""
+
+	def setUp(self):
+		"""Make demo data."""
+
+		db.drop_all()
+		db.create_all()
+		user = User(**user_data)
+		db.session.add(user)
+		db.session.commit()
+		project = Project(user_id=user.id, **project1)
+		db.session.add(project)
+		db.session.commit()
+		self.project_id = project.id
+		query_instrumentation.reset()
+		query_instrumentation.headers = True
+
+	def tearDown(self):
+		"""Turn the headers off again."""
+
+		query_instrumentation.headers = False
+		db.session.rollback()
+
+	def test_request_headers(self):
+		"""Ensures each response reports its own queries"""
+
+		with app.test_client() as client:
+			resp = client.get(f"/project/{self.project_id}")
+			tags = client.get("/api/tags")
+
+		self.assertEqual(resp.status_code, 200)
+		self.assertTrue(int(resp.headers['X-SQL-Queries']) >= 1)
+		self.assertIn(' SELECT ', resp.headers['X-SQL-Slowest'])
+		self.assertNotIn('\n', resp.headers['X-SQL-Slowest'])
+		self.assertIn('db;dur=', resp.headers['Server-Timing'])
+		self.assertTrue(int(tags.headers['X-SQL-Queries']) <= 1)
+
+	def test_metrics(self):
+		"""Ensures /metrics aggregates the requests of each endpoint in
+		the Prometheus text format"""
+
+		with app.test_client() as client:
+			client.get(f"/project/{self.project_id}")
+			first = int(client.get(f"/project/{self.project_id}").headers['X-SQL-Queries'])
+			client.get("/no-such-page")
+			resp = client.get("/metrics")
+
+		stats = query_instrumentation.endpoints()['project_detail']
+		text = resp.get_data(as_text=True)
+		self.assertEqual(resp.status_code, 200)
+		self.assertTrue(resp.content_type.startswith('text/plain; version=0.0.4'))
+		self.assertEqual(stats.requests, 2)
+		self.assertTrue(stats.queries >= first)
+		self.assertIn('http_requests_total{endpoint="project_detail"} 2', text)
+		self.assertIn('http_requests_total{endpoint="unmatched"} 1', text)
+		self.assertIn('sql_slowest_seconds{endpoint="project_detail"}', text)
+		self.assertNotIn('SELECT', text)
+		self.assertIn('geocoder_lookups_total{result="cached"}', text)
+
+	def test_metrics_allowed_addresses(self):
+		"""Ensures /metrics is only answered to the allowed addresses"""
+
+		with app.test_client() as client:
+			resp = client.get("/metrics", environ_base={'REMOTE_ADDR': '203.0.113.9'})
+
+		self.assertEqual(resp.status_code, 404)
+
+	def test_metrics_count_errors(self):
+		"""Ensures requests failing with an unhandled error are counted"""
+
+		def fail(project_ids):
+			raise RuntimeError("query failed")
+		summaries = Project.__dict__['query_summaries']
+		Project.query_summaries = fail
+		try:
+			with app.test_client() as client:
+				with self.assertRaises(RuntimeError):
+					client.get("/api/search?q=glass")
+		finally:
+			Project.query_summaries = summaries
+
+		self.assertEqual(query_instrumentation.endpoints()['api_search'].requests, 1)
+
+
+class SlowQueryLogTestCase(TestCase):
+	"""Tests for the slow query log"""
+
+	def setUp(self):
+		"""Make demo data and log every statement."""
+
+		db.drop_all()
+		db.create_all()
+		user = User(**user_data)
+		db.session.add(user)
+		db.session.commit()
+		project = Project(user_id=user.id, **project1)
+		db.session.add(project)
+		db.session.commit()
+		self.user_id = user.id
+		self.project_id = project.id
+		slow_query_log.use_file(os.path.join(tempfile.mkdtemp(), 'slow-queries.log'))
+		self.threshold = slow_query_log.threshold
+		slow_query_log.threshold = 0
+
+	def tearDown(self):
+		"""Restore the threshold."""
+
+		slow_query_log.threshold = self.threshold
+		db.session.rollback()
+
+	def read_log(self):
+		for handler in slow_query_log.logger.handlers:
+			handler.flush()
+		with open(slow_query_log.path, encoding='utf-8') as file:
+			return file.read()
+
+	def test_log_request_statements(self):
+		"""Ensures slow statements are logged with their parameters, route
+		and user, and explained once per fingerprint"""
+
+		with app.test_client() as client:
+			with client.session_transaction() as change_session:
+				change_session['CURR_USER_KEY'] = self.user_id
+			client.get(f"/project/{self.project_id}")
+			client.get(f"/project/{self.project_id}")
+
+		log = self.read_log()
+		entries = [entry for entry in log.split('\n') if 'route=GET /project/' in entry]
+		self.assertTrue(entries)
+		self.assertTrue(all(entry.endswith(f"(project_detail) user={self.user_id}") for entry in entries))
+		self.assertIn('FROM projects', log)
+		self.assertIn(f"parameters: ({self.project_id},", log)
+		plans = log.count('plan:')
+		self.assertTrue(0 < plans < len(entries))
+		self.assertTrue(any('projects' in plan.split('\n')[1] for plan in log.split('plan:')[1:]))
+
+	def test_log_redacts_parameters(self):
+		"""Ensures passwords, emails and contact info are left out of the
+		logged parameters"""
+
+		with app.test_client() as client:
+			client.post("/login", data={'form-user-login-email': user_data['email'],
+				'form-user-login-password': 'password'})
+		Project.query.filter_by(contact_info=user_data['email']).all()
+		User.query.filter_by(password=user_data['password']).all()
+
+		log = self.read_log()
+		self.assertIn("parameters: ('***',", log)
+		self.assertNotIn(user_data['email'], log)
+		self.assertNotIn(user_data['password'], log)
+
+	def test_executemany_not_explained(self):
+		"""Ensures statements are explained the first time they run alone"""
+
+		key = fingerprint("INSERT INTO tags (name) VALUES (?)")
+		slow_query_log._explained.clear()
+		db.session.execute(Tag.__table__.insert(), [{'name': 'a'}, {'name': 'b'}])
+		self.assertNotIn(key, slow_query_log._explained)
+
+		db.session.execute(Tag.__table__.insert(), {'name': 'c'})
+		db.session.commit()
+		self.assertIn(key, slow_query_log._explained)
+		self.assertEqual(self.read_log().count('plan:'), 1)
+
+	def test_threshold(self):
+		"""Ensures statements under the threshold are not logged"""
+
+		slow_query_log.threshold = 60
+		with app.test_client() as client:
+			client.get(f"/project/{self.project_id}")
+
+		self.assertFalse(os.path.exists(slow_query_log.path) and self.read_log())
+
+	def test_fingerprint(self):
+		"""Ensures fingerprints ignore literals and IN list lengths"""
+
+		self.assertEqual(fingerprint("SELECT * FROM t WHERE id IN (%(id_1)s, %(id_2)s)"),
+			fingerprint("SELECT * FROM t\nWHERE id IN (%(id_1)s)"))
+		self.assertEqual(fingerprint("SELECT * FROM t WHERE name = 'a' LIMIT 10"),
+			fingerprint("SELECT * FROM t WHERE name = 'b' LIMIT 20"))
+		self.assertNotEqual(fingerprint("SELECT * FROM t"), fingerprint("SELECT * FROM u"))
+
+
+class BenchmarkCompareTestCase(TestCase):
+	"""Tests for the benchmark baseline comparison"""
+
+	def test_compare(self):
+		"""Ensures timings regress past the relative threshold and query
+		counts past their absolute slack"""
+
+		baseline = {'1000': {'GET /api/tags': {'p50_ms': 10, 'p95_ms': 20, 'queries': 1, 'alloc_kib': 50}}}
+		results = {'1000': {'GET /api/tags': {'p50_ms': 12, 'p95_ms': 30, 'queries': 2, 'alloc_kib': 55}},
+			'5000': {'GET /api/tags': {'p50_ms': 99, 'p95_ms': 99, 'queries': 9, 'alloc_kib': 99}}}
+
+		regressions = bench.compare(results, baseline, 0.25)
+
+		self.assertEqual(len(regressions), 2)
+		self.assertIn('p95_ms', regressions[0])
+		self.assertIn('queries', regressions[1])
+		self.assertEqual(bench.compare(results, baseline, 1), regressions[1:])
+
+
+class PasswordHasherTestCase(TestCase):
+	"""Tests for password hashing off the request thread"""
+
+	def setUp(self):
+		"""Make demo data."""
+
+		db.drop_all()
+		db.create_all()
+		user = User(**user_data)
+		db.session.add(user)
+		db.session.commit()
+		self.user_id = user.id
+
+	def tearDown(self):
+		"""Clean up fouled transactions."""
+
+		db.session.rollback()
+
+	def test_login_rehash(self):
+		"""Ensures hashes made with fewer rounds than configured are
+		upgraded on login"""
+
+		password_hasher.rounds = 5
+		try:
+			self.assertTrue(User.login(user_data['email'], 'password'))
+			self.assertTrue(User.query.get(self.user_id).password.startswith('$2b$12$'))
+
+			user = User.query.get(self.user_id)
+			user.password = bcrypt.generate_password_hash('password', 4).decode('UTF-8')
+			db.session.commit()
+			self.assertTrue(User.login(user_data['email'], 'password'))
+			self.assertTrue(User.query.get(self.user_id).password.startswith('$2b$05$'))
+			self.assertTrue(User.login(user_data['email'], 'password'))
+			self.assertFalse(User.login(user_data['email'], 'wrong'))
+		finally:
+			password_hasher.rounds = 4
+
+	def test_hasher_busy(self):
+		"""Ensures calls beyond the pool and its queue are refused"""
+
+		hasher = PasswordHasher(bcrypt, rounds=12, max_workers=1, max_waiting=0, wait_timeout=0)
+		thread = threading.Thread(target=hasher.hash, args=['password'])
+		thread.start()
+		time.sleep(0.05)
+
+		with self.assertRaises(PasswordHasherBusy):
+			hasher.hash('password')
+		thread.join()
+		self.assertTrue(hasher.check(hasher.hash('password'), 'password'))
+
+class SpatialTestCase(TestCase):
+	"""Tests for the spatial cell index helpers"""
+
+	def test_covering_ranges_contain_point(self):
+		"""Ensures a point inside the bounds falls in a covering range"""
+
+		key = cell_key(user_data['lat'], user_data['long'])
+		ranges = covering_ranges(49.3, 49.1, -122.8, -123.5)
+
+		self.assertTrue(len(ranges) <= 32)
+		self.assertTrue(any(low <= key <= high for low, high in ranges))
+
+	def test_tile_bounds(self):
+		"""Ensures tile bounds follow the Web Mercator tiling"""
+
+		north, south, east, west = tile_bounds(1, 0, 0)
+
+		self.assertAlmostEqual(north, 85.0511287798)
+		self.assertAlmostEqual(south, 0)
+		self.assertEqual((east, west), (0, -180))
+
+	def test_haversine_km(self):
+		"""Ensures great-circle distances are computed in km"""
+
+		distances = haversine_km(0, 0, [1, 0], [0, 180])
+
+		self.assertAlmostEqual(distances[0], 111.2, places=1)
+		self.assertAlmostEqual(distances[1], 20015.1, places=0)
+
+	def test_radius_boxes_antimeridian(self):
+		"""Ensures search boxes crossing the antimeridian are split"""
+
+		boxes = radius_boxes(0, 179.9, 50)
+
+		self.assertEqual(len(boxes), 2)
+		self.assertEqual(boxes[1][2], 180.0)
+
+	def test_covering_ranges_empty_bounds(self):
+		"""Ensures inverted bounds produce no ranges"""
+
+		self.assertEqual(covering_ranges(10, 20, 5, 0), [])
+		self.assertEqual(covering_ranges(20, 10, 0, 5), [])
+
+	def test_cell_keys_match_cell_key(self):
+		"""Ensures vectorized cell keys equal the scalar ones"""
+
+		lats = [user_data['lat'], -90, 90, 0, -33.8688]
+		longs = [user_data['long'], -180, 180, 0, 151.2093]
+
+		self.assertEqual(cell_keys(lats, longs).tolist(),
+			[cell_key(lat, long) for lat, long in zip(lats, longs)])
+
+class RegionCacheTestCase(TestCase):
+	"""Tests for the region cache"""
+
+	def test_lru_byte_budget(self):
+		"""Ensures least recently used entries are evicted past the budget"""
+
+		cache = RegionCache(max_bytes=10, max_age=60)
+		cache.put('a', (1, 0, 1, 0), b'aaaa', 4, cache.begin())
+		cache.put('b', (1, 0, 1, 0), b'bbbb', 4, cache.begin())
+		cache.get('a')
+		cache.put('c', (1, 0, 1, 0), b'cccc', 4, cache.begin())
+
+		self.assertEqual(cache.get('a'), b'aaaa')
+		self.assertIsNone(cache.get('b'))
+		self.assertEqual(cache.size, 8)
+
+	def test_invalidate_point(self):
+		"""Ensures only entries whose region holds the point are dropped"""
+
+		cache = RegionCache(max_bytes=100, max_age=60)
+		cache.put('near', (2, 0, 2, 0), b'near', 4, cache.begin())
+		cache.put('far', (12, 10, 12, 10), b'far', 3, cache.begin())
+		cache.invalidate_point(1, 1)
+
+		self.assertIsNone(cache.get('near'))
+		self.assertEqual(cache.get('far'), b'far')
+
+	def test_put_after_invalidation_skipped(self):
+		"""Ensures values computed during an invalidation are not stored"""
+
+		cache = RegionCache(max_bytes=100, max_age=60)
+		token = cache.begin()
+		cache.invalidate_point(1, 1)
+		cache.put('a', (2, 0, 2, 0), b'old', 3, token)
+
+		self.assertIsNone(cache.get('a'))
+
+class IndexRebuildTestCase(TestCase):
+	"""Tests for rebuilding the in-memory indexes"""
+
+	def setUp(self):
+		"""Make a load function which blocks while rebuilding."""
+
+		self.rows = []
+		self.rebuilding = threading.Event()
+		self.release = threading.Event()
+
+	def load(self, index):
+		"""Returns the rows, waiting for release if the index is built."""
+
+		rows = list(self.rows)
+		if index._data is not None:
+			self.rebuilding.set()
+			self.release.wait(5)
+		return rows
+
+	def rebuild(self, index, read):
+		"""Starts a rebuild of an index and waits until it is loading."""
+
+		time.sleep(0.01)
+		thread = threading.Thread(target=read)
+		thread.start()
+		self.assertTrue(self.rebuilding.wait(5))
+		return thread
+
+	def test_tag_index_rebuild(self):
+		"""Ensures reads go on during a rebuild and changes applied
+		meanwhile are kept"""
+
+		self.rows = [(1, 'paint')]
+		index = TagIndex(lambda: self.load(index), max_age=0)
+		self.assertEqual(index.usage(['paint']), {'paint': 1})
+
+		thread = self.rebuild(index, lambda: index.usage(['paint']))
+		self.assertEqual(index.usage(['paint']), {'paint': 1})
+		index.apply([ProjectChange(2, [], False, ['paint'], None)])
+		self.release.set()
+		thread.join()
+
+		index.max_age = None
+		self.assertEqual(index.carrying([1, 2], ['paint']), [True, True])
+
+	def test_text_index_rebuild(self):
+		"""Ensures a wholesale change during a rebuild discards it"""
+
+		self.rows = [(1, 'Mural', 'Paint a wall')]
+		index = TextIndex(lambda: self.load(index), max_age=0)
+		self.assertEqual(list(index.search('mural')), [1])
+
+		thread = self.rebuild(index, lambda: index.search('mural'))
+		self.assertEqual(list(index.search('wall')), [1])
+		index.apply([ProjectChange(1, [], False, None, ('Shed', 'Build a shed'))])
+		self.assertEqual(list(index.search('shed')), [1])
+		self.rows = [(2, 'Bench', 'Build a bench')]
+		index.apply(None)
+		self.release.set()
+		thread.join()
+
+		index.max_age = None
+		self.assertEqual(list(index.search('build')), [2])
+
+class TagCompleterTestCase(TestCase):
+	"""Tests for the precomputed tag completions"""
+
+	def setUp(self):
+		"""Make a catalogue and count the usage lookups."""
+
+		self.snapshot = CatalogueSnapshot(1, ['glass art', 'glazing', 'Glazing', 'gluing', 'grout'], None, None)
+		self.counts = {'glass art': 1, 'glazing': 3, 'Glazing': 0, 'gluing': 7, 'grout': 2}
+		self.lookups = 0
+		catalogue = type('Catalogue', (), {'get': lambda catalogue: self.snapshot})()
+		self.completer = TagCompleter(catalogue, self.usage, max_limit=3)
+
+	def usage(self, names):
+		self.lookups += 1
+		return {name: self.counts[name] for name in names}
+
+	def test_complete(self):
+		"""Ensures exact matches come first, then the most used tags, from
+		counts looked up once per snapshot"""
+
+		self.assertEqual(self.completer.complete('g', 10), [('gluing', 7), ('glazing', 3), ('grout', 2)])
+		self.assertEqual(self.completer.complete('GLAZING ', 10), [('glazing', 3), ('Glazing', 0)])
+		self.assertEqual(self.completer.complete('gl', 10), [('gluing', 7), ('glazing', 3), ('glass art', 1)])
+		self.assertEqual(self.completer.complete('gla', 1), [('glazing', 3)])
+		self.assertEqual(self.completer.complete('x', 10), [])
+		self.assertEqual(self.lookups, 1)
+
+		self.counts['grout'] = 9
+		self.snapshot = CatalogueSnapshot(2, self.snapshot.items, None, None)
+		self.assertEqual(self.completer.complete('g', 1), [('grout', 9)])
+		self.assertEqual(self.lookups, 2)